@@ -0,0 +1,76 @@
+""" Bandwidth, CPU cost and quality of the audio encodings of the TTS output.
+
+Encodes audio in chunks of one Mimi frame (80 ms at 24 kHz), like the TTS server sends it, with every encoding that is
+available here (Opus needs `opuslib`), decodes it again like the client does, and reports the bytes per second of
+speech, the encode and decode time per second of speech and the signal-to-noise ratio of the decoded audio. The audio
+is read from a mono WAV file (e.g. a reply saved in `outputs/`) or synthesized. Run from the `voice_note` directory:
+
+    python -m benchmarks.audio_encoding --wav outputs/<conversation>/<assistant audio>.wav
+"""
+import argparse
+import time
+import wave
+
+import numpy as np
+
+from server.utils.audio_encoding import FLOAT32, AudioDecoder, AudioEncoder, available_encodings
+
+RATE = 24_000
+FRAME_SIZE = 1920  # Samples of one Mimi frame.
+
+
+def synthesize(seconds: float) -> np.ndarray:
+    """ Harmonics of a gliding pitch with a syllable-like envelope and some noise, roughly like voiced speech. """
+    t = np.arange(int(seconds * RATE)) / RATE
+    pitch = 2 * np.pi * np.cumsum(140 + 30 * np.sin(2 * np.pi * 0.7 * t)) / RATE
+    voiced = sum(np.sin(k * pitch) / k for k in range(1, 12))
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    noise = np.random.default_rng(0).normal(0, 0.01, len(t))
+    return (0.15 * voiced * envelope + noise).astype(np.float32)
+
+
+def read_wav(path: str) -> np.ndarray:
+    with wave.open(path, 'rb') as wf:
+        assert wf.getnchannels() == 1 and wf.getsampwidth() == 2, 'Expected mono 16-bit PCM.'
+        if wf.getframerate() != RATE:
+            print(f'Note: {path} has {wf.getframerate()} Hz, it is treated as {RATE} Hz.')
+        return np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16).astype(np.float32) / 32767
+
+
+def bench(encoding: str, pcm: np.ndarray) -> None:
+    frames = [pcm[start:start + FRAME_SIZE] for start in range(0, len(pcm) - FRAME_SIZE + 1, FRAME_SIZE)]
+    seconds = len(frames) * FRAME_SIZE / RATE
+
+    encoder = AudioEncoder(encoding, RATE)
+    start = time.process_time()
+    encoded = [encoder.encode(frame) for frame in frames]
+    encode_time = time.process_time() - start
+
+    decoder = AudioDecoder(encoding, RATE)
+    start = time.process_time()
+    decoded = b''.join(decoder.decode(data) for data in encoded)
+    decode_time = time.process_time() - start
+
+    if encoding == FLOAT32:
+        output = np.frombuffer(decoded, dtype=np.float32)
+    else:
+        output = np.frombuffer(decoded, dtype=np.int16) / 32767
+    reference = np.concatenate(frames)
+    noise = output[:len(reference)] - reference
+    quality = f'SNR {10 * np.log10(np.sum(reference ** 2) / np.sum(noise ** 2)):5.1f} dB' if noise.any() else 'lossless'
+    print(f'{encoding:>6}: {sum(map(len, encoded)) / seconds / 1e3:7.1f} kB/s, '
+          f'encode {encode_time / seconds * 1e3:6.2f} ms/s, decode {decode_time / seconds * 1e3:6.2f} ms/s, {quality}')
+
+
+def main(args: argparse.Namespace) -> None:
+    pcm = read_wav(args.wav) if args.wav else synthesize(args.seconds)
+    print(f'{len(pcm) / RATE:.1f} s of audio, in chunks of {FRAME_SIZE} samples')
+    for encoding in available_encodings():
+        bench(encoding, pcm)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--wav', help='Mono 16-bit WAV file at 24 kHz, synthesized audio is used without it.')
+    parser.add_argument('--seconds', type=float, default=30., help='Length of the synthesized audio.')
+    main(parser.parse_args())
@@ -0,0 +1,79 @@
+""" Time to the first text of a response for a new client and after starting a new conversation, with and without
+pre-started Pi processes (`CHAT_PI_POOL_SIZE`).
+
+Uses `benchmarks/fake_pi.py`, which takes `--startup` seconds to start (like Node loading Pi) and `--reset` seconds to
+reset its session. Set `PI_COMMAND` to measure the real Pi instead (needs llama.cpp). The client connects `--delay`
+seconds after the chat server started and starts the new conversation `--delay` seconds after the first response. Run
+from the `voice_note` directory:
+
+    python -m benchmarks.chat_pi_pool --pool-sizes 0 1
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from server.base_server import _current_session
+from server.chat.chat import CHAT_AGENT_CWD, ChatServer, PiProcessPool
+
+
+class FirstText:
+    """ Stands in for the client stream and notes when the first text arrives. """
+
+    def __init__(self):
+        self.first_text = None
+
+    def send(self, data: dict) -> None:
+        if data.get('text') and self.first_text is None:
+            self.first_text = time.perf_counter()
+
+
+async def time_to_first_text(server: ChatServer, stream: FirstText, text: str, request_id: str) -> float:
+    stream.first_text = None
+    start = time.perf_counter()
+    await server._run_workload([{'text': text, 'id': request_id}])
+    return stream.first_text - start
+
+
+async def run(pool_size: int, delay: float) -> tuple[float, float]:
+    server = ChatServer('localhost', 0)
+    server.pi_pool = PiProcessPool(server.pi_command, CHAT_AGENT_CWD, pool_size)
+    server.pi_pool.warm_up()  # Like `serve_forever`
+    await asyncio.sleep(delay)
+
+    session = server._create_session(None)
+    stream = session.streams['client'] = FirstText()
+    _current_session.set(session)
+    try:
+        first = await time_to_first_text(server, stream, 'Hello!', 'first')
+        await asyncio.sleep(delay)
+        session.new_session_requested = True  # Like a `NEW CONVERSATION` message.
+        new_conversation = await time_to_first_text(server, stream, 'Hello again!', 'second')
+    finally:
+        await server._close_session(session)
+        await server.pi_pool.close()
+    return first, new_conversation
+
+
+async def main(args: argparse.Namespace) -> None:
+    for pool_size in args.pool_sizes:
+        results = [await run(pool_size, args.delay) for _ in range(args.repeats)]
+        first, new_conversation = (statistics.median(times) for times in zip(*results))
+        print(f'Pool size {pool_size}: first response after {first * 1e3:7.1f} ms, '
+              f'after a new conversation {new_conversation * 1e3:7.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pool-sizes', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--delay', type=float, default=2., help='Seconds between server start, client and reset.')
+    parser.add_argument('--startup', type=float, default=1., help='Startup time of the fake Pi.')
+    parser.add_argument('--reset', type=float, default=0.2, help='Time the fake Pi takes for `new_session`.')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    os.environ.setdefault('PI_COMMAND', f'{sys.executable} {Path(__file__).parent / "fake_pi.py"} '
+                                        f'--startup {args.startup} --reset {args.reset}')
+    asyncio.run(main(args))
@@ -0,0 +1,74 @@
+""" Per-chunk cost of saving assistant responses in a `Conversation`, depending on the length of the turn.
+
+Simulates turns of increasing length, each chunk carrying a few characters of text and one Mimi frame of float32 audio,
+and reports how long the calls block the caller (the event loop, in the servers): the mean time per chunk at the start
+and at the end of each turn, the slowest chunk and `add_turn`. `--slow-disk` adds a delay to every WAV write, to see how
+a slow disk shows up; `--chunk-interval` paces the chunks like a real response would. Run from the `voice_note` directory:
+
+    python -m benchmarks.conversation --slow-disk 5 --chunk-interval 10
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from server.utils.audio import AudioConfig
+from server.utils import conversation as conversation_module
+from server.utils.conversation import Conversation
+
+FRAME_BYTES = 1920 * 4  # 80 ms of float32 audio at 24 kHz.
+
+
+def bench_turn(conversation: Conversation, n_chunks: int, audio_config: AudioConfig,
+               chunk_interval: float) -> tuple[float, list[float]]:
+    start = time.perf_counter()
+    conversation.add_turn('How are you?', b'\x00\x00' * 16000 * 10, AudioConfig(format=8, channels=1, rate=16000))
+    add_turn_time = time.perf_counter() - start
+    audio_chunk = b'\x00' * FRAME_BYTES
+    timings = []
+    for _ in range(n_chunks):
+        start = time.perf_counter()
+        conversation.update_assistant_response(text_chunk='word ', audio_chunk=audio_chunk, audio_config=audio_config)
+        timings.append(time.perf_counter() - start)
+        time.sleep(chunk_interval)
+    conversation.finalize_assistant_response()
+    return add_turn_time, timings
+
+
+def slow_down_wav_writes(delay: float) -> None:
+    write = conversation_module.StreamingWavWriter.write
+
+    def slow_write(self, audio_bytes: bytes) -> None:
+        time.sleep(delay)
+        write(self, audio_bytes)
+
+    conversation_module.StreamingWavWriter.write = slow_write
+
+
+def main(args: argparse.Namespace) -> None:
+    audio_config = AudioConfig(format=1, channels=1, rate=24000)
+    if args.slow_disk:
+        slow_down_wav_writes(args.slow_disk / 1000)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)  # Conversations are saved relative to the working directory.
+        conversation = Conversation()
+        for n_chunks in args.turn_lengths:
+            add_turn_time, timings = bench_turn(conversation, n_chunks, audio_config, args.chunk_interval / 1000)
+            window = max(1, min(100, n_chunks // 10))
+            print(f'Turn with {n_chunks:5d} chunks ({n_chunks * 0.08:6.1f} s of audio): '
+                  f'first {window} chunks {statistics.mean(timings[:window]) * 1e6:8.1f} us/chunk, '
+                  f'last {window} chunks {statistics.mean(timings[-window:]) * 1e6:8.1f} us/chunk, '
+                  f'max {max(timings) * 1e3:6.2f} ms, add_turn {add_turn_time * 1e3:6.2f} ms, '
+                  f'total {sum(timings):.3f} s')
+        start = time.perf_counter()
+        conversation.close()
+        print(f'close (waits for pending writes): {time.perf_counter() - start:.3f} s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turn-lengths', type=int, nargs='+', default=[100, 500, 1000, 2000])
+    parser.add_argument('--chunk-interval', type=float, default=0., help='Pause between chunks in milliseconds')
+    parser.add_argument('--slow-disk', type=float, default=0., help='Delay of every WAV write in milliseconds')
+    main(parser.parse_args())
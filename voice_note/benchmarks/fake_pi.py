@@ -0,0 +1,77 @@
+""" Stands in for `pi --mode rpc` in benchmarks, without Node or a language model.
+
+Takes `--startup` seconds before it reads the first command (like Node loading Pi), `--reset` seconds for `new_session`
+and answers every prompt with `--tokens` text deltas (`<prompt>:<index> `), the first one after `--first-token` seconds
+and then one every `--token-interval` seconds. `abort` stops a running response (unless `--ignore-abort`). Unknown
+arguments (Pi's own) are ignored, so it can be used as `PI_COMMAND`:
+
+    PI_COMMAND="python benchmarks/fake_pi.py --startup 1" python -m server.chat.chat
+"""
+import argparse
+import asyncio
+import json
+import sys
+from typing import Optional
+
+
+def emit(event: dict) -> None:
+    sys.stdout.write(json.dumps(event) + '\n')
+    sys.stdout.flush()
+
+
+def text_delta(delta: str) -> dict:
+    return {'type': 'message_update', 'assistantMessageEvent': {'type': 'text_delta', 'delta': delta}}
+
+
+async def generate(message: str, args: argparse.Namespace) -> None:
+    emit({'type': 'agent_start'})
+    try:
+        await asyncio.sleep(args.first_token)
+        for idx in range(args.tokens):
+            if idx > 0:
+                await asyncio.sleep(args.token_interval)
+            emit(text_delta(f'{message}:{idx} '))
+    finally:
+        emit({'type': 'agent_end'})
+
+
+async def main(args: argparse.Namespace) -> None:
+    await asyncio.sleep(args.startup)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    generation: Optional[asyncio.Task] = None
+    while line := await reader.readline():
+        command = json.loads(line)
+        if command['type'] == 'extension_ui_response':
+            continue
+        response = {'type': 'response', 'id': command.get('id'), 'command': command['type'], 'success': True}
+        if command['type'] == 'prompt':
+            if generation is not None and not generation.done():
+                emit(response | {'success': False, 'error': 'Agent is already processing.'})
+                continue
+            emit(response)
+            generation = asyncio.create_task(generate(command['message'], args))
+        elif command['type'] == 'abort':
+            if generation is not None and not generation.done() and not args.ignore_abort:
+                generation.cancel()
+                await asyncio.gather(generation, return_exceptions=True)
+            emit(response)
+        elif command['type'] == 'new_session':
+            await asyncio.sleep(args.reset)
+            emit(response | {'data': {'cancelled': False}})
+        else:
+            emit(response)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--startup', type=float, default=1., help='Seconds until the first command is read.')
+    parser.add_argument('--reset', type=float, default=0.2, help='Seconds `new_session` takes.')
+    parser.add_argument('--first-token', type=float, default=0.1, help='Seconds until the first text delta.')
+    parser.add_argument('--token-interval', type=float, default=0.02)
+    parser.add_argument('--tokens', type=int, default=20)
+    parser.add_argument('--ignore-abort', action='store_true',
+                        help='Go on with responses after `abort`, like a hung Pi.')
+    asyncio.run(main(parser.parse_known_args()[0]))
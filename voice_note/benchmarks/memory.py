@@ -0,0 +1,32 @@
+""" Peak memory measurements for the benchmarks, needs Linux with glibc. """
+import ctypes
+import gc
+import re
+import time
+from pathlib import Path
+
+libc = ctypes.CDLL('libc.so.6')
+
+
+def map_large_buffers() -> None:
+    """ Map and unmap large buffers, instead of reusing freed (and still resident) heap memory. Otherwise only the first
+    run of a benchmark would increase the peak. """
+    libc.mallopt(-3, 128 * 1024)  # M_MMAP_THRESHOLD
+
+
+def _memory_kb(field: str) -> int:
+    return int(re.search(rf'{field}:\s+(\d+) kB', Path('/proc/self/status').read_text()).group(1))
+
+
+def measure(fn, *args) -> tuple[float, float]:
+    """ Seconds and peak resident memory increase in MB of `fn(*args)`. """
+    gc.collect()
+    libc.malloc_trim(0)  # Small allocations of earlier runs are freed to the heap, return them to the system.
+    Path('/proc/self/clear_refs').write_text('5')  # Resets the peak resident set size.
+    before = _memory_kb('VmRSS')
+    start = time.perf_counter()
+    result = fn(*args)
+    seconds = time.perf_counter() - start
+    peak = _memory_kb('VmHWM') - before
+    del result
+    return seconds, peak / 1024
@@ -0,0 +1,90 @@
+""" Throughput benchmark for the JSON/base64 and the binary `Message` wire formats.
+
+Measures encode + decode throughput and wire size for audio messages, and the end-to-end throughput of sending them
+through a pair of `StreamingConnection`s over a local WebSocket. Run from the `voice_note` directory:
+
+    python -m benchmarks.message
+"""
+import argparse
+import asyncio
+import contextlib
+import time
+
+import websockets
+
+from server.utils.message import BINARY_SUBPROTOCOL, Message, select_subprotocol
+from server.utils.streaming_connection import StreamingConnection
+
+HOST = '127.0.0.1'
+FORMATS = {
+    'json': (lambda msg: msg.encode(), Message.from_frame),
+    'binary': (lambda msg: msg.encode_binary(), Message.from_frame),
+}
+
+
+def _audio_message(chunk_size: int) -> Message:
+    # 80 ms of float32 audio at 24 kHz is 7680 bytes, i.e. one Mimi frame as sent by the TTS server.
+    return Message({'id': 'bench', 'status': 'GENERATING', 'audio': bytes(range(256)) * (chunk_size // 256),
+                    'config': {'format': 1, 'channels': 1, 'rate': 24000}})
+
+
+def bench_codec(chunk_size: int, n_messages: int) -> None:
+    msg = _audio_message(chunk_size)
+    for name, (encode, decode) in FORMATS.items():
+        start = time.perf_counter()
+        for _ in range(n_messages):
+            decode(encode(msg))
+        elapsed = time.perf_counter() - start
+        encoded = encode(msg)
+        wire_size = len(encoded.encode() if isinstance(encoded, str) else encoded)
+        print(f'{name:>6} codec: {n_messages / elapsed:9.0f} msg/s, {n_messages * chunk_size / elapsed / 1e6:7.1f} MB/s '
+              f'of audio, {wire_size} bytes on the wire ({100 * (wire_size / chunk_size - 1):.1f}% overhead)')
+
+
+async def _sink_handler(websocket) -> None:
+    connection = StreamingConnection('bench_sink', websocket)
+    run_task = asyncio.create_task(connection.run())
+    try:
+        while True:
+            for msg in connection.recv():
+                if msg['status'] == 'FINISHED':
+                    connection.send(msg)
+            await connection.wait_readable()
+    except ConnectionError:
+        pass
+    finally:
+        run_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await run_task
+
+
+async def bench_websocket(chunk_size: int, n_messages: int) -> None:
+    async with websockets.serve(_sink_handler, HOST, 0, select_subprotocol=select_subprotocol) as server:
+        uri = f'ws://{HOST}:{server.sockets[0].getsockname()[1]}'
+        for name, subprotocols in [('json', None), ('binary', [BINARY_SUBPROTOCOL])]:
+            connection = StreamingConnection('bench_source', await websockets.connect(uri, subprotocols=subprotocols))
+            run_task = asyncio.create_task(connection.run())
+            msg = _audio_message(chunk_size).data
+
+            start = time.perf_counter()
+            for _ in range(n_messages):
+                connection.send(msg)
+            connection.send(msg | {'status': 'FINISHED'})
+            while not connection.recv():
+                await connection.wait_readable()
+            elapsed = time.perf_counter() - start
+
+            print(f'{name:>6} websocket: {n_messages / elapsed:9.0f} msg/s, '
+                  f'{n_messages * chunk_size / elapsed / 1e6:7.1f} MB/s of audio')
+            await connection.close()
+            with contextlib.suppress(asyncio.CancelledError):
+                await run_task
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunk-size', type=int, default=7680)
+    parser.add_argument('--messages', type=int, default=5000)
+    args = parser.parse_args()
+    bench_codec(args.chunk_size, args.messages)
+    asyncio.run(bench_websocket(args.chunk_size, args.messages))
@@ -0,0 +1,104 @@
+""" Latency and CPU benchmark for `StreamingConnection`.
+
+Measures the round-trip latency of small messages through an echo server and the CPU time burned by idle connections.
+Run from the `voice_note` directory:
+
+    python -m benchmarks.streaming_connection
+"""
+import argparse
+import asyncio
+import contextlib
+import statistics
+import time
+
+import websockets
+
+from server.utils.streaming_connection import POLL_INTERVAL, StreamingConnection
+
+HOST = '127.0.0.1'
+
+
+async def _wait_readable(connection: StreamingConnection) -> None:
+    # Fall back to polling for revisions of `StreamingConnection` without an awaitable receive path.
+    if hasattr(connection, 'wait_readable'):
+        await connection.wait_readable()
+    else:
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def _echo_handler(websocket) -> None:
+    connection = StreamingConnection('bench_echo', websocket)
+    run_task = asyncio.create_task(connection.run())
+    try:
+        while True:
+            for msg in connection.recv():
+                connection.send(msg)
+            await _wait_readable(connection)
+    except ConnectionError:
+        pass
+    finally:
+        run_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await run_task
+
+
+async def _open(port: int, name: str) -> tuple[StreamingConnection, asyncio.Task]:
+    connection = StreamingConnection(name, await websockets.connect(f'ws://{HOST}:{port}'))
+    return connection, asyncio.create_task(connection.run())
+
+
+async def bench_latency(port: int, n_messages: int, payload_size: int) -> list[float]:
+    connection, run_task = await _open(port, 'bench_latency')
+    payload = b'\x00' * payload_size
+    latencies = []
+    try:
+        for idx in range(n_messages):
+            start = time.perf_counter()
+            connection.send({'id': None, 'audio': payload, 'status': 'RECORDING', 'idx': idx})
+            received = []
+            while not received:
+                await _wait_readable(connection)
+                received = connection.recv()
+            latencies.append(time.perf_counter() - start)
+    finally:
+        await connection.close()
+        with contextlib.suppress(asyncio.CancelledError):
+            await run_task
+    return latencies
+
+
+async def bench_idle_cpu(port: int, n_connections: int, duration: float) -> float:
+    opened = [await _open(port, f'bench_idle_{idx}') for idx in range(n_connections)]
+    try:
+        start = time.process_time()
+        await asyncio.sleep(duration)
+        return time.process_time() - start
+    finally:
+        for connection, run_task in opened:
+            await connection.close()
+            with contextlib.suppress(asyncio.CancelledError):
+                await run_task
+
+
+async def main(args: argparse.Namespace) -> None:
+    async with websockets.serve(_echo_handler, HOST, 0) as server:
+        port = server.sockets[0].getsockname()[1]
+
+        latencies = await bench_latency(port, args.messages, args.payload_size)
+        latencies_ms = sorted(latency * 1000 for latency in latencies)
+        print(f'Round-trip latency over {args.messages} messages of {args.payload_size} bytes: '
+              f'mean {statistics.mean(latencies_ms):.3f} ms, median {statistics.median(latencies_ms):.3f} ms, '
+              f'p99 {latencies_ms[int(len(latencies_ms) * 0.99) - 1]:.3f} ms')
+
+        cpu_time = await bench_idle_cpu(port, args.idle_connections, args.idle_duration)
+        print(f'Idle CPU with {args.idle_connections} connections (both ends in this process): '
+              f'{cpu_time:.3f} s over {args.idle_duration:.1f} s ({100 * cpu_time / args.idle_duration:.1f}% of a core)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--payload-size', type=int, default=3200)
+    parser.add_argument('--idle-connections', type=int, default=20)
+    parser.add_argument('--idle-duration', type=float, default=3.0)
+    asyncio.run(main(parser.parse_args()))
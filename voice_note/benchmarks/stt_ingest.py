@@ -0,0 +1,118 @@
+""" Peak memory and CPU time of collecting a long recording in the STT server, with and without the shared buffer.
+
+A recording of `--minutes` of noise with short pauses arrives in messages of 0.1 s, like the client sends them. `old`
+keeps the audio in the messages and joins it (batch transcription) or collects it like `IncrementalTranscription` did
+before (streaming transcription). `new` moves it into an `AudioBuffer`, of which the transcription windows and the saved
+turn are views. Transcribing a window is replaced by reading it. Peak memory is the increase of the resident set size
+until the turn is saved and needs Linux with glibc. Run from the `voice_note` directory:
+
+    python -m benchmarks.stt_ingest --minutes 10
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import numpy as np
+
+from benchmarks.memory import map_large_buffers, measure
+from server.utils.audio_buffer import AudioBuffer
+from server.utils.incremental_transcription import MAX_WINDOW_SECONDS, MIN_WINDOW_SECONDS, IncrementalTranscription
+from server.utils.vad import find_pause
+
+CHUNK_SECONDS = 0.1
+BUFFER_SECONDS = 600.  # Capacity of the buffer, like in the STT server.
+
+
+def make_recording(minutes: float, rate: int) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    audio = (rng.standard_normal(int(minutes * 60 * rate)) * 3000).astype(np.int16)
+    audio[np.arange(len(audio)) % int(3.5 * rate) >= 3 * rate] = 0  # A pause of 0.5 s every 3.5 s.
+    return audio
+
+
+def arriving(audio: np.ndarray, rate: int):
+    """ The messages of the recording, the audio bytes of each one are only created when it arrives. """
+    chunk_size = int(CHUNK_SECONDS * rate)
+    for start in range(0, len(audio), chunk_size):
+        yield {'audio': audio[start:start + chunk_size].tobytes(), 'id': 'bench', 'status': 'RECORDING'}
+
+
+def transcribe(window) -> str:
+    np.frombuffer(window, dtype=np.int16).max()  # Reads the window without copying it.
+    return ''
+
+
+def old_batch(audio: np.ndarray, rate: int):
+    messages = list(arriving(audio, rate))  # Kept until the workload is done.
+    audio_bytes = b''.join([msg.get('audio', b'') for msg in messages])
+    transcribe(audio_bytes)
+    return messages, audio_bytes  # The audio is kept until the turn is saved.
+
+
+def new_batch(audio: np.ndarray, rate: int):
+    recording = AudioBuffer(int(BUFFER_SECONDS * rate) * 2)
+    messages = []
+    for msg in arriving(audio, rate):
+        recording.append(msg.pop('audio'))
+        messages.append(msg)
+    transcribe(recording.view())
+    return messages, recording.view()
+
+
+def old_streaming(audio: np.ndarray, rate: int):
+    messages, fragments, pending = [], [], bytearray()
+    for msg in arriving(audio, rate):
+        messages.append(msg)
+        fragments.append(msg['audio'])
+        pending += msg['audio']
+        pending_seconds = len(pending) / (2 * rate)
+        if pending_seconds < MIN_WINDOW_SECONDS:
+            continue
+        split = find_pause(bytes(pending), rate, min_seconds=pending_seconds / 2,
+                           force=pending_seconds >= MAX_WINDOW_SECONDS)
+        if split is not None:
+            transcribe(bytes(pending[:split]))
+            del pending[:split]
+    transcribe(bytes(pending))
+    return messages, b''.join(fragments)
+
+
+def new_streaming(audio: np.ndarray, rate: int):
+    async def run():
+        async def transcribe_window(window: memoryview) -> str:
+            return transcribe(window)
+
+        incremental = IncrementalTranscription('bench', rate, transcribe_window,
+                                               audio=AudioBuffer(int(BUFFER_SECONDS * rate) * 2))
+        messages = []
+        for msg in arriving(audio, rate):
+            incremental.add_audio(msg.pop('audio'))
+            messages.append(msg)
+            await asyncio.sleep(0)  # Windows are transcribed while the recording arrives.
+        await incremental.finish()
+        return messages, incremental.get_audio_bytes()
+    return asyncio.run(run())
+
+
+def main(args: argparse.Namespace) -> None:
+    map_large_buffers()
+    audio = make_recording(args.minutes, args.rate)
+    print(f'{args.minutes:.0f} min at {args.rate} Hz, {audio.nbytes / 2 ** 20:.1f} MB of audio')
+    for name, fn in [('old batch', old_batch), ('new batch', new_batch),
+                     ('old streaming', old_streaming), ('new streaming', new_streaming)]:
+        cpu, peaks = [], []
+        for _ in range(args.repeats):
+            start = time.process_time()
+            _, peak = measure(fn, audio, args.rate)
+            cpu.append(time.process_time() - start)
+            peaks.append(peak)
+        print(f'{name:13}: peak memory +{statistics.median(peaks):6.1f} MB, CPU {statistics.median(cpu) * 1e3:7.1f} ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--minutes', type=float, default=10., help='Length of the recording.')
+    parser.add_argument('--rate', type=int, default=48_000, help='Sample rate of the recording.')
+    parser.add_argument('--repeats', type=int, default=3)
+    main(parser.parse_args())
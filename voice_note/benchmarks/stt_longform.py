@@ -0,0 +1,82 @@
+""" Transcription throughput (seconds of audio per second) against the length of a recording, e.g. on the CPU.
+
+Needs the Whisper model in `models/whisper-medium` and a 16 bit mono WAV recording, which is repeated with `--pause`
+seconds of silence in between until each length of `--seconds` is reached. `truncated` is the transcription before long
+recordings were split: one window of which Whisper only hears the first 30 s. `sequential` splits the recording at
+pauses into windows of at most 30 s and transcribes them one after another, `batched` (`Sample.transcribe_batch`)
+transcribes all windows with one `generate` call. The word count shows how much of the recording made it into the text.
+Run from the `voice_note` directory:
+
+    CUDA_VISIBLE_DEVICES= python -m benchmarks.stt_longform recording.wav --seconds 15 30 60 120 300
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+import torch
+
+from benchmarks.stt_streaming import load_wav
+from server.stt.stt import LANG, Transcription
+from server.utils.audio import AudioConfig
+from server.utils.sample import MAX_WINDOW_SECONDS, SAMPLE_RATE, Sample
+from server.utils.vad import split_at_pauses
+
+
+def generate(transcription: Transcription, windows: list[np.ndarray]) -> list[str]:
+    processor, model = transcription.processor, transcription.model
+    input_features = processor(windows, sampling_rate=SAMPLE_RATE, return_tensors='pt').input_features
+    pred_ids = model.generate(input_features.to(model.device, dtype=model.dtype), language=LANG)
+    return [text.strip() for text in processor.batch_decode(pred_ids, skip_special_tokens=True)]
+
+
+def truncated(transcription: Transcription, sample: Sample) -> str:
+    return generate(transcription, [sample.audio_data.numpy()])[0]
+
+
+def sequential(transcription: Transcription, sample: Sample) -> str:
+    data = sample.audio_data.numpy()
+    windows = [data[start:end] for start, end in split_at_pauses(data, SAMPLE_RATE, MAX_WINDOW_SECONDS)]
+    return ' '.join(generate(transcription, [window])[0] for window in windows)
+
+
+def batched(transcription: Transcription, sample: Sample) -> str:
+    Sample.transcribe_batch([sample], transcription.model, transcription.processor, LANG, vad=False)
+    return sample.result
+
+
+def make_recording(audio_bytes: bytes, audio_config: AudioConfig, seconds: float, pause: float) -> bytes:
+    speech_and_pause = audio_bytes + bytes(int(pause * audio_config.rate) * 2)
+    repeats = int(seconds * audio_config.bytes_per_second) // len(speech_and_pause) + 1
+    return (speech_and_pause * repeats)[:int(seconds * audio_config.rate) * 2]
+
+
+def main(args: argparse.Namespace) -> None:
+    torch.set_num_threads(args.threads)
+    transcription = Transcription()
+    audio_bytes, audio_config = load_wav(args.wav)
+    batched(transcription, Sample(fragments=[audio_bytes], audio_config=audio_config))  # Warmup
+    for seconds in args.seconds:
+        recording = make_recording(audio_bytes, audio_config, seconds, args.pause)
+        for name, fn in [('truncated', truncated), ('sequential', sequential), ('batched', batched)]:
+            times, text = [], ''
+            for _ in range(args.repeats):
+                sample = Sample(fragments=[recording], audio_config=audio_config)
+                _ = sample.audio_data  # Preprocessing is not part of the comparison.
+                start = time.perf_counter()
+                text = fn(transcription, sample)
+                times.append(time.perf_counter() - start)
+            elapsed = statistics.median(times)
+            print(f'{seconds:5.0f} s, {name:10}: {elapsed:6.2f} s, {seconds / elapsed:5.2f} s of audio per s, '
+                  f'{len(text.split())} words')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('wav')
+    parser.add_argument('--seconds', type=float, nargs='+', default=[15., 30., 60., 120., 300.],
+                        help='Lengths of the recordings.')
+    parser.add_argument('--pause', type=float, default=1., help='Seconds of silence between the repetitions.')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=torch.get_num_threads(), help='Torch threads.')
+    main(parser.parse_args())
@@ -0,0 +1,77 @@
+""" Time and peak memory of turning a recording into Whisper's 16 kHz float input, per utterance.
+
+Compares the old preprocessing (a new `Resample` per utterance, all fragments joined and converted at once) with the
+cached resampler and block by block conversion of `Sample`, once after the whole recording arrived and once
+resampled in the background while it arrives (`Sample.add_fragment`, only the time after the last fragment counts).
+The recording is random noise in chunks of 0.1 s, like the client sends them. Peak memory is the increase of the
+resident set size and needs Linux with glibc. Run from the `voice_note` directory:
+
+    python -m benchmarks.stt_preprocessing --seconds 5 30 120
+"""
+import argparse
+import statistics
+
+import numpy as np
+import torch
+from torchaudio.transforms import Resample
+
+from benchmarks.memory import map_large_buffers, measure
+from server.utils.audio import AudioConfig
+from server.utils.sample import Sample
+
+CHUNK_SECONDS = 0.1
+
+
+def old_audio_data(fragments: list[bytes], audio_config: AudioConfig) -> torch.Tensor:
+    """ `Sample.audio_data` before the resampler was cached and fragments were converted block by block. """
+    resampler = Resample(audio_config.rate, 16_000)
+    data = torch.asarray(b''.join(fragments), dtype=torch.int16).float()
+    data /= 32768.
+    return resampler(data)
+
+
+def cached_audio_data(fragments: list[bytes], audio_config: AudioConfig) -> torch.Tensor:
+    return Sample(fragments=fragments, audio_config=audio_config).audio_data
+
+
+def streaming_audio_data(sample: Sample) -> torch.Tensor:
+    return sample.audio_data
+
+
+def streaming_sample(fragments: list[bytes], audio_config: AudioConfig) -> Sample:
+    sample = Sample(fragments=[], audio_config=audio_config)
+    for fragment in fragments:
+        sample.add_fragment(fragment)
+    if sample.resampling is not None:
+        sample.resampling.result()  # The blocks are resampled in the background while the recording arrives.
+    return sample
+
+
+def main(args: argparse.Namespace) -> None:
+    map_large_buffers()
+    torch.set_num_threads(args.threads)
+    audio_config = AudioConfig(format=8, channels=1, rate=args.rate)
+    rng = np.random.default_rng(0)
+    chunk_size = int(CHUNK_SECONDS * args.rate)
+    for seconds in args.seconds:
+        audio = (rng.standard_normal(int(seconds * args.rate)) * 3000).astype(np.int16)
+        fragments = [audio[start:start + chunk_size].tobytes() for start in range(0, len(audio), chunk_size)]
+
+        for name, fn in [('old', old_audio_data), ('cached', cached_audio_data), ('streaming', streaming_audio_data)]:
+            results = []
+            for _ in range(args.repeats):
+                fn_args = (streaming_sample(fragments, audio_config),) if name == 'streaming' else (fragments,
+                                                                                                    audio_config)
+                results.append(measure(fn, *fn_args))
+            times, peaks = zip(*results)
+            print(f'{seconds:5.0f} s at {args.rate} Hz, {name:9}: {statistics.median(times) * 1e3:7.2f} ms, '
+                  f'peak memory +{statistics.median(peaks):6.1f} MB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, nargs='+', default=[5., 30., 120.], help='Lengths of the recordings.')
+    parser.add_argument('--rate', type=int, default=48_000, help='Sample rate of the recordings.')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1, help='Torch threads, like one transcription thread.')
+    main(parser.parse_args())
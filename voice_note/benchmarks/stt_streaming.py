@@ -0,0 +1,65 @@
+""" Time from `FINISHED` to transcript for batch and streaming (windowed) transcription.
+
+Needs the Whisper model in `models/whisper-medium` and a 16 bit mono WAV recording. The recording is fed in real time
+(or `--speed` times faster) in chunks like the client would send them. Run from the `voice_note` directory:
+
+    python -m benchmarks.stt_streaming recording.wav
+"""
+import argparse
+import asyncio
+import time
+import wave
+
+from server.stt.stt import Transcription
+from server.utils.audio import AudioConfig
+from server.utils.incremental_transcription import IncrementalTranscription
+from server.utils.sample import Sample
+
+CHUNK_SECONDS = 0.1
+
+
+def load_wav(path: str) -> tuple[bytes, AudioConfig]:
+    with wave.open(path, 'rb') as wf:
+        assert wf.getsampwidth() == 2 and wf.getnchannels() == 1, 'Expected 16 bit mono audio.'
+        return wf.readframes(wf.getnframes()), AudioConfig(format=8, channels=1, rate=wf.getframerate())
+
+
+async def bench_batch(transcription: Transcription, audio_bytes: bytes, audio_config: AudioConfig) -> float:
+    start = time.perf_counter()
+    await transcription.run(Sample(fragments=[audio_bytes], audio_config=audio_config))
+    return time.perf_counter() - start
+
+
+async def bench_streaming(transcription: Transcription, audio_bytes: bytes, audio_config: AudioConfig,
+                          speed: float) -> float:
+    incremental = IncrementalTranscription(
+        'bench', audio_config.rate,
+        lambda window: transcription.run(Sample(fragments=[window], audio_config=audio_config))
+    )
+    chunk_size = int(CHUNK_SECONDS * audio_config.rate) * 2
+    for offset in range(0, len(audio_bytes), chunk_size):
+        incremental.add_audio(audio_bytes[offset:offset + chunk_size])
+        await asyncio.sleep(CHUNK_SECONDS / speed)
+
+    start = time.perf_counter()
+    await incremental.finish()
+    return time.perf_counter() - start
+
+
+async def main(args: argparse.Namespace) -> None:
+    audio_bytes, audio_config = load_wav(args.wav)
+    transcription = Transcription()
+    await bench_batch(transcription, audio_bytes[:audio_config.bytes_per_second], audio_config)  # Warmup.
+
+    duration = len(audio_bytes) / audio_config.bytes_per_second
+    print(f'Recording: {duration:.1f} s')
+    print(f'Batch:     {await bench_batch(transcription, audio_bytes, audio_config):.3f} s from FINISHED to transcript')
+    streaming = await bench_streaming(transcription, audio_bytes, audio_config, args.speed)
+    print(f'Streaming: {streaming:.3f} s from FINISHED to transcript')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('wav')
+    parser.add_argument('--speed', type=float, default=1., help='Playback speed relative to real time.')
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,62 @@
+""" Transcription time and text with and without trimming the silence around speech (`STT_VAD`).
+
+Needs the Whisper model in `models/whisper-medium` and 16 bit mono WAV recordings. Each recording is transcribed as it
+is and with `--pad` seconds of silence added before and after it (like a push-to-talk button that is pressed early and
+released late). A recording of silence only shows the time saved by dropping it. Also reports the time the VAD itself
+takes. Run from the `voice_note` directory:
+
+    python -m benchmarks.stt_vad recording1.wav recording2.wav
+"""
+import argparse
+import statistics
+import time
+
+from benchmarks.stt_streaming import load_wav
+from server.stt.stt import LANG, Transcription
+from server.utils.audio import AudioConfig
+from server.utils.sample import SAMPLE_RATE, Sample
+from server.utils.vad import speech_bounds
+
+
+def transcribe(transcription: Transcription, audio_bytes: bytes, audio_config: AudioConfig,
+               vad: bool) -> tuple[float, str]:
+    sample = Sample(fragments=[audio_bytes], audio_config=audio_config)
+    _ = sample.audio_data  # Preprocessing is not part of the comparison.
+    start = time.perf_counter()
+    Sample.transcribe_batch([sample], transcription.model, transcription.processor, LANG, vad)
+    return time.perf_counter() - start, sample.result
+
+
+def bench(transcription: Transcription, name: str, audio_bytes: bytes, audio_config: AudioConfig,
+          repeats: int) -> None:
+    duration = len(audio_bytes) / audio_config.bytes_per_second
+    for vad in (False, True):
+        runs = [transcribe(transcription, audio_bytes, audio_config, vad) for _ in range(repeats)]
+        seconds = statistics.median(run[0] for run in runs)
+        print(f'{name} ({duration:.1f} s), VAD {"on " if vad else "off"}: {seconds:.3f} s, {runs[0][1]!r}')
+
+
+def main(args: argparse.Namespace) -> None:
+    transcription = Transcription()
+    for path in args.wavs:
+        audio_bytes, audio_config = load_wav(path)
+        silence = bytes(int(args.pad * audio_config.rate) * 2)
+        transcribe(transcription, audio_bytes, audio_config, False)  # Warmup
+
+        samples = Sample(fragments=[audio_bytes], audio_config=audio_config).audio_data.numpy()
+        start = time.perf_counter()
+        speech_bounds(samples, SAMPLE_RATE)
+        print(f'VAD of {path}: {(time.perf_counter() - start) * 1e3:.2f} ms')
+
+        bench(transcription, path, audio_bytes, audio_config, args.repeats)
+        bench(transcription, f'{path} + {args.pad:.0f} s silence', silence + audio_bytes + silence, audio_config,
+              args.repeats)
+        bench(transcription, 'silence', silence + silence, audio_config, args.repeats)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('wavs', nargs='+')
+    parser.add_argument('--pad', type=float, default=3., help='Seconds of silence added before and after the speech.')
+    parser.add_argument('--repeats', type=int, default=3)
+    main(parser.parse_args())
@@ -0,0 +1,119 @@
+""" How the TTS server splits streamed chat responses into chunks for the model.
+
+Replays chat responses delta by delta on a simulated clock, like the chat server streams them to the TTS server, and
+compares the old policy (pass the text on as soon as it has two words, even if the last one is cut in the middle) with
+the sentence-aware `TextChunker`. Reports the time to the first chunk (the earliest the model can start speaking), the
+number of chunks per response (one `prepare_script` call each), the words per chunk and the share of chunks that end at
+a sentence or clause boundary or cut a word in two. The responses are synthesized from sample texts split into
+token-sized deltas, or read with `--traces` from a JSONL file with one response per line, e.g.
+`{"deltas": [[0.0, "Hello"], [0.04, " there"], [0.09, "!"]]}` (seconds since the first delta). Run from the
+`voice_note` directory:
+
+    python -m benchmarks.text_chunking --tokens-per-second 30
+"""
+import argparse
+import json
+import re
+import statistics
+from typing import Callable, Iterable, List, Tuple
+
+from server.utils import text_chunking
+from server.utils.text_chunking import TextChunker
+
+TEXTS = [
+    'Sure! The capital of Australia is Canberra, not Sydney as many people think. It was chosen as a compromise between '
+    'Sydney and Melbourne in 1908.',
+    'Here is a quick recipe.\n1. Preheat the oven to 180 degrees.\n2. Mix the flour, sugar and eggs.\n3. Bake for 25 '
+    'minutes, e.g. until golden.',
+    'Dr. Smith said the U.S. economy grew 3.5 percent in 2024. That is, roughly speaking, more than most analysts '
+    'expected at the start of the year; however, it was not enough to offset the losses of the previous two years.',
+    'Hmm, let me think about that for a second. I would say the second option is better, because it is cheaper and '
+    'easier to maintain in the long run.',
+]
+_BOUNDARY = re.compile(r'[.!?…,;:—–]["\'”’)\]*_]*$')
+
+Trace = List[Tuple[float, str]]
+
+
+def synthesize(text: str, tokens_per_second: float) -> Trace:
+    """ Split `text` into token-sized deltas (about four characters, sometimes within words). """
+    pieces = re.findall(r'\s*\S{1,4}', text)
+    return [(idx / tokens_per_second, piece) for idx, piece in enumerate(pieces)]
+
+
+def old_policy(trace: Trace) -> List[Tuple[float, str]]:
+    chunks, received = [], ''
+    for idx, (t, delta) in enumerate(trace):
+        received += delta
+        if len(received.split()) >= 2 or idx == len(trace) - 1:
+            chunks.append((t, received))
+            received = ''
+    return chunks
+
+
+def sentence_policy(trace: Trace, min_words: int, max_words: int, deadline: float,
+                    stall_deadline: float) -> List[Tuple[float, str]]:
+    now = 0.
+    chunker = TextChunker(min_words, max_words, deadline, stall_deadline, clock=lambda: now)
+    chunks = []
+    for idx, (t, delta) in enumerate(trace):
+        # Poll at the deadline, like the TTS server does while it waits for text.
+        while (wait := chunker.time_until_deadline()) is not None and now + wait < t:
+            now += wait + 1e-9  # Without the epsilon, rounding may leave the deadline just ahead.
+            chunks += [(now, chunk) for chunk in chunker.poll()]
+        now = t
+        chunks += [(now, chunk) for chunk in chunker.add(delta)]
+        if idx == len(trace) - 1:
+            chunks += [(now, chunk) for chunk in chunker.flush()]
+    return chunks
+
+
+def summarize(name: str, traces: List[Trace], policy: Callable[[Trace], List[Tuple[float, str]]]) -> None:
+    first, counts, words, boundaries, cuts = [], [], [], 0, 0
+    for trace in traces:
+        text = ''.join(delta for _, delta in trace)
+        word_ends = [match.end() for match in re.finditer(r'\S+', text)]
+        chunks = policy(trace)
+        first.append(chunks[0][0] - trace[0][0])
+        counts.append(len(chunks))
+        position = 0
+        for _, chunk in chunks:
+            words.append(len(chunk.split()))
+            boundaries += bool(_BOUNDARY.search(chunk.strip()))
+            # Chunks of the old policy are raw text, those of `TextChunker` whole words joined by spaces.
+            position = position + len(chunk) if policy is old_policy else word_ends[len(words) - 1 - sum(counts[:-1])]
+            cuts += position < len(text) and not text[position - 1].isspace() and not text[position].isspace()
+
+    n_chunks = sum(counts)
+    print(f'{name:>16}: first chunk after {statistics.mean(first) * 1e3:6.1f} ms, '
+          f'{statistics.mean(counts):5.1f} chunks per response, {statistics.mean(words):5.1f} words per chunk, '
+          f'{boundaries / n_chunks * 100:5.1f} % end at a boundary, {cuts / n_chunks * 100:5.1f} % cut a word')
+
+
+def load_traces(path: str) -> Iterable[Trace]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield [(t, delta) for t, delta in json.loads(line)['deltas']]
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.traces:
+        traces = list(load_traces(args.traces))
+    else:
+        traces = [synthesize(text, args.tokens_per_second) for text in TEXTS]
+    print(f'{len(traces)} responses, {sum(len(trace) for trace in traces)} deltas')
+    summarize('old (>= 2 words)', traces, old_policy)
+    summarize('sentence-aware', traces,
+              lambda trace: sentence_policy(trace, args.min_words, args.max_words, args.deadline, args.stall_deadline))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--traces', help='JSONL file with recorded responses, see above.')
+    parser.add_argument('--tokens-per-second', type=float, default=30., help='Speed of the synthesized responses.')
+    parser.add_argument('--min-words', type=int, default=text_chunking.MIN_WORDS)
+    parser.add_argument('--max-words', type=int, default=text_chunking.MAX_WORDS)
+    parser.add_argument('--deadline', type=float, default=text_chunking.DEADLINE, help='Seconds.')
+    parser.add_argument('--stall-deadline', type=float, default=text_chunking.STALL_DEADLINE, help='Seconds.')
+    main(parser.parse_args())
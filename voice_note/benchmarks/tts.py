@@ -0,0 +1,157 @@
+""" Time to first audio, reset latency, event loop lag and idle CPU usage of the TTS server.
+
+Starts a `TTSServer` in this process (needs the Kyutai TTS model in `models/`), streams a text to it word by word like
+the chat server does, and measures the time from the first text chunk to the first audio chunk and to the end of the
+audio. Meanwhile a task that sleeps in short intervals measures how late the event loop wakes it up, i.e. how long
+model steps block sending and receiving. With `--sessions`, several clients speak at the same time, to see how much the
+batched generation adds to the time per utterance.
+
+Then a reply that starts with a cached phrase (`--phrase`, one of `TTS_CACHED_PHRASES`) is sent, to compare its time to
+first audio with the generated replies. Next, the first client interrupts utterances as soon as their audio starts; the time from the reset to the
+first frame and to the first audible (non-silent) frame of the next utterance is measured, as well as when its speech
+starts on a client that plays every frame it receives, silent ones included. Finally the clients stay connected without
+sending anything and the CPU time used meanwhile is reported. Run from the `voice_note` directory:
+
+    python -m benchmarks.tts --sessions 4
+"""
+import argparse
+import asyncio
+import contextlib
+import statistics
+import time
+
+import websockets
+
+from server.tts.tts import TTSServer
+from server.utils.message import BINARY_SUBPROTOCOL
+from server.utils.streaming_connection import StreamingConnection
+
+HOST = '127.0.0.1'
+LAG_INTERVAL = 0.005  # Seconds
+TEXT = 'Hello! It is nice to hear from you again. What would you like to talk about today?'
+
+
+async def bench_utterance(connection: StreamingConnection, id_: str, text: str,
+                          word_interval: float) -> tuple[float, float]:
+    start = time.perf_counter()
+    for word in text.split():
+        connection.send({'status': 'GENERATING', 'text': word + ' ', 'id': id_})
+        await asyncio.sleep(word_interval)
+    connection.send({'status': 'FINISHED', 'text': '', 'id': id_})
+
+    first_audio = None
+    while True:
+        for msg in connection.recv():
+            if first_audio is None and msg.get('audio'):
+                first_audio = time.perf_counter() - start
+            if msg['status'] == 'FINISHED':
+                return first_audio, time.perf_counter() - start
+        await connection.wait_readable()
+
+
+async def bench_reset(connection: StreamingConnection, id_: str, text: str,
+                      word_interval: float) -> tuple[float, float, float]:
+    connection.reset(id_)
+    connection.send({'status': 'GENERATING', 'text': text, 'id': id_})
+    connection.send({'status': 'FINISHED', 'text': '', 'id': id_})
+    while not any(msg.get('audio') for msg in connection.recv()):
+        await connection.wait_readable()
+
+    next_id = f'{id_}-next'
+    connection.reset(next_id)
+    start = time.perf_counter()
+    for word in text.split():
+        connection.send({'status': 'GENERATING', 'text': word + ' ', 'id': next_id})
+        await asyncio.sleep(word_interval)
+    connection.send({'status': 'FINISHED', 'text': '', 'id': next_id})
+
+    first_frame = first_audible = config = None
+    silence = 0.  # Seconds of silent frames before the first audible one.
+    while True:
+        for msg in connection.recv():
+            config = msg.get('config', config)  # Only sent with the first audio.
+            if msg.get('audio'):
+                first_frame = first_frame or time.perf_counter() - start
+                if first_audible is None and any(msg['audio']):
+                    first_audible = time.perf_counter() - start
+                elif first_audible is None:
+                    silence += len(msg['audio']) / 4 / config['rate']  # Float32 samples.
+            if msg['status'] == 'FINISHED':
+                return first_frame, first_audible, max(first_audible, first_frame + silence)
+        await connection.wait_readable()
+
+
+async def monitor_loop_lag(lags: list[float]) -> None:
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(time.perf_counter() - start - LAG_INTERVAL)
+
+
+async def main(args: argparse.Namespace) -> None:
+    server = TTSServer(HOST, args.port)
+    await server.warmup()
+    server_task = asyncio.create_task(server.serve_forever())
+    await asyncio.sleep(0.5)
+
+    connections = [
+        StreamingConnection(
+            f'bench_tts_{idx}',
+            await websockets.connect(f'ws://{HOST}:{args.port}', subprotocols=[BINARY_SUBPROTOCOL])
+        )
+        for idx in range(args.sessions)
+    ]
+    run_tasks = [asyncio.create_task(connection.run()) for connection in connections]
+    lags = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lags))
+    try:
+        first_audio, total = [], []
+        start = time.perf_counter()
+        for idx in range(args.runs):
+            results = await asyncio.gather(*[
+                bench_utterance(connection, f'bench-{idx}', TEXT, args.word_interval) for connection in connections
+            ])
+            first_audio += [first for first, _ in results]
+            total += [end for _, end in results]
+        elapsed = time.perf_counter() - start
+        lag_task.cancel()
+        print(f'Time to first audio: mean {statistics.mean(first_audio) * 1e3:7.1f} ms, '
+              f'min {min(first_audio) * 1e3:7.1f} ms over {args.runs} runs of {args.sessions} sessions')
+        print(f'Time to end of audio: mean {statistics.mean(total):.2f} s, '
+              f'{len(total) / elapsed:.2f} utterances/s')
+        print(f'Event loop lag during generation: mean {statistics.mean(lags) * 1e3:.1f} ms, '
+              f'max {max(lags) * 1e3:.1f} ms')
+
+        cached, _ = await bench_utterance(connections[0], 'bench-phrase', f'{args.phrase} {TEXT}', args.word_interval)
+        print(f'Time to first audio of a reply that starts with a cached phrase: {cached * 1e3:.1f} ms '
+              f'({server.phrase_cache.summary()})')
+
+        results = [
+            await bench_reset(connections[0], f'bench-reset-{idx}', TEXT, args.word_interval) for idx in range(args.runs)
+        ]
+        first_frame, first_audible, speech = (statistics.mean(values) * 1e3 for values in zip(*results))
+        print(f'Reset to first frame: mean {first_frame:7.1f} ms, to first audible frame: mean {first_audible:7.1f} ms, '
+              f'to the start of the speech when played: mean {speech:7.1f} ms')
+
+        start_cpu, start = time.process_time(), time.perf_counter()
+        await asyncio.sleep(args.idle_seconds)
+        cpu = (time.process_time() - start_cpu) / (time.perf_counter() - start)
+        print(f'Idle CPU usage with {args.sessions} connected clients: {cpu * 100:.1f} % of a core')
+    finally:
+        for connection in connections:
+            await connection.close()
+        for task in (lag_task, *run_tasks, server_task):
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=12397)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--sessions', type=int, default=1, help='Clients that speak at the same time.')
+    parser.add_argument('--word-interval', type=float, default=0.05, help='Seconds between the words of the text.')
+    parser.add_argument('--phrase', default='Let me think about that.', help='Cached phrase to start a reply with.')
+    parser.add_argument('--idle-seconds', type=float, default=5.)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,155 @@
+""" Per-message overhead of the TTS audio on its way to the client, with and without frame coalescing.
+
+A fake TTS server produces 80 ms Mimi frames of float32 audio at `--speed` times real time and sends them like
+`TTSServer` does, through a `FrameCoalescer` with the given target duration (0 sends every frame on its own). Two relays
+forward the messages like the chat and STT servers do, to a client that receives them. Reports the messages and bytes
+per second of audio, the CPU time of the whole process (producer, relays and client) per second of audio and the time
+from the first frame to its arrival at the client. Run from the `voice_note` directory:
+
+    python -m benchmarks.tts_coalescing --targets 0 0.32 0.64
+"""
+import argparse
+import asyncio
+import contextlib
+import statistics
+import time
+
+import numpy as np
+import websockets
+
+from server.tts.coalescing import FrameCoalescer
+from server.utils.audio_encoding import AudioEncoder, decoded_format
+from server.utils.message import BINARY_SUBPROTOCOL, select_subprotocol
+from server.utils.streaming_connection import StreamingConnection
+
+HOST = '127.0.0.1'
+RATE = 24_000
+FRAME_SIZE = 1920
+
+
+async def _run(connection: StreamingConnection, fn) -> None:
+    run_task = asyncio.create_task(connection.run())
+    try:
+        await fn()
+    except ConnectionError:
+        pass
+    finally:
+        run_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await run_task
+
+
+def frames_per_utterance(args: argparse.Namespace) -> int:
+    return int(args.seconds * RATE / FRAME_SIZE)
+
+
+def producer_handler(args: argparse.Namespace, target: float):
+    async def handler(websocket) -> None:
+        connection = StreamingConnection('bench_tts', websocket)
+
+        async def produce() -> None:
+            rng = np.random.default_rng(0)
+            frame_interval = FRAME_SIZE / RATE / args.speed
+            for idx in range(args.utterances):
+                encoder = AudioEncoder(args.encoding, RATE)
+                config = {'format': decoded_format(args.encoding), 'channels': 1, 'rate': RATE,
+                          'encoding': args.encoding}
+                coalescer = FrameCoalescer(RATE, target)
+
+                def send(batch: np.ndarray, first: bool = False) -> None:
+                    msg = {'audio': encoder.encode(batch), 'status': 'GENERATING', 'id': str(idx)}
+                    if first:
+                        msg |= {'config': config, 'sent': time.perf_counter()}
+                    connection.send(msg)
+
+                for _ in range(frames_per_utterance(args)):
+                    # Like the TTS server, wake up for the deadline of the coalescer while the next frame is generated.
+                    next_frame = time.perf_counter() + frame_interval
+                    while (now := time.perf_counter()) < next_frame:
+                        flush = coalescer.time_until_flush()
+                        await asyncio.sleep(next_frame - now if flush is None else min(next_frame - now, flush))
+                        if (batch := coalescer.poll()) is not None:
+                            send(batch)
+                    first = coalescer.start is None
+                    if (batch := coalescer.add((rng.standard_normal(FRAME_SIZE) * 0.1).astype(np.float32))) is not None:
+                        send(batch, first)
+                if (batch := coalescer.flush()) is not None:
+                    send(batch)
+                connection.send({'audio': b'', 'status': 'FINISHED', 'id': str(idx), 'config': config})
+            await connection.wait_readable()  # Until the relay disconnects.
+
+        await _run(connection, produce)
+    return handler
+
+
+def relay_handler(name: str, upstream_port: int):
+    async def handler(websocket) -> None:
+        connection = StreamingConnection(name, websocket)
+        upstream = StreamingConnection(f'{name}_upstream', await websockets.connect(
+            f'ws://{HOST}:{upstream_port}', subprotocols=[BINARY_SUBPROTOCOL]
+        ))
+
+        async def forward() -> None:
+            while not connection.closed:
+                for msg in upstream.recv():
+                    connection.send(msg | {'save_path': 'outputs/bench'})  # Like the STT server.
+                await upstream.wait_readable(timeout=0.1)  # Notice when the client is gone.
+
+        try:
+            await _run(upstream, lambda: _run(connection, forward))
+        finally:
+            await upstream.close()
+    return handler
+
+
+async def bench(args: argparse.Namespace, target: float) -> None:
+    async with contextlib.AsyncExitStack() as stack:
+        port = 0
+        for name, handler in [('tts', producer_handler(args, target)), ('chat', None), ('stt', None)]:
+            handler = handler or relay_handler(f'bench_{name}', port)
+            server = await stack.enter_async_context(
+                websockets.serve(handler, HOST, 0, select_subprotocol=select_subprotocol)
+            )
+            port = server.sockets[0].getsockname()[1]
+
+        client = StreamingConnection('bench_client', await websockets.connect(
+            f'ws://{HOST}:{port}', subprotocols=[BINARY_SUBPROTOCOL]
+        ))
+        n_messages = n_bytes = finished = 0
+        first_audio = []
+
+        async def receive() -> None:
+            nonlocal n_messages, n_bytes, finished
+            while finished < args.utterances:
+                await client.wait_readable()
+                for msg in client.recv():
+                    n_messages += 1
+                    n_bytes += len(msg['audio'])
+                    if 'sent' in msg:
+                        first_audio.append(time.perf_counter() - msg['sent'])
+                    finished += msg['status'] == 'FINISHED'
+
+        start = time.process_time()
+        await _run(client, receive)
+        cpu = time.process_time() - start
+        await client.close()
+
+    seconds = args.utterances * frames_per_utterance(args) * FRAME_SIZE / RATE
+    print(f'target {target:4.2f} s: {n_messages / seconds:5.1f} messages/s, {n_bytes / seconds / 1e3:5.1f} kB/s, '
+          f'CPU {cpu / seconds * 1e3:5.1f} ms per second of audio, '
+          f'first audio after {statistics.mean(first_audio) * 1e3:4.1f} ms')
+
+
+async def main(args: argparse.Namespace) -> None:
+    for target in args.targets:
+        await bench(args, target)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--targets', type=float, nargs='+', default=[0., 0.32], help='Seconds per message.')
+    parser.add_argument('--speed', type=float, default=4., help='Speed of the producer relative to real time.')
+    parser.add_argument('--seconds', type=float, default=5., help='Seconds of audio per utterance.')
+    parser.add_argument('--utterances', type=int, default=4)
+    parser.add_argument('--encoding', default='f32', choices=['f32', 'pcm16', 'mulaw'])
+    asyncio.run(main(parser.parse_args()))
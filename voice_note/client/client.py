@@ -1,15 +1,20 @@
 import asyncio
+import os
 import pyaudio
 import FreeSimpleGUI as sg
 from uuid import uuid4
-import websockets
 from functools import lru_cache
 from server.utils.audio import audio
+from server.utils.audio_encoding import AudioDecoder, preferred_encodings
+from server.utils.connection_pool import connect_with_backoff
+from server.utils.message import BINARY_SUBPROTOCOL
 from server.utils.streaming_connection import StreamingConnection, POLL_INTERVAL
 
 INPUT_DEVICE_INDEX = None
 AUDIO_FORMAT = pyaudio.paInt16  # https://en.wikipedia.org/wiki/Audio_bit_depth
 NUM_CHANNELS = 1  # Number of audio channels
+# Accept the lossy 8-bit mu-law for the TTS audio (a quarter of the size of float32), if Opus is not available.
+MULAW = os.getenv('CLIENT_MULAW', '0') == '1'
 
 
 async def start_recording(connection, input_device_index, values):
@@ -17,13 +22,14 @@ async def start_recording(connection, input_device_index, values):
     connection.reset(id_)
     connection.send({
         'audio_config': get_audio_config(input_device_index),
+        'audio_encodings': preferred_encodings(MULAW),  # For the TTS audio, in order of preference.
         'id': id_,
         'status': 'INITIALIZING'
     })
 
     def _callback(in_data, *args):
         try:
-            connection.send({'audio': in_data, 'id': id_, 'status': 'RECORDING'})
+            connection.send_threadsafe({'audio': in_data, 'id': id_, 'status': 'RECORDING'})
             return None, pyaudio.paContinue
         except BrokenPipeError:
             return None, pyaudio.paComplete
@@ -95,20 +101,17 @@ def recv_messages(connection, text_messages, audio_messages):
             text_messages.append(msg)
         elif 'audio' in msg:
             audio_messages.append(msg)
+        elif msg['status'] == 'END_OF_SPEECH':
+            pass  # The server already ended the recording, it is stopped when REC is released.
         else:
             assert msg['status'] == 'INITIALIZING', 'Unknown message type.'
 
 
 async def main(window):
     uri = 'ws://localhost:12345'
-    while True:
-        try:
-            websocket = await websockets.connect(uri)
-            window['REC'].update(disabled=False)
-            print("Connected.")
-            break
-        except ConnectionRefusedError:
-            await asyncio.sleep(POLL_INTERVAL)
+    websocket = await connect_with_backoff(uri, [BINARY_SUBPROTOCOL])
+    window['REC'].update(disabled=False)
+    print("Connected.")
 
     stream = StreamingConnection("client", websocket)
     await asyncio.gather(stream.run(), ui(window, stream))
@@ -116,7 +119,7 @@ async def main(window):
 
 async def ui(window, com_stream):
     text_messages, audio_messages = [], []
-    rec_stream = playback_stream = save_path = None
+    rec_stream = playback_stream = save_path = decoder = playback_config = None
 
     while True:
         event, values = window.read(timeout=0)
@@ -129,6 +132,7 @@ async def ui(window, com_stream):
         if event == 'REC' and window['status'].get() == 'STOPPED':
             playback_stream = stop_playback(playback_stream)
             text_messages, audio_messages = [], []
+            decoder = playback_config = None
             rec_stream = await start_recording(com_stream, INPUT_DEVICE_INDEX, values)
             window['status'].update('RECORDING')
             window['message'].update('')
@@ -146,8 +150,12 @@ async def ui(window, com_stream):
             # .is_stopped returns False even if .is_active is False.
             if audio_messages and (playback_stream is None or not playback_stream.is_active()):
                 stop_playback(playback_stream)
-                playback_stream = start_playback(audio_messages[0]['config'],
-                                                 b''.join([msg['audio'] for msg in audio_messages]))
+                # Only the first audio message of a response carries the config.
+                playback_config = audio_messages[0].get('config', playback_config)
+                # Decodes all audio of the response, in order.
+                decoder = decoder or AudioDecoder.from_config(playback_config)
+                playback_stream = start_playback(playback_config,
+                                                 b''.join([decoder.decode(msg['audio']) for msg in audio_messages]))
                 audio_messages = []
         elif event in ['Delete', 'New Conversation']:
             if event != 'Wrong':
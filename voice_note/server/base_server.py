@@ -1,74 +1,206 @@
 import asyncio
-import threading
-import websockets
+import logging
+import os
+from contextvars import ContextVar
 from websockets.asyncio.server import ServerConnection, serve
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple, Union
 
-from server.utils.streaming_connection import POLL_INTERVAL, StreamingConnection, StreamReset
-from server.utils.message import Message
+from server.utils.connection_pool import MultiplexedConnectionPool, connect_with_backoff
+from server.utils.multiplexing import MUX_SUBPROTOCOL, ChannelConnection, MultiplexedConnection
+from server.utils.streaming_connection import StreamingConnection, StreamInterrupted, StreamReset
+from server.utils.message import BINARY_SUBPROTOCOL, Message, select_subprotocol
 
+logger = logging.getLogger(__name__)
 
-class ThreadExecutor:
-    def __init__(self):
-        self.cancel_event = threading.Event()
+# Carry all sessions to a downstream server over one WebSocket connection (if the downstream server supports it).
+MULTIPLEX = os.getenv('MULTIPLEX', '1') == '1'
 
-    async def run(self, *fn_args) -> Any:
-        self.cancel_event.clear()
+
+class BatchingThreadExecutor:
+    """ Collects concurrent calls to `run` into batches and runs `blocking_fn` once per batch in a thread.
+
+    A batch is started as soon as `max_batch_size` items are pending, or `max_wait` seconds after the first item arrived.
+    Every caller gets back the result for its own item, so items from different sessions can share a batch.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending: List[Tuple[Any, asyncio.Future]] = []
+        self.pending_event = asyncio.Event()
+        self.worker: Optional[asyncio.Task] = None
+
+    async def run(self, item: Any) -> Any:
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._process_batches())
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        self.pending_event.set()
         try:
-            result = await asyncio.to_thread(self.blocking_fn, *fn_args)
-            return result
+            return await future
         except asyncio.CancelledError:
-            self.cancel_event.set()
+            # Nothing to do if the batch is already running, its result for this item is just discarded.
+            self.pending = [entry for entry in self.pending if entry[1] is not future]
+            raise
 
-    def blocking_fn(self) -> Any:
+    async def _process_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.pending:
+                self.pending_event.clear()
+                await self.pending_event.wait()
+
+            # Give other requests the chance to join the batch.
+            deadline = loop.time() + self.max_wait
+            while len(self.pending) < self.max_batch_size and (remaining := deadline - loop.time()) > 0:
+                self.pending_event.clear()
+                try:
+                    await asyncio.wait_for(self.pending_event.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+
+            batch, self.pending = self.pending[:self.max_batch_size], self.pending[self.max_batch_size:]
+            batch = [entry for entry in batch if not entry[1].done()]
+            if not batch:
+                continue
+
+            try:
+                results = await asyncio.to_thread(self.blocking_fn, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def blocking_fn(self, items: List[Any]) -> List[Any]:
         raise NotImplementedError
 
 
+class Session:
+    """ State of one client connection: its streams to the client and to the downstream servers.
+
+    Servers that need more per-client state (e.g. a conversation) subclass this and override `BaseServer._create_session`.
+    """
+
+    def __init__(self, client_connection: Union[ServerConnection, ChannelConnection]):
+        self.client_connection = client_connection
+        self.streams: Dict[str, StreamingConnection] = {}
+
+
+# Every connection is handled in its own task (and the tasks it spawns), so a context variable gives each of them their
+# own session, while the server code can keep using `self.session` and `self.streams`.
+_current_session: ContextVar[Session] = ContextVar('session')
+
+
 class BaseServer:
     def __init__(self, name: str, host: str, port: int):
         self.name = name
         self.host = host
         self.port = port
         self.connections = {}  # Connection URIs to other servers.
-        self.streams = {}
+        self.sessions: Set[Session] = set()
+        self.multiplex = MULTIPLEX
+        self.pool = MultiplexedConnectionPool()  # Shared connections to other servers.
+
+    @property
+    def session(self) -> Session:
+        """ The session of the client connection that is handled by the current task. """
+        return _current_session.get()
+
+    @property
+    def streams(self) -> Dict[str, StreamingConnection]:
+        return self.session.streams
 
     async def serve_forever(self) -> None:
-        async with serve(self.handle_connection, self.host, self.port):
-            await asyncio.Future()
+        if self.multiplex:
+            # Connect to the other servers right away, so the first client does not have to wait for it.
+            for uri in self.connections.values():
+                self.pool.warm_up(uri)
+        try:
+            async with serve(self.handle_connection, self.host, self.port, select_subprotocol=self._select_subprotocol):
+                await asyncio.Future()
+        finally:
+            await self.pool.close()
+
+    @staticmethod
+    def _select_subprotocol(connection: ServerConnection, subprotocols: Sequence[str]) -> Optional[str]:
+        if MUX_SUBPROTOCOL in subprotocols:
+            return MUX_SUBPROTOCOL
+        return select_subprotocol(connection, subprotocols)
 
     async def handle_connection(self, client_connection: ServerConnection) -> None:
+        if client_connection.subprotocol == MUX_SUBPROTOCOL:
+            await self._handle_multiplexed_connection(client_connection)
+        else:
+            await self._handle_session(client_connection)
+
+    async def _handle_multiplexed_connection(self, connection: ServerConnection) -> None:
+        """ Handle every channel of a multiplexed connection from an upstream server as its own session. """
+        print(f"Multiplexed connection from {connection.remote_address}")
+        session_tasks: Set[asyncio.Task] = set()
+
+        def on_channel(channel: ChannelConnection) -> None:
+            task = asyncio.create_task(self._handle_channel_session(channel))
+            session_tasks.add(task)
+            task.add_done_callback(session_tasks.discard)
+
+        await MultiplexedConnection(connection, on_channel).run()
+        # All channels are closed now, so the sessions end on their own.
+        await asyncio.gather(*session_tasks, return_exceptions=True)
+
+    async def _handle_channel_session(self, channel: ChannelConnection) -> None:
+        try:
+            await self._handle_session(channel)
+        except Exception:
+            # Do not let one failing session take down the other sessions on the connection.
+            logger.exception(f"Session on channel {channel.channel_id} failed")
+
+    async def _handle_session(self, client_connection: Union[ServerConnection, ChannelConnection]) -> None:
         print(f"Connection from {client_connection.remote_address}")
-        for stream in self.streams.values():
-            await stream.close()
-
-        self.streams = {}
-        for key, uri in self.connections.items():
-            self.streams[key] = await self.setup_connection(key, uri)
-        self.streams['client'] = StreamingConnection(f"{self.name}_client", client_connection)
-
-        tasks = self._create_tasks()
-        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-        first_exception = next((task.exception() for task in done if task.exception() is not None), None)
-        StreamingConnection.cancel_tasks(pending)
-        for task in pending:
-            try:
-                await task
-            except asyncio.CancelledError:
-                pass
-        for stream in self.streams.values():
-            await stream.close()
-        self.streams = {}
+        session = self._create_session(client_connection)
+        _current_session.set(session)
+        self.sessions.add(session)
+        try:
+            for key, uri in self.connections.items():
+                self.streams[key] = await self.setup_connection(key, uri)
+            self.streams['client'] = StreamingConnection(f"{self.name}_client", client_connection)
+
+            tasks = self._create_tasks()
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            first_exception = next((task.exception() for task in done if task.exception() is not None), None)
+            StreamingConnection.cancel_tasks(pending)
+            for task in pending:
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        finally:
+            for stream in self.streams.values():
+                await stream.close()
+            self.sessions.discard(session)
+            await self._close_session(session)
         if first_exception is not None:
             raise first_exception
 
+    def _create_session(self, client_connection: Union[ServerConnection, ChannelConnection]) -> Session:
+        return Session(client_connection)
+
+    async def _close_session(self, session: Session) -> None:
+        """ Release resources of a session after its connection ended. """
+        pass
+
     async def setup_connection(self, connection_name: str, uri: str) -> StreamingConnection:
-        while True:
-            try:
-                connection = await websockets.connect(uri)
-                break
-            except OSError:
-                await asyncio.sleep(POLL_INTERVAL)
-        return StreamingConnection(f"{self.name}_{connection_name}", connection)
+        name = f"{self.name}_{connection_name}"
+        channel = await self.pool.open_channel(uri) if self.multiplex else None
+        if channel is None:
+            # Multiplexing is disabled or not supported by the other server, use a connection per session.
+            return StreamingConnection(name, await connect_with_backoff(uri, [BINARY_SUBPROTOCOL]))
+        return StreamingConnection(name, channel)
 
     def _create_tasks(self) -> List[asyncio.Task]:
         streaming_tasks = [asyncio.create_task(stream.run(), name=key) for key, stream in self.streams.items()]
@@ -88,14 +220,13 @@ class BaseServer:
 
                 cutoff = self._get_cutoff_idx(received)
                 if cutoff > 0:
-                    # Reset other streams with new id.
-                    [stream.reset(received[0]['id']) for key, stream in self.streams.items() if key != 'client']
+                    self._reset_streams(received[0]['id'])
 
                     workload = asyncio.create_task(self._run_workload(received[:cutoff]))
                     await workload
                     received = received[cutoff:]
                 else:
-                    await asyncio.sleep(POLL_INTERVAL)
+                    await self.streams['client'].wait_readable()
             except StreamReset as e:
                 # Only triggered when the current server tries to send something via a resetting connection. This could
                 # also be just forwarding of messages from another server, which would trigger the reset command to be
@@ -104,9 +235,26 @@ class BaseServer:
                 received = []
                 if workload is not None and not workload.done():
                     workload.cancel()
+            except StreamInterrupted as e:
+                # A downstream server was restarted while it worked on the request. Its response is lost, but the
+                # session goes on with the next request.
+                print(f"{e} ({received[0]['id']}).")
+                try:
+                    self.streams['client'].send(self._interrupted_response(received[0]['id']))
+                except StreamReset:
+                    pass  # The client already moved on.
+                received = received[cutoff:]
             except ConnectionError:
                 break
 
+    def _reset_streams(self, id_: str) -> None:
+        """ Reset the streams to other servers with the id of a new workload. """
+        [stream.reset(id_) for key, stream in self.streams.items() if key != 'client']
+
+    def _interrupted_response(self, id_: str) -> Message.DataDict:
+        """ The message that ends the response to the workload with `id_` for the client, after it was interrupted. """
+        return {'id': id_, 'text': '', 'status': 'FINISHED'}
+
     def _recv_client_messages(self) -> List[Message.DataDict]:
         return self.streams['client'].recv()
 
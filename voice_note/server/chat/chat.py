@@ -6,13 +6,14 @@ import shlex
 import shutil
 from collections import deque
 from pathlib import Path
-from typing import AsyncIterator, List, Union
+from typing import AsyncIterator, Coroutine, Dict, List, Optional, Set, Union
 from uuid import uuid4
+from websockets.asyncio.server import ServerConnection
 
-from server.base_server import BaseServer
+from server.base_server import BaseServer, Session
 from server.utils.misc import BASE_DIR
 from server.utils.message import Message
-from server.utils.streaming_connection import POLL_INTERVAL, StreamReset
+from server.utils.streaming_connection import StreamInterrupted, StreamReset
 
 
 logger = logging.getLogger(__name__)
@@ -23,6 +24,12 @@ PI_AGENT_DIR = Path(os.getenv('PI_CODING_AGENT_DIR', BASE_DIR / 'pi-agent'))
 LLAMACPP_BASE_URL = os.getenv('LLAMACPP_BASE_URL')
 SERVER_DIR = BASE_DIR / 'server'
 LOCAL_PI_COMMAND = SERVER_DIR / 'node_modules' / '.bin' / 'pi'
+# Pi processes that are kept started, with a fresh session, for new clients and conversations. 0 starts Pi on the first
+# prompt and resets its session in place for a new conversation.
+PI_POOL_SIZE = int(os.getenv('CHAT_PI_POOL_SIZE', '1'))
+# After an abort, the next prompt or new session waits this long at most for Pi to stop the aborted prompt, then Pi is
+# restarted.
+ABORT_TIMEOUT = 5.  # Seconds
 
 READ_ONLY_TOOLS = 'read,grep,find,ls,set_thinking'
 CODING_TOOLS = 'read,write,edit,bash,grep,find,ls,set_thinking'
@@ -65,13 +72,26 @@ def _get_pi_command(tools: str = 'read-only') -> List[str]:
 
 
 class PiRpcClient:
+    """ Talks to a Pi process in RPC mode.
+
+    A background task reads all of Pi's output: responses go to the command that waits for them, other events to the
+    running prompt. Events of an aborted prompt are dropped, so `abort` neither has to wait for the prompt nor read its
+    remaining events.
+    """
+
     def __init__(self, command: List[str], cwd: str):
         self.command = command
         self.cwd = cwd
         self.process: asyncio.subprocess.Process | None = None
         self.stderr_task: asyncio.Task | None = None
+        self.stdout_task: asyncio.Task | None = None
         self.stderr_lines: deque[str] = deque(maxlen=50)
-        self.lock = asyncio.Lock()
+        self.lock = asyncio.Lock()  # Prompts and new sessions are started one after another.
+        self.responses: Dict[str, asyncio.Future] = {}  # By command id
+        # Events of the running prompt, followed by `None` if it is aborted or the exception the process failed with.
+        self.events: asyncio.Queue[Union[dict, Exception, None]] | None = None
+        self.idle = asyncio.Event()  # Cleared while Pi works on a prompt.
+        self.idle.set()
 
     async def start(self) -> None:
         if self.process is not None and self.process.returncode is None:
@@ -97,6 +117,9 @@ class PiRpcClient:
                 'install npx, or set PI_COMMAND to the Pi executable.'
             ) from exc
         self.stderr_task = asyncio.create_task(self._collect_stderr())
+        self.responses = {}
+        self.idle.set()
+        self.stdout_task = asyncio.create_task(self._dispatch_events(self.responses))
 
     async def close(self) -> None:
         if self.process is None:
@@ -110,15 +133,17 @@ class PiRpcClient:
                 self.process.kill()
                 await self.process.wait()
 
-        if self.stderr_task is not None:
-            self.stderr_task.cancel()
+        for task in (self.stderr_task, self.stdout_task):
+            if task is None:
+                continue
+            task.cancel()
             try:
-                await self.stderr_task
+                await task
             except asyncio.CancelledError:
                 pass
 
         self.process = None
-        self.stderr_task = None
+        self.stderr_task = self.stdout_task = None
 
     async def _collect_stderr(self) -> None:
         assert self.process is not None and self.process.stderr is not None
@@ -131,57 +156,111 @@ class PiRpcClient:
             logger.info('pi stderr: %s', decoded)
 
     async def new_session(self) -> None:
-        await self._send_command_and_wait({'type': 'new_session'})
+        async with self.lock:
+            await self._wait_until_idle()
+            await self._send_command_and_wait({'type': 'new_session'})
 
     async def abort(self) -> None:
-        await self._send_command_and_wait({'type': 'abort'})
+        """ Abort the running prompt without waiting for it. Its generator ends, its remaining events are dropped and
+        the next prompt is sent once Pi stopped. """
+        if self.events is not None:
+            self.events.put_nowait(None)
+            self.events = None
+        if self.process is None or self.process.returncode is not None or self.idle.is_set():
+            return
+        await self._write_command({'type': 'abort'})  # The response is dropped.
 
     async def prompt(self, message: str) -> AsyncIterator[dict]:
         async with self.lock:
-            command_id = await self._send_command({'type': 'prompt', 'message': message})
-            prompt_accepted = False
-            while True:
-                event = await self._read_event()
+            await self._wait_until_idle()
+            events = self.events = asyncio.Queue()
+            self.idle.clear()
+            response = await self._send_command({'type': 'prompt', 'message': message})
 
-                if event.get('type') == 'response' and event.get('id') == command_id:
-                    if not event.get('success'):
-                        raise RuntimeError(event.get('error', 'Pi rejected the prompt.'))
-                    prompt_accepted = True
-                    continue
-
-                await self._handle_extension_ui_request(event)
+        try:
+            result = await response
+            if not result.get('success'):
+                self.idle.set()
+                raise RuntimeError(result.get('error', 'Pi rejected the prompt.'))
+
+            while (event := await events.get()) is not None:
+                if isinstance(event, Exception):
+                    raise event
                 yield event
-
                 if event.get('type') == 'agent_end':
                     return
+        finally:
+            if self.events is events:
+                self.events = None
 
-                if event.get('type') == 'message_update':
-                    assistant_event = event.get('assistantMessageEvent', {})
-                    if assistant_event.get('type') == 'error':
-                        reason = assistant_event.get('reason', 'error')
-                        if not prompt_accepted:
-                            raise RuntimeError(f'Pi prompt failed before acceptance: {reason}')
+    async def _wait_until_idle(self) -> None:
+        """ Pi only takes the next command once it stopped the previous prompt, e.g. after an abort. A Pi that does not
+        stop in time is restarted: its late events could not be told apart from those of the next prompt. """
+        await self.start()
+        try:
+            await asyncio.wait_for(self.idle.wait(), ABORT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning('Pi did not stop the previous prompt within %s s, restarting it', ABORT_TIMEOUT)
+            await self.close()
+            await self.start()
 
     async def _send_command_and_wait(self, command: dict) -> dict:
-        async with self.lock:
-            command_id = await self._send_command(command)
-            while True:
-                event = await self._read_event()
-                await self._handle_extension_ui_request(event)
-                if event.get('type') == 'response' and event.get('id') == command_id:
-                    if not event.get('success'):
-                        raise RuntimeError(event.get('error', f"Pi command failed: {command['type']}"))
-                    return event
+        response = await (await self._send_command(command))
+        if not response.get('success'):
+            raise RuntimeError(response.get('error', f"Pi command failed: {command['type']}"))
+        return response
 
-    async def _send_command(self, command: dict) -> str:
+    async def _send_command(self, command: dict) -> asyncio.Future:
+        """ Returns the future of Pi's response to `command`. """
         await self.start()
+        command_id = str(uuid4())
+        response = self.responses[command_id] = asyncio.get_running_loop().create_future()
+        await self._write_command(command, command_id)
+        return response
+
+    async def _write_command(self, command: dict, command_id: Optional[str] = None) -> None:
         assert self.process is not None and self.process.stdin is not None
 
-        command_id = str(uuid4())
-        command = {'id': command_id, **command}
+        command = {'id': command_id or str(uuid4()), **command}
         self.process.stdin.write((json.dumps(command) + '\n').encode('utf-8'))
         await self.process.stdin.drain()
-        return command_id
+
+    async def _dispatch_events(self, responses: Dict[str, asyncio.Future]) -> None:
+        """ Reads Pi's output until the process ends. `responses` are the ones waited for from this process. """
+        error: Exception = RuntimeError('Pi RPC process was closed.')
+        try:
+            while True:
+                try:
+                    event = await self._read_event()
+                except RuntimeError as exc:
+                    if self.process.returncode is not None:
+                        raise
+                    # Invalid JSON, only the running prompt fails.
+                    if self.events is not None:
+                        self.events.put_nowait(exc)
+                    continue
+                await self._handle_extension_ui_request(event)
+                if event.get('type') == 'response':
+                    response = responses.pop(event.get('id'), None)
+                    if response is not None and not response.done():
+                        response.set_result(event)
+                    continue
+
+                if event.get('type') == 'agent_end':
+                    self.idle.set()
+                if self.events is not None:
+                    self.events.put_nowait(event)
+        except RuntimeError as exc:
+            error = exc
+        finally:
+            for response in responses.values():
+                if not response.done():
+                    response.set_exception(error)
+            responses.clear()
+            if self.responses is responses:  # Not restarted yet.
+                if self.events is not None:
+                    self.events.put_nowait(error)
+                self.idle.set()
 
     async def _read_event(self) -> dict:
         assert self.process is not None and self.process.stdout is not None
@@ -214,23 +293,153 @@ class PiRpcClient:
         await self.process.stdin.drain()
 
 
+class PiProcessPool:
+    """ Keeps `size` Pi processes started and in a fresh session, so a new client or conversation does not have to
+    wait for Node to start or for the session to be reset.
+
+    Taking a process from the pool starts a replacement in the background. A process whose conversation ended is
+    recycled in the background: its session is reset and it goes back to the pool, or it is closed if the pool is full.
+    """
+
+    def __init__(self, command: List[str], cwd: str, size: int = PI_POOL_SIZE):
+        self.command = command
+        self.cwd = cwd
+        self.size = size
+        self.ready: List[PiRpcClient] = []
+        self.starting = 0
+        self.tasks: Set[asyncio.Task] = set()
+
+    def warm_up(self) -> None:
+        """ Start processes in the background until `size` of them are ready (or on their way). """
+        while len(self.ready) + self.starting < self.size:
+            self.starting += 1
+            self._run_in_background(self._start_process())
+
+    def take(self) -> PiRpcClient:
+        """ A ready process if there is one, otherwise one that starts with its first command. """
+        pi = self.ready.pop(0) if self.ready else PiRpcClient(self.command, self.cwd)
+        self.warm_up()
+        return pi
+
+    def recycle(self, pi: PiRpcClient) -> None:
+        self._run_in_background(self._recycle(pi))
+
+    async def close(self) -> None:
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await asyncio.gather(*(pi.close() for pi in self.ready))
+        self.ready = []
+
+    async def _start_process(self) -> None:
+        try:
+            await self._prepare(PiRpcClient(self.command, self.cwd))
+        finally:
+            self.starting -= 1
+
+    async def _recycle(self, pi: PiRpcClient) -> None:
+        if pi.process is None or pi.process.returncode is not None or len(self.ready) >= self.size:
+            await pi.close()
+        else:
+            await self._prepare(pi)
+
+    async def _prepare(self, pi: PiRpcClient) -> None:
+        """ Put `pi` into a fresh session (which also waits for a new process to be up) and into the pool. """
+        try:
+            await pi.new_session()
+        except asyncio.CancelledError:
+            await pi.close()
+            raise
+        except Exception:
+            logger.exception('Could not prepare a Pi process')
+            await pi.close()
+            return
+        await self._add(pi)
+
+    async def _add(self, pi: PiRpcClient) -> None:
+        if len(self.ready) < self.size:
+            self.ready.append(pi)
+        else:
+            await pi.close()
+
+    def _run_in_background(self, coroutine: Coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+class PiResponse:
+    """ A prompt that runs in the background, its events are queued until they are streamed to the client. So a
+    speculative prompt can be started before it is known whether its response is needed. """
+
+    def __init__(self, request_id: str):
+        self.id = request_id
+        # Pi's events, followed by `None` at the end of the response or the exception it failed with.
+        self.events: asyncio.Queue[Union[dict, Exception, None]] = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    async def cancel(self) -> None:
+        """ Stop the prompt, which aborts it in Pi. """
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+
+class ChatSession(Session):
+    def __init__(self, client_connection: ServerConnection, pi: PiRpcClient):
+        super().__init__(client_connection)
+        self.pi = pi
+        self.new_session_requested = False
+        self.response: Optional[PiResponse] = None
+        # Text of the current utterance that Pi already got with speculative prompts whose responses were discarded.
+        self.speculated_text = ''
+        # The audio encodings the client can play, for the TTS server. The TTS server reads them at the start of an
+        # utterance, so they are only sent with the first message of a request (the one of `tts_request_id`).
+        self.audio_encodings: Optional[List[str]] = None
+        self.tts_request_id: Optional[str] = None
+
+
 class ChatServer(BaseServer):
 
     def __init__(self, host: str, port: int, tts_uri: Union[str, None] = None):
         super().__init__('chat', host, port)
         _write_pi_models_config()
-        self.pi = PiRpcClient(_get_pi_command(), CHAT_AGENT_CWD)
-        self.new_session_requested = False
+        self.pi_command = _get_pi_command()
         logger.info('Pi agent: model=%s, cwd=%s', PI_MODEL, CHAT_AGENT_CWD)
+        self.pi_pool = PiProcessPool(self.pi_command, CHAT_AGENT_CWD)
 
         if tts_uri is not None:
             self.connections = {'tts': tts_uri}
 
+    @property
+    def pi(self) -> PiRpcClient:
+        return self.session.pi
+
+    async def serve_forever(self) -> None:
+        # Start Pi right away, so the first client does not have to wait for it.
+        self.pi_pool.warm_up()
+        try:
+            await super().serve_forever()
+        finally:
+            await self.pi_pool.close()
+
+    def _create_session(self, client_connection: ServerConnection) -> ChatSession:
+        # Every session gets its own Pi process, so concurrent conversations do not share context.
+        return ChatSession(client_connection, self.pi_pool.take())
+
+    async def _close_session(self, session: ChatSession) -> None:
+        if session.response is not None:
+            await session.response.cancel()
+        self.pi_pool.recycle(session.pi)
+
     def _recv_client_messages(self) -> List[Message.DataDict]:
         text_messages = []
         for msg in super()._recv_client_messages():
             if msg.get('action') == 'NEW CONVERSATION':
-                self.new_session_requested = True
+                self.session.new_session_requested = True
             else:
                 text_messages.append(msg)
         return text_messages
@@ -240,18 +449,85 @@ class ChatServer(BaseServer):
 
     async def _run_workload(self, received: List[Message.DataDict]) -> None:
         request_id = received[0]['id']
-        user_text = received[0]['text']
+        if received[0].get('audio_encodings') is not None:
+            self.session.audio_encodings = received[0]['audio_encodings']
+        if received[0].get('status') == 'CONFIRMED':
+            await self._confirm_response(request_id)
+            return
 
+        user_text = received[0]['text']
+        speculative = received[0].get('status') == 'SPECULATIVE'
         display_text = user_text[:100] + '...' if len(user_text) > 100 else user_text
-        logger.info('[%s] Prompt: %s', request_id[:8], display_text)
+        logger.info('[%s] %s: %s', request_id[:8], 'Speculative prompt' if speculative else 'Prompt', display_text)
 
+        # Pi runs one prompt at a time, a speculative one that was not confirmed is not needed anymore.
+        await self._discard_response()
+        response = PiResponse(request_id)
+        response.task = asyncio.create_task(self._prompt(response, user_text, speculative))
+        self.session.response = response
+        if not speculative:
+            await self._stream_response(response)
+
+    async def _prompt(self, response: PiResponse, user_text: str, speculative: bool) -> None:
         try:
-            if self.new_session_requested:
-                await self.pi.new_session()
-                self.new_session_requested = False
+            if self.session.new_session_requested:
+                await self._new_pi_session()
+                self.session.new_session_requested = False
+                self.session.speculated_text = ''
+
+            accepted = False
+            async for event in self.pi.prompt(self._unsent_text(user_text)):
+                if not accepted:
+                    accepted = True
+                    # Pi keeps the text of the prompt, even if its response is discarded.
+                    self.session.speculated_text = user_text if speculative else ''
+                response.events.put_nowait(event)
+            response.events.put_nowait(None)
+        except asyncio.CancelledError:
+            await self.pi.abort()
+            raise
+        except Exception as e:
+            response.events.put_nowait(e)
+
+    async def _new_pi_session(self) -> None:
+        if self.pi_pool.size > 0:
+            # Switch to a process that is already in a fresh session, the old one is reset in the background.
+            self.pi_pool.recycle(self.session.pi)
+            self.session.pi = self.pi_pool.take()
+        else:
+            await self.pi.new_session()
+
+    def _unsent_text(self, user_text: str) -> str:
+        """ Pi already got the beginning of the utterance with speculative prompts whose responses were discarded (the
+        user went on talking), only the rest of it is sent. """
+        speculated = self.session.speculated_text
+        if speculated and len(user_text) > len(speculated) and user_text.startswith(speculated):
+            return user_text[len(speculated):].strip()
+        return user_text
+
+    async def _confirm_response(self, request_id: str) -> None:
+        response = self.session.response
+        if response is None or response.id != request_id:
+            logger.warning('[%s] Confirmed response does not exist', request_id[:8])
+            self._send_text(request_id, 'Sorry, I ran into an error.', 'GENERATING')
+            await self._finish_response(request_id)
+            return
 
+        logger.info('[%s] Speculative prompt confirmed', request_id[:8])
+        self.session.speculated_text = ''
+        await self._stream_response(response)
+
+    async def _stream_response(self, response: PiResponse) -> None:
+        request_id = response.id
+        try:
             chars = 0
-            async for event in self.pi.prompt(user_text):
+            while (event := await response.events.get()) is not None:
+                if isinstance(event, Exception):
+                    logger.error('[%s] Error', request_id[:8], exc_info=event)
+                    self._send_text(request_id, 'Sorry, I ran into an error.', 'GENERATING')
+                    await self._finish_response(request_id)
+                    return
+
                 stream_text = self._extract_text_delta(event)
                 if stream_text:
                     self._send_text(request_id, stream_text, 'GENERATING')
@@ -263,16 +539,17 @@ class ChatServer(BaseServer):
             await self._finish_response(request_id)
             logger.info('[%s] Complete: %s chars', request_id[:8], chars)
         except asyncio.CancelledError:
-            await self.pi.abort()
+            await response.cancel()
             raise
-        except StreamReset:
-            await self.pi.abort()
+        except (StreamReset, StreamInterrupted):
+            await response.cancel()
             logger.info('[%s] Aborted', request_id[:8])
             raise
-        except Exception:
-            logger.exception('[%s] Error', request_id[:8])
-            self._send_text(request_id, 'Sorry, I ran into an error.', 'GENERATING')
-            await self._finish_response(request_id)
+
+    async def _discard_response(self) -> None:
+        response, self.session.response = self.session.response, None
+        if response is not None:
+            await response.cancel()
 
     @staticmethod
     def _extract_text_delta(event: dict) -> str:
@@ -288,22 +565,30 @@ class ChatServer(BaseServer):
     def _send_text(self, request_id: str, text: str, status: str) -> None:
         self.streams['client'].send({'status': 'GENERATING', 'text': text, 'id': request_id})
         if 'tts' in self.streams:
-            self.streams['tts'].send({'status': status, 'text': text, 'id': request_id})
+            self._send_to_tts({'status': status, 'text': text, 'id': request_id})
+
+    def _send_to_tts(self, msg: Message.DataDict) -> None:
+        if self.session.tts_request_id != msg['id']:
+            self.session.tts_request_id = msg['id']
+            if self.session.audio_encodings is not None:
+                msg['audio_encodings'] = self.session.audio_encodings
+        self.streams['tts'].send(msg)
 
     async def _finish_response(self, request_id: str) -> None:
         if 'tts' not in self.streams:
             self.streams['client'].send({'status': 'FINISHED', 'text': '', 'id': request_id})
             return
 
-        self.streams['tts'].send({'status': 'FINISHED', 'text': '', 'id': request_id})
+        self._send_to_tts({'status': 'FINISHED', 'text': '', 'id': request_id})
         waiting_for_tts = True
         while waiting_for_tts:
             for msg in self.streams['tts'].recv():
                 self.streams['client'].send(msg)
                 if msg.get('status') == 'FINISHED':
                     waiting_for_tts = False
-            await asyncio.sleep(POLL_INTERVAL)
-            if self.streams['tts'].closed and self.streams['tts'].received_q.empty():
+            if waiting_for_tts:
+                await self.streams['tts'].wait_readable()
+            if self.streams['tts'].closed and not self.streams['tts'].received_q:
                 break
 
     def _forward_tts_messages(self) -> None:
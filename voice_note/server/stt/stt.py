@@ -2,17 +2,22 @@ import asyncio
 import os
 import torch
 from pathlib import Path
-from typing import List, Union
+from typing import List, Optional, Union
+from uuid import uuid4
 from transformers import WhisperForConditionalGeneration, WhisperProcessor
 
-from server.base_server import BaseServer, ThreadExecutor
+from server.base_server import BaseServer, BatchingThreadExecutor, Session
 from websockets.asyncio.server import ServerConnection
 from server.utils.audio import AudioConfig
+from server.utils.audio_buffer import AudioBuffer
+from server.utils.audio_encoding import AudioDecoder
 from server.utils.conversation import Conversation
+from server.utils.incremental_transcription import IncrementalTranscription
 from server.utils.message import Message
+from server.utils.persistence import PersistenceWriter
 from server.utils.misc import BASE_DIR
 from server.utils.sample import Sample
-from server.utils.streaming_connection import POLL_INTERVAL
+from server.utils.vad import EndOfSpeechDetector
 
 SAVE_DIR = BASE_DIR / 'outputs'
 MODEL_DIR = BASE_DIR / 'models/whisper-medium'
@@ -21,47 +26,102 @@ LANG = 'en'
 DEVICE, DTYPE = ('cuda:0', torch.float16) if torch.cuda.is_available() else ('cpu', torch.float32)
 
 CHAT_URI = os.getenv('CHAT_URI', 'ws://localhost:12346')
+# Transcribe windows of the recording while it is still ongoing, instead of everything after `FINISHED`.
+STREAMING = os.getenv('STT_STREAMING', '1') == '1'
+# Transcription requests of concurrent sessions are batched into one `generate` call.
+MAX_BATCH_SIZE = int(os.getenv('STT_MAX_BATCH_SIZE', '8'))
+MAX_BATCH_WAIT = float(os.getenv('STT_MAX_BATCH_WAIT', '0.01'))  # Seconds
+# Capacity of the buffer for the audio of a recording. Only the part that is filled takes up memory, longer recordings
+# make it grow (which copies the audio once).
+RECORDING_BUFFER_SECONDS = 600.
+# Trim the silence around speech before transcribing it and drop recordings without speech.
+VAD = os.getenv('STT_VAD', '1') == '1'
+# End a recording after this many seconds of silence following speech, without waiting for the client's `FINISHED`.
+END_OF_SPEECH = float(os.getenv('STT_END_OF_SPEECH', '0'))  # Seconds, 0 disables it.
+# With streaming transcription, send the transcript so far to the chat server after a pause of this many seconds, so it
+# can start on the response before the recording is finished. The response is only used if the transcript does not
+# change anymore.
+SPECULATION_PAUSE = float(os.getenv('STT_SPECULATION_PAUSE', '0'))  # Seconds, 0 disables it.
 
 
-class Transcription(ThreadExecutor):
-    def __init__(self):
-        super().__init__()
+class Transcription(BatchingThreadExecutor):
+    def __init__(self, max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_BATCH_WAIT):
+        super().__init__(max_batch_size, max_wait)
         self.processor = WhisperProcessor.from_pretrained(MODEL_DIR, local_files_only=True)
         self.model = WhisperForConditionalGeneration.from_pretrained(
             MODEL_DIR, use_safetensors=True, local_files_only=True, torch_dtype=DTYPE
         )
         self.model.to(DEVICE)
 
-    def blocking_fn(self, sample: Sample) -> str:
-        sample.transcribe(self.model, self.processor, LANG)
-        return sample.result
+    def blocking_fn(self, samples: List[Sample]) -> List[str]:
+        Sample.transcribe_batch(samples, self.model, self.processor, LANG, VAD)
+        return [sample.result for sample in samples]
+
+
+class STTSession(Session):
+    def __init__(self, client_connection: ServerConnection, persistence: PersistenceWriter):
+        super().__init__(client_connection)
+        self.conversation = Conversation(persistence)
+        self.incremental: Optional[IncrementalTranscription] = None
+        # The audio of the recording with id `recording_id`. Without streaming transcription, it is also resampled into
+        # `sample` while it arrives.
+        self.recording: Optional[AudioBuffer] = None
+        self.recording_id: Optional[str] = None
+        self.sample: Optional[Sample] = None
+        self.audio_encodings: Optional[List[str]] = None
+        # Also notices the pauses for speculative chat requests.
+        self.end_of_speech: Optional[EndOfSpeechDetector] = None
+        # Id of the last recording that was ended at the end of speech, the client's remaining messages for it are
+        # dropped.
+        self.ended_id: Optional[str] = None
+        # Transcribes the recording up to the last pause and sends it to the chat server as a speculative request.
+        self.speculation: Optional[asyncio.Task] = None
+        self.speculative_request: Optional[Message.DataDict] = None  # The last one sent for the current recording.
+        self.paused = False  # Whether the current pause was already used for a speculative request.
 
 
 class STTServer(BaseServer):
-    def __init__(self, host: str, port: int, chat_uri: Union[str, None] = None):
+    def __init__(self, host: str, port: int, chat_uri: Union[str, None] = None, streaming: bool = STREAMING):
         super().__init__("stt", host, port)
+        # Shared by all sessions, so their transcriptions can be batched.
         self.transcription = Transcription()
-        self.conversation: Conversation = None
+        self.streaming = streaming
+        self.speculative = SPECULATION_PAUSE > 0 and chat_uri is not None
+        # Saves the conversations of all sessions in a background thread.
+        self.persistence = PersistenceWriter()
 
         if chat_uri is not None:
             self.connections = {'chat': chat_uri}
 
-    def _new_conversation(self) -> None:
-        self.conversation = Conversation()
+    def _create_session(self, client_connection: ServerConnection) -> STTSession:
+        return STTSession(client_connection, self.persistence)
+
+    async def serve_forever(self) -> None:
+        try:
+            await super().serve_forever()
+        finally:
+            # Make sure everything the sessions wrote reaches the disk.
+            await asyncio.to_thread(self.persistence.close)
 
-    async def handle_connection(self, client_connection: ServerConnection) -> None:
-        if self.conversation is None:
-            # Do not start a new conversation for each new connection.
-            self._new_conversation()
-        await super().handle_connection(client_connection)
+    async def _close_session(self, session: STTSession) -> None:
+        if session.incremental is not None:
+            session.incremental.cancel()
+        if session.speculation is not None:
+            session.speculation.cancel()
+        session.conversation.close()
+
+    def _new_conversation(self) -> None:
+        self.session.conversation.close()
+        self.session.conversation = Conversation(self.persistence)
 
     def _recv_client_messages(self) -> List[Message.DataDict]:
         audio_messages = []
         for msg in super()._recv_client_messages():
             action = msg.get('action')
             if action == 'DELETE CONVERSATION':
-                self.delete_entry(msg['save_path'])
                 self._new_conversation()
+                # Deleted by the writer thread, after the pending writes of the closed conversation.
+                self.persistence.submit(self.delete_entry, msg['save_path'])
                 if 'chat' in self.streams:
                     self.streams['chat'].reset(msg['id'])
                     msg_for_chat = msg.copy()
@@ -72,10 +132,91 @@ class STTServer(BaseServer):
                 if 'chat' in self.streams:
                     self.streams['chat'].reset(msg['id'])
                     self.streams['chat'].send(msg)
+            elif msg['id'] == self.session.ended_id:
+                continue
             else:
+                self._ingest_audio(msg)
                 audio_messages.append(msg)
         return audio_messages
 
+    def _ingest_audio(self, msg: Message.DataDict) -> None:
+        """ Moves the audio of `msg` into the buffer of its recording, which is shared (without copies) by the
+        transcription and the conversation. """
+        if msg['status'] == 'INITIALIZING':
+            if self.session.incremental is not None:
+                self.session.incremental.cancel()
+                self.session.incremental = None
+            if self.session.speculation is not None:
+                self.session.speculation.cancel()
+            self.session.speculation = self.session.speculative_request = None
+            self.session.paused = False
+            audio_config = AudioConfig(**msg['audio_config'])
+            recording = AudioBuffer(int(RECORDING_BUFFER_SECONDS * audio_config.bytes_per_second))
+            # Also kept with the message, so the workload finds it even if the next recording already started.
+            msg['recording'] = self.session.recording = recording
+            self.session.recording_id = msg['id']
+            self.session.audio_encodings = msg.get('audio_encodings')
+            if self.streaming:
+                self.session.incremental = IncrementalTranscription(
+                    msg['id'], audio_config.rate,
+                    lambda window: self.transcription.run(Sample(fragments=[window], audio_config=audio_config)),
+                    audio=recording
+                )
+            else:
+                msg['sample'] = self.session.sample = Sample(fragments=[], audio_config=audio_config)
+            if END_OF_SPEECH > 0 or (self.speculative and self.streaming):
+                self.session.end_of_speech = EndOfSpeechDetector(audio_config.rate, END_OF_SPEECH)
+        elif self.session.recording_id == msg['id'] and msg.get('audio'):
+            audio_bytes = msg.pop('audio')
+            if self.session.incremental is not None:
+                self.session.incremental.add_audio(audio_bytes)  # Appends it to the recording.
+            else:
+                self.session.recording.append(audio_bytes)
+                if self.session.sample is not None:
+                    self.session.sample.add_fragment(audio_bytes)
+            detector = self.session.end_of_speech
+            if detector is None:
+                return
+            ended = detector.add_audio(audio_bytes)
+            if self.session.incremental is not None and self.speculative:
+                self._speculate_at_pause(detector.silence_after_speech)
+            if ended and END_OF_SPEECH > 0:
+                # Handled like the client's `FINISHED`.
+                msg['status'] = 'FINISHED'
+                self.session.end_of_speech = None
+                self.session.ended_id = msg['id']
+                self.streams['client'].send({'status': 'END_OF_SPEECH', 'id': msg['id']})
+
+    def _speculate_at_pause(self, silence: float) -> None:
+        """ Start a speculative chat request once per pause of at least `SPECULATION_PAUSE` seconds. """
+        if silence < SPECULATION_PAUSE:
+            self.session.paused = False
+            return
+        if self.session.paused:
+            return
+        self.session.paused = True
+        if self.session.speculation is not None:
+            self.session.speculation.cancel()  # Its request would be outdated anyway.
+        self.session.speculation = asyncio.create_task(self._send_speculative_request(self.session.incremental))
+
+    async def _send_speculative_request(self, incremental: IncrementalTranscription) -> None:
+        # Splits the recording at the pause, so the text before it does not change anymore.
+        text = await incremental.transcribe_pending()
+        previous = self.session.speculative_request
+        if not text or (previous is not None and previous['text'] == text):
+            return
+        request = {'status': 'SPECULATIVE', 'text': text, 'id': f'{incremental.id}-{uuid4().hex[:8]}'}
+        if self.session.audio_encodings is not None:
+            request['audio_encodings'] = self.session.audio_encodings
+        # Discards the response to the previous speculative request.
+        self.streams['chat'].reset(request['id'])
+        self.streams['chat'].send(request)
+        self.session.speculative_request = request
+
+    def _reset_streams(self, id_: str) -> None:
+        # The chat stream is reset by the workload, unless it uses the response to a speculative request.
+        [stream.reset(id_) for key, stream in self.streams.items() if key not in ('client', 'chat')]
+
     def _get_cutoff_idx(self, received: List[Message.DataDict]) -> int:
         return next((idx for idx, msg in enumerate(received) if msg['status'] == 'FINISHED'), -1) + 1
 
@@ -83,23 +224,55 @@ class STTServer(BaseServer):
         assert messages[0]['status'] == 'INITIALIZING'
 
         audio_config = AudioConfig(**messages[0]['audio_config'])
-        audio_bytes = b''.join([msg.get('audio', b'') for msg in messages])
-        sample = Sample(fragments=[audio_bytes], audio_config=audio_config)
+        recording = messages[0]['recording']
+        speculation = None
+        if self.session.recording_id == messages[0]['id']:
+            self.session.recording = self.session.recording_id = self.session.sample = None
+            self.session.end_of_speech = None
+            speculation, self.session.speculation = self.session.speculation, None
+        incremental = self.session.incremental
+        if incremental is not None and incremental.id == messages[0]['id']:
+            self.session.incremental = None
+            transcription = await incremental.finish()
+        else:
+            # Without streaming transcription (or if it was interrupted), the whole recording is transcribed at once.
+            sample = messages[0].get('sample') or Sample(fragments=[recording.view()], audio_config=audio_config)
+            transcription = await self.transcription.run(sample)
 
-        transcription = await self.transcription.run(sample)
+        if not transcription:
+            # Nothing was said, there is nothing to respond to.
+            print(f"No speech in recording {messages[0]['id']}, dropped it.")
+            return
 
-        self.conversation.add_turn(
+        self.session.conversation.add_turn(
             user_text=transcription,
-            user_audio_bytes=sample.get_audio_bytes(),
+            user_audio_bytes=recording.view(),
             user_audio_config=audio_config,
         )
 
-        await self.get_chat_response(
-            {'text': transcription, 'id': messages[0]['id']}
-        )
+        transcription_result = {'text': transcription, 'id': messages[0]['id']}
+        if 'audio_encodings' in messages[0]:
+            # The encodings the client can play, passed on to the TTS server.
+            transcription_result['audio_encodings'] = messages[0]['audio_encodings']
+
+        speculative_id = None
+        if speculation is not None:
+            await asyncio.wait([speculation])  # Done right after the transcription.
+            request, self.session.speculative_request = self.session.speculative_request, None
+            if (request is not None and request['text'] == transcription
+                    and self.streams['chat'].communication_id == request['id']):
+                speculative_id = request['id']
+        if speculative_id is None:
+            self.streams['chat'].reset(messages[0]['id'])
+        await self.get_chat_response(transcription_result, speculative_id)
+
+    def _interrupted_response(self, id_: str) -> Message.DataDict:
+        return super()._interrupted_response(id_) | {'save_path': self.session.conversation.get_save_path()}
 
     @staticmethod
-    def delete_entry(save_path: str) -> None:
+    def delete_entry(save_path: Optional[str]) -> None:
+        if save_path is None:
+            return  # Nothing was saved yet.
         save_path = Path(save_path)
         if not save_path.exists():
             return
@@ -109,28 +282,39 @@ class STTServer(BaseServer):
         save_path.rmdir()
         print(f"Deleted {save_path}.")
 
-    async def get_chat_response(self, transcription_result: Message.DataDict) -> None:
-        self.streams['chat'].send(transcription_result)
+    async def get_chat_response(self, transcription_result: Message.DataDict,
+                                speculative_id: Optional[str] = None) -> None:
+        """ With `speculative_id`, the chat server already works on the response to the same text, it is only
+        confirmed. """
+        if speculative_id is None:
+            self.streams['chat'].send(transcription_result)
+        else:
+            self.streams['chat'].send({'status': 'CONFIRMED', 'id': speculative_id})
 
-        assistant_audio_config = None
+        assistant_audio_config = decoder = None
         try:
             while True:
                 for msg in self.streams['chat'].recv():
-                    self.streams['client'].send(msg | {'save_path': self.conversation.get_save_path()})
+                    self.streams['client'].send(msg | {'id': transcription_result['id'],
+                                                       'save_path': self.session.conversation.get_save_path()})
 
                     if 'config' in msg and not assistant_audio_config:
-                        assistant_audio_config = AudioConfig(**msg['config'])
+                        config = msg['config']
+                        assistant_audio_config = AudioConfig(config['format'], config['channels'], config['rate'])
+                        decoder = AudioDecoder.from_config(config)
 
-                    self.conversation.update_assistant_response(
+                    audio_chunk = msg.get('audio', b'')
+                    self.session.conversation.update_assistant_response(
                         text_chunk=msg.get('text', ''),
-                        audio_chunk=msg.get('audio', b''),
+                        audio_chunk=decoder.decode(audio_chunk) if audio_chunk and decoder else audio_chunk,
+                        audio_config=assistant_audio_config,
                     )
 
                     if msg.get("status") == "FINISHED":
                         return
-                await asyncio.sleep(POLL_INTERVAL)
+                await self.streams['chat'].wait_readable()
         finally:
-            self.conversation.finalize_assistant_audio(assistant_audio_config)
+            self.session.conversation.finalize_assistant_response()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+
+# Seconds of audio per message once the client has enough audio buffered.
+TARGET_DURATION = 0.32
+
+
+class FrameCoalescer:
+    """ Collects the PCM frames of one utterance into fewer, larger messages.
+
+    The first frame is released right away, so the time to first audio does not change. After that, frames are held
+    back until they add up to `target` seconds, but only while the client still has more than `target` seconds of audio
+    to play (estimated from the audio released so far and the time since the first frame). So the client never runs
+    dry because of the coalescing, even if frames are generated barely faster than real time.
+    """
+
+    def __init__(self, rate: int, target: float = TARGET_DURATION, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.target = target
+        self.clock = clock
+        self.pending: List[np.ndarray] = []
+        self.pending_samples = 0
+        self.released_samples = 0
+        self.start: Optional[float] = None  # When the first frame was released.
+
+    def add(self, pcm: np.ndarray) -> Optional[np.ndarray]:
+        """ Add a frame and return the audio to send now, if any. """
+        self.pending.append(pcm)
+        self.pending_samples += len(pcm)
+        if self.start is None or self.pending_samples >= self.target * self.rate:
+            return self.flush()
+        return self.poll()
+
+    def poll(self) -> Optional[np.ndarray]:
+        """ Return the pending audio if the client is about to run out of audio to play. """
+        if self.pending and self.time_until_flush() == 0:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[np.ndarray]:
+        """ Return all pending audio, e.g. at the end of the utterance. """
+        if not self.pending:
+            return None
+        if self.start is None:
+            self.start = self.clock()
+        pcm = np.concatenate(self.pending) if len(self.pending) > 1 else self.pending[0]
+        self.released_samples += self.pending_samples
+        self.pending, self.pending_samples = [], 0
+        return pcm
+
+    def time_until_flush(self) -> Optional[float]:
+        """ Seconds until `poll` releases the pending audio, `None` without pending audio. """
+        if not self.pending:
+            return None
+        if self.start is None:
+            return 0.
+        buffered = self.start + self.released_samples / self.rate - self.clock()
+        return max(0., buffered - self.target)
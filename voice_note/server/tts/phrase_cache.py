@@ -0,0 +1,129 @@
+import collections
+import hashlib
+import logging
+import re
+import unicodedata
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from server.utils.persistence import PersistenceWriter
+
+logger = logging.getLogger(__name__)
+
+MAX_BYTES = 64 * 2 ** 20
+_WORD = re.compile(r'\S+')
+
+
+def normalize(text: str) -> str:
+    """ Key for `text`: differences in case, whitespace and unicode forms do not change what is spoken. """
+    return ' '.join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+class PhraseCache:
+    """ LRU cache for the audio of fixed `phrases`, e.g. greetings, fillers and error messages.
+
+    Entries are the PCM chunks a phrase was streamed in, keyed on its normalized text and the voice. Only the given
+    phrases are cached, other text is hardly ever repeated word for word. A phrase is found at the start of an utterance
+    (see `get_leading`), so a filler followed by the actual answer is a hit, too. The cache holds at most `max_bytes` of
+    audio. With a `directory`, entries are also written there (in the writer thread of `writer`) and loaded again on
+    start, so phrases survive restarts.
+    """
+
+    def __init__(self, voice: str, phrases: Iterable[str] = (), max_bytes: int = MAX_BYTES,
+                 directory: Optional[Path] = None, writer: Optional[PersistenceWriter] = None):
+        self.voice = voice
+        self.phrases = {normalize(phrase) for phrase in phrases} - {''}
+        self.max_bytes = max_bytes
+        # Words of the longest phrase, longer text cannot be a phrase.
+        self.max_words = max((len(phrase.split()) for phrase in self.phrases), default=0)
+        self.directory = directory
+        self.entries: collections.OrderedDict[str, List[bytes]] = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            self.owns_writer = writer is None
+            self.writer = PersistenceWriter() if writer is None else writer
+            directory.mkdir(parents=True, exist_ok=True)
+            self._load()
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.
+
+    def may_complete(self, text: str) -> bool:
+        """ Whether `text` is the beginning of a cached phrase, i.e. more text could still turn it into a hit. """
+        key = normalize(text)
+        return bool(key) and any(cached.startswith(key) for cached in self.entries)
+
+    def get_leading(self, text: str, complete: bool = False) -> Optional[Tuple[List[bytes], str]]:
+        """ If `text` starts with a cached phrase, return its audio chunks and the rest of `text`, else `None`. The
+        longest phrase wins. The last word only counts once whitespace follows it, or with `complete` (at the end of the
+        text). Counts as a hit or miss. """
+        words = list(_WORD.finditer(text))
+        if words and not complete and words[-1].end() == len(text):
+            words.pop()  # More of the last word might still come.
+        for n_words in range(min(len(words), self.max_words), 0, -1):
+            key = normalize(text[:words[n_words - 1].end()])
+            if (frames := self.entries.get(key)) is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return frames, text[words[n_words - 1].end():]
+        self.misses += 1
+        return None
+
+    def put(self, text: str, frames: List[bytes]) -> None:
+        """ Cache the audio chunks of `text`, if it is one of the phrases. """
+        key = normalize(text)
+        if key not in self.phrases or key in self.entries:
+            return
+        if self._insert(key, frames) and self.directory is not None:
+            self.writer.submit(self._save, self._path(key), key, frames)
+
+    def summary(self) -> str:
+        return (f'{len(self.entries)} phrases, {self.nbytes / 2 ** 20:.1f} MB, '
+                f'hit rate {self.hit_rate * 100:.0f} % ({self.hits}/{self.hits + self.misses})')
+
+    def close(self) -> None:
+        if self.directory is not None and self.owns_writer:
+            self.writer.close()
+
+    def _insert(self, key: str, frames: List[bytes]) -> bool:
+        nbytes = sum(len(frame) for frame in frames)
+        if nbytes > self.max_bytes:
+            return False
+        while self.nbytes + nbytes > self.max_bytes:
+            evicted, evicted_frames = self.entries.popitem(last=False)
+            self.nbytes -= sum(len(frame) for frame in evicted_frames)
+            if self.directory is not None:
+                self.writer.submit(self._path(evicted).unlink, True)  # missing_ok
+        self.entries[key] = frames
+        self.nbytes += nbytes
+        return True
+
+    def _path(self, key: str) -> Path:
+        digest = hashlib.sha1(f'{self.voice}\0{key}'.encode()).hexdigest()
+        return self.directory / f'{digest}.npz'
+
+    def _save(self, path: Path, key: str, frames: List[bytes]) -> None:
+        with open(path, 'wb') as f:
+            np.savez(f, voice=np.array(self.voice), text=np.array(key),
+                     lengths=np.array([len(frame) for frame in frames]),
+                     audio=np.frombuffer(b''.join(frames), dtype=np.uint8))
+
+    def _load(self) -> None:
+        # Oldest first, so the most recently written entries are the last to be evicted.
+        for path in sorted(self.directory.glob('*.npz'), key=lambda path: path.stat().st_mtime):
+            try:
+                with np.load(path) as data:
+                    if str(data['voice']) != self.voice or str(data['text']) not in self.phrases:
+                        continue
+                    audio = data['audio'].tobytes()
+                    offsets = np.cumsum([0, *data['lengths']])
+                    frames = [audio[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+                    self._insert(str(data['text']), frames)
+            except Exception:
+                logger.exception(f'Loading cached phrase {path} failed.')
@@ -1,12 +1,23 @@
 import asyncio
+import os
+import queue
+import threading
+import time
 from moshi.models.loaders import CheckpointInfo
 from moshi.models.tts import ConditionAttributes, Entry, LMGen, TTSModel
 from pathlib import Path
+import numpy as np
 import torch
 import typing as tp
 
 from server.base_server import BaseServer
-from server.utils.streaming_connection import POLL_INTERVAL, StreamReset
+from server.tts import coalescing, phrase_cache
+from server.tts.coalescing import FrameCoalescer
+from server.tts.phrase_cache import PhraseCache
+from server.utils.audio_encoding import AudioEncoder, choose_encoding, decoded_format
+from server.utils.streaming_connection import StreamReset
+from server.utils import text_chunking
+from server.utils.text_chunking import TextChunker
 
 
 DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -14,65 +25,123 @@ if DEVICE == 'cuda':
     torch.backends.cudnn.benchmark = True
 MODEL_DIR = Path('./models/tts-1.6b-en_fr')
 VOICE_PATH = Path('./models/tts-voices/expresso/ex01-ex02_fast_001_channel2_73s.wav.1e68beda@240.safetensors')
+# Utterances of concurrent sessions are generated together, in one batch of this size.
+MAX_STREAMS = int(os.getenv('TTS_MAX_STREAMS', '4'))
+# Text is passed to the model in chunks that end at sentence boundaries (see `TextChunker`).
+CHUNK_MIN_WORDS = int(os.getenv('TTS_CHUNK_MIN_WORDS', text_chunking.MIN_WORDS))
+CHUNK_MAX_WORDS = int(os.getenv('TTS_CHUNK_MAX_WORDS', text_chunking.MAX_WORDS))
+CHUNK_DEADLINE = float(os.getenv('TTS_CHUNK_DEADLINE', text_chunking.DEADLINE))  # Seconds
+# Audio of fixed phrases (separated by `|`) is generated during the warmup and streamed right away when an utterance
+# starts with one of them (see `PhraseCache`).
+CACHED_PHRASES = os.getenv(
+    'TTS_CACHED_PHRASES', 'Sorry, I ran into an error.|Let me think about that.|One moment, please.'
+).split('|')
+PHRASE_CACHE_BYTES = int(float(os.getenv('TTS_PHRASE_CACHE_MB', phrase_cache.MAX_BYTES / 2 ** 20)) * 2 ** 20)
+PHRASE_CACHE_DIR = os.getenv('TTS_PHRASE_CACHE_DIR')
+# Audio frames are sent in messages of about this many seconds, once the client has enough audio to play.
+COALESCE_DURATION = float(os.getenv('TTS_COALESCE_DURATION', coalescing.TARGET_DURATION))
+
+
+class TTSStream:
+    """
+    One utterance that is synthesized by the `BatchedTTSGenerator`.
+
+    Keeps its own state machine and step counter, so several streams can share the batch of the model.
+    Text goes in through `BatchedTTSGenerator.add_text`, audio comes out through `get_audio_chunk`.
+    """
+
+    def __init__(self, tts_model: TTSModel):
+        # Written by the event loop, read by the inference thread.
+        self.text_queue: queue.Queue[Entry] = queue.Queue()
+        self.finished = False
+        self.cancelled = False
+        # Written by the inference thread, read by the event loop.
+        self.audio_queue: asyncio.Queue[tp.Optional[torch.Tensor]] = asyncio.Queue()
+
+        # Only accessed by the inference thread.
+        self.state = tts_model.machine.new_state([])
+        self.offset = 0
+        self.end_of_text = False  # `finished`, as seen by the inference thread after all text was added.
+        self.slot: tp.Optional[int] = None
+
+        # Only accessed by the event loop.
+        self.first_chunk_processed = False
+
+    async def get_audio_chunk(self) -> tp.Optional[torch.Tensor]:
+        """Retrieves the next available chunk of audio, `None` at the end of the utterance."""
+        return await self.audio_queue.get()
+
+    def has_work(self) -> bool:
+        # Without entries to process, a stream waits for more text unless it is finishing.
+        return bool(self.state.entries or self.state.queued or self.end_of_text)
 
 
-class AsyncTTSGenerator:
+class BatchedTTSGenerator:
     """
-    A class to handle TTS generation asynchronously.
+    A class to handle TTS generation of several concurrent utterances.
 
-    It manages the model state and runs the generation loop in a background task,
-    allowing for streaming of text input and audio output.
+    Every utterance is a `TTSStream` that occupies one slot of a model batch. The streams are stepped together by
+    `LMGen.step` in a dedicated inference thread; streams that wait for text are excluded with the exec mask, so they
+    keep their state. Streams are admitted and retired while the others keep generating. The state of a slot is reset
+    when its stream retires, so the next stream can start stepping in it right away.
     """
 
-    def __init__(self, tts_model: TTSModel, condition_attributes: ConditionAttributes):
+    def __init__(self, tts_model: TTSModel, condition_attributes: ConditionAttributes, max_streams: int):
         self.tts_model = tts_model
         self.condition_attributes = condition_attributes
         self.device = tts_model.lm.device
+        self.max_streams = max_streams
 
         # Condition tensors are constant for a fixed voice; compute once and reuse.
         assert tts_model.lm.condition_provider is not None
-        prepared = tts_model.lm.condition_provider.prepare([condition_attributes])
+        prepared = tts_model.lm.condition_provider.prepare([condition_attributes] * max_streams)
         self.condition_tensors = tts_model.lm.condition_provider(prepared)
 
-        # Queues for communication with the generation loop
-        self.text_queue: asyncio.Queue[tp.Optional[Entry]] = asyncio.Queue()
-        self.audio_queue: asyncio.Queue[tp.Optional[torch.Tensor]] = asyncio.Queue()
+        # Handed over to the inference thread, which wakes up on `wakeup` after each change.
+        self.admissions: queue.Queue[TTSStream] = queue.Queue()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.free_slots = asyncio.Semaphore(max_streams)
+        self.loop: tp.Optional[asyncio.AbstractEventLoop] = None
+        self.thread: tp.Optional[threading.Thread] = None
 
-        # State for the generation loop
-        self.lm_gen: tp.Optional[LMGen] = None
-        self.state: tp.Optional[tp.Any] = None
-        self.offset = 0
-        self.generation_task: tp.Optional[asyncio.Task] = None
-        self.finished = False
-        self.first_chunk_processed = False
+        # Only accessed by the inference thread.
+        self.slots: list[tp.Optional[TTSStream]] = [None] * max_streams
+        self.executing: list[bool] = [False] * max_streams
 
     def _on_text_hook(self, text_tokens: torch.Tensor):
-        """Hook to inject our text tokens into the generation process."""
-        predicted_token = text_tokens.item()
-        assert self.state is not None
-
-        # If we are out of entries but more text might be coming,
-        # prevent the model from ending the generation prematurely.
-        if not self.state.entries and not self.state.queued and not self.finished:
-            if predicted_token == self.tts_model.machine.token_ids.new_word:
-                predicted_token = self.tts_model.machine.token_ids.pad
-
-        output_token, consumed_new_word = self.tts_model.machine.process(self.offset, self.state, predicted_token)
-        if consumed_new_word:
-            word, step = self.state.transcript[-1]
-            print(f"Step {step}: Model consumed word -> '{word}'")
-        text_tokens[0] = output_token
+        """Hook to inject the text tokens of every stream into the generation process."""
+        machine = self.tts_model.machine
+        tokens = text_tokens.tolist()
+        for b, stream in enumerate(self.slots):
+            if stream is None or not self.executing[b]:
+                continue
+            predicted_token = tokens[b]
+            # If we are out of entries but more text might be coming,
+            # prevent the model from ending the generation prematurely.
+            if not stream.state.entries and not stream.state.queued and not stream.end_of_text:
+                if predicted_token == machine.token_ids.new_word:
+                    predicted_token = machine.token_ids.pad
+
+            tokens[b], consumed_new_word = machine.process(stream.offset, stream.state, predicted_token)
+            if consumed_new_word:
+                word, step = stream.state.transcript[-1]
+                print(f"Slot {b}, step {step}: Model consumed word -> '{word}'")
+        text_tokens[:] = torch.tensor(tokens, dtype=torch.long, device=text_tokens.device)
 
     def _on_audio_hook(self, audio_tokens: torch.Tensor):
-        """Hook to handle initial audio delay."""
+        """Hook to handle the initial audio delay of every stream."""
         lm = self.tts_model.lm
         machine = self.tts_model.machine
         audio_offset = lm.audio_offset
         delays = lm.delays
-        for q in range(audio_tokens.shape[1]):
-            delay = delays[q + audio_offset]
-            if self.offset < delay + self.tts_model.delay_steps:
-                audio_tokens[:, q] = machine.token_ids.zero
+        for b, stream in enumerate(self.slots):
+            if stream is None or not self.executing[b]:
+                continue
+            for q in range(audio_tokens.shape[1]):
+                delay = delays[q + audio_offset]
+                if stream.offset < delay + self.tts_model.delay_steps:
+                    audio_tokens[b, q] = machine.token_ids.zero
 
     def _create_lm_gen(self) -> LMGen:
         """Creates and configures the LMGen instance."""
@@ -84,86 +153,146 @@ class AsyncTTSGenerator:
             condition_tensors=self.condition_tensors,
             on_text_hook=self._on_text_hook,
             on_audio_hook=self._on_audio_hook,
+            # Streams start at different steps, so frames have to be returned for each of them individually.
+            support_out_of_sync=True,
         )
 
-    async def _generation_loop(self):
-        """The main background task for generating audio."""
-        self.lm_gen = self._create_lm_gen()
-        self.state = self.tts_model.machine.new_state([])
-        self.offset = 0
+    def _generation_loop(self):
+        """The main loop for generating audio, runs in the inference thread."""
+        lm_gen = self._create_lm_gen()
         mimi = self.tts_model.mimi
         lm = self.tts_model.lm
         machine = self.tts_model.machine
-        input_tokens = torch.full((1, lm.n_q - lm.dep_q, 1), machine.token_ids.zero, dtype=torch.long,
-                                  device=self.device)
-
-        try:
-            with self.lm_gen.streaming(batch_size=1), mimi.streaming(batch_size=1):
-                while True:
-                    # If there's no work to do, wait for more text.
-                    # "Work" means having text in the queue, or having entries to process.
-                    if self.text_queue.empty() and (
-                        not self.state.entries and not self.state.queued and not self.finished
-                    ):
-                        await asyncio.sleep(POLL_INTERVAL)
+        input_tokens = torch.full((self.max_streams, lm.n_q - lm.dep_q, 1), machine.token_ids.zero,
+                                  dtype=torch.long, device=self.device)
+
+        # The whole loop runs in inference mode, the streaming state is also reset in between steps.
+        with torch.inference_mode(), lm_gen.streaming(self.max_streams), mimi.streaming(self.max_streams):
+            while not self.stopping:
+                # Cleared before looking for work, so a change made meanwhile is not missed.
+                self.wakeup.clear()
+                self._admit_streams()
+                self._retire_streams(lm_gen)
+                for b, stream in enumerate(self.slots):
+                    self.executing[b] = stream is not None and self._prepare_step(stream)
+                if not any(self.executing):
+                    # Nothing to do until text arrives, or streams are admitted or cancelled.
+                    self.wakeup.wait()
+                    continue
+
+                # Generate one step for all streams that have work
+                exec_mask = torch.tensor(self.executing, dtype=torch.bool)
+                lm_gen.set_exec_mask(exec_mask)
+                input_tokens.fill_(machine.token_ids.zero)
+                frame = lm_gen.step(input_tokens)
+
+                audio_codes = frame[:, 1:, :]
+                # Streams in their initial delay have no audio yet, mimi must not advance for them.
+                decode_mask = exec_mask & (audio_codes >= 0).all(dim=2).all(dim=1).cpu()
+                pcm = None
+                if decode_mask.any():
+                    mimi.set_exec_mask(decode_mask)
+                    pcm = mimi.decode(audio_codes.clamp(min=0))
+                    # Copy to the CPU here, so the event loop never waits for the device.
+                    pcm = torch.clip(pcm[:, 0], -1, 1).cpu()
+
+                for b, stream in enumerate(self.slots):
+                    if not self.executing[b]:
                         continue
+                    if decode_mask[b]:
+                        # Frames of the initial delay would only be silence in front of the speech, they are skipped.
+                        self._emit(stream, pcm[b])
+                    stream.offset += 1
+
+    def _admit_streams(self):
+        while not self.admissions.empty():
+            stream = self.admissions.get_nowait()
+            # A free slot is guaranteed by `free_slots`, its state was reset when its previous stream retired.
+            stream.slot = self.slots.index(None)
+            self.slots[stream.slot] = stream
+
+    def _retire_streams(self, lm_gen: LMGen):
+        reset_mask = torch.zeros(self.max_streams, dtype=torch.bool)
+        for b, stream in enumerate(self.slots):
+            if stream is not None and (stream.cancelled or self._is_done(stream)):
+                self._retire(stream)
+                reset_mask[b] = True
+        if reset_mask.any():
+            # Reset here rather than on admission, so that the reset does not delay the first frame of the next stream.
+            lm_gen.reset_streaming(reset_mask)
+            self.tts_model.mimi.reset_streaming(reset_mask)
+
+    def _retire(self, stream: TTSStream):
+        self.slots[stream.slot] = None
+        self._emit(stream, None)  # Sentinel to signal end of audio
+        self._call_soon(self.free_slots.release)
+
+    @staticmethod
+    def _prepare_step(stream: TTSStream) -> bool:
+        """Moves new text into the state machine of `stream` and returns whether it has work to do."""
+        # Read before taking the text, all text is queued once `finished` is set.
+        stream.end_of_text = stream.finished
+        while not stream.text_queue.empty():
+            stream.state.entries.append(stream.text_queue.get_nowait())
+        return stream.has_work()
+
+    def _is_done(self, stream: TTSStream) -> bool:
+        no_pending_entries = not stream.state.entries and not stream.state.queued
+        end_signaled = stream.state.end_step is not None
+        return stream.end_of_text and no_pending_entries and end_signaled and stream.offset >= (
+            stream.state.end_step + self.tts_model.delay_steps + self.tts_model.final_padding
+        )
+
+    def _emit(self, stream: TTSStream, pcm: tp.Optional[torch.Tensor]):
+        self._call_soon(stream.audio_queue.put_nowait, pcm)
+
+    def _call_soon(self, fn: tp.Callable, *args):
+        # The loop is gone when the server shuts down while this thread still runs.
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(fn, *args)
 
-                    # Check for new text entries to add to the state machine
-                    while not self.text_queue.empty():
-                        entry = self.text_queue.get_nowait()
-                        if entry is None:
-                            # Sentinel from finish() was received. We don't need to do anything with it,
-                            # as self.finished is the source of truth.
-                            self.text_queue.put_nowait(None)  # Put back for any other logic that might check it.
-                            break
-                        assert self.state is not None
-                        self.state.entries.append(entry)
-
-                    # Check for termination conditions
-                    no_pending_entries = not self.state.entries and not self.state.queued
-                    end_signaled = self.state.end_step is not None
-
-                    if self.finished and no_pending_entries and end_signaled:
-                        if self.offset >= (
-                            self.state.end_step + self.tts_model.delay_steps + self.tts_model.final_padding
-                        ):
-                            break
-
-                    # Generate one step
-                    with torch.inference_mode():
-                        input_tokens.fill_(machine.token_ids.zero)
-                        frame = self.lm_gen.step(input_tokens)
-
-                        if frame is not None:
-                            audio_codes = frame[:, 1:, :]
-                            if (audio_codes < 0).any():
-                                pcm = torch.zeros(mimi.frame_size, device=self.device)
-                            else:
-                                pcm = mimi.decode(audio_codes)
-                                pcm = torch.clip(pcm.squeeze(0).squeeze(0), -1, 1)
-                            await self.audio_queue.put(pcm)
-
-                    self.offset += 1
-                    await asyncio.sleep(0)  # Yield control without adding latency
-        except asyncio.CancelledError:
-            print("Generation loop cancelled.")
+    def _run_generation(self):
+        """Entry point of the inference thread."""
+        try:
+            self._generation_loop()
         finally:
-            await self.audio_queue.put(None)  # Sentinel to signal end of audio
+            # End all streams, so that nobody waits for audio that will never come.
+            while not self.admissions.empty():
+                stream = self.admissions.get_nowait()
+                self._emit(stream, None)
+                self._call_soon(self.free_slots.release)
+            for stream in self.slots:
+                if stream is not None:
+                    self._retire(stream)
 
     async def start(self):
-        """Starts the generation background task."""
-        if self.generation_task and not self.generation_task.done():
+        """Starts the inference thread."""
+        if self.thread is not None and self.thread.is_alive():
             return
-        self.generation_task = asyncio.create_task(self._generation_loop())
-
-    async def add_text(self, text: str):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = False
+        self.slots = [None] * self.max_streams
+        # A daemon thread, so that a thread waiting for text does not keep the process alive.
+        self.thread = threading.Thread(target=self._run_generation, name='tts-inference', daemon=True)
+        self.thread.start()
+
+    async def open_stream(self) -> TTSStream:
+        """Starts a new utterance. Waits until a slot of the batch is free."""
+        await self.start()  # In case the inference thread died with an error.
+        await self.free_slots.acquire()
+        stream = TTSStream(self.tts_model)
+        self.admissions.put(stream)
+        self.wakeup.set()
+        return stream
+
+    async def add_text(self, stream: TTSStream, text: str):
         """Adds a piece of text to be synthesized."""
         print(f"---> Streaming in text: '{text}'")
         entries = self.tts_model.prepare_script([text], padding_between=1)
 
-        if not self.first_chunk_processed:
+        if not stream.first_chunk_processed:
             if entries:
-                self.first_chunk_processed = True
+                stream.first_chunk_processed = True
         else:
             # This is a subsequent chunk, remove the speaker token that was added by prepare_script.
             if entries and entries[0].tokens:
@@ -172,38 +301,32 @@ class AsyncTTSGenerator:
                     entries[0].tokens.pop(0)
 
         for entry in entries:
-            await self.text_queue.put(entry)
+            stream.text_queue.put(entry)
+        self.wakeup.set()
 
-    async def finish(self):
+    async def finish(self, stream: TTSStream):
         """Signals that no more text will be added."""
-        self.finished = True
-        await self.text_queue.put(None)
+        stream.finished = True
+        self.wakeup.set()
 
-    async def get_audio_chunk(self) -> tp.Optional[torch.Tensor]:
-        """Retrieves the next available chunk of audio."""
-        return await self.audio_queue.get()
+    async def close(self):
+        """Stops the inference thread, ending all streams."""
+        if self.thread is None:
+            return
+        self.stopping = True
+        self.wakeup.set()
+        await asyncio.to_thread(self.thread.join)
+        self.thread = None
 
-    async def restart(self):
-        """Stops the current generation and resets the state for a new one."""
-        print("\nRestarting generator...")
-        if self.generation_task:
-            self.generation_task.cancel()
-            try:
-                await self.generation_task
-            except asyncio.CancelledError:
-                pass
-            self.generation_task = None
-
-        # Clear queues
-        self.audio_queue = asyncio.Queue()
-        self.text_queue = asyncio.Queue()
-        self.finished = False
-        self.first_chunk_processed = False
-        await self.start()
+    def close_stream(self, stream: TTSStream):
+        """Stops the generation of `stream`. Its slot is freed within one step."""
+        print("\nClosing TTS stream...")
+        stream.cancelled = True
+        self.wakeup.set()
 
 
 class TTSServer(BaseServer):
-    def __init__(self, host: str, port: int):
+    def __init__(self, host: str, port: int, max_streams: int = MAX_STREAMS):
         super().__init__("tts", host, port)
         checkpoint_info = CheckpointInfo.from_hf_repo(
             "DUMMY_REPO",  # Repo name is not used when all paths are local
@@ -214,7 +337,13 @@ class TTSServer(BaseServer):
         )
         tts_model = TTSModel.from_checkpoint_info(checkpoint_info, n_q=32, temp=0.6, device=DEVICE)
         condition_attributes = tts_model.make_condition_attributes([VOICE_PATH], cfg_coef=2.0)
-        self.generator = AsyncTTSGenerator(tts_model, condition_attributes)
+        # Shared by all sessions. Each session synthesizes its utterances in a stream of its own; when more sessions
+        # speak at once than there are streams, they wait for a free one.
+        self.generator = BatchedTTSGenerator(tts_model, condition_attributes, max_streams)
+        self.phrase_cache = PhraseCache(
+            VOICE_PATH.name, CACHED_PHRASES, PHRASE_CACHE_BYTES,
+            directory=Path(PHRASE_CACHE_DIR) if PHRASE_CACHE_DIR else None
+        )
 
         self.audio_config = {
             'format': 1,  # 1 is pyaudio.paFloat32.
@@ -226,62 +355,196 @@ class TTSServer(BaseServer):
         """Runs a short dummy generation to prime CUDA kernels and first-call paths."""
         print("Warming up TTS...")
         await self.generator.start()
-        await self.generator.add_text('Warmup.')
-        await self.generator.finish()
-        while await self.generator.get_audio_chunk() is not None:
-            pass
-        await self.generator.restart()
+        await self._synthesize('Warmup.')
+        # So they are never generated while a user waits.
+        for phrase in CACHED_PHRASES:
+            if phrase_cache.normalize(phrase) not in self.phrase_cache.entries:
+                self.phrase_cache.put(phrase, await self._synthesize(phrase))
         print("TTS warmup complete.")
 
+    async def serve_forever(self) -> None:
+        try:
+            await super().serve_forever()
+        finally:
+            print(f'Phrase cache: {self.phrase_cache.summary()}')
+            await asyncio.to_thread(self.phrase_cache.close)
+
+    async def _synthesize(self, text: str) -> tp.List[bytes]:
+        stream = await self.generator.open_stream()
+        await self.generator.add_text(stream, text)
+        await self.generator.finish(stream)
+        frames = []
+        while (audio := await stream.get_audio_chunk()) is not None:
+            frames.append(audio.cpu().numpy().tobytes())
+        return frames
+
     async def _handle_workload(self) -> None:
         await self.generator.start()
 
-        current_id = None
+        current_id = None  # Only set while this session has an open `stream`.
+        stream = None
+        chunker = None  # Collects the text of `stream` until it can be passed on.
+        audio_task = None  # Waits for the next audio chunk of the current utterance.
+        encoder = None  # Encodes the audio of the current utterance as negotiated with the client.
+        coalescer = None  # Collects the frames of the current utterance into messages.
+        cacheable = None  # Text and audio of the current utterance while it may still be a phrase to cache.
+        held = None  # Id of the utterance whose text is held back for the phrase cache, and since when.
         received = []
-        while True:
-            try:
-                received += self._recv_client_messages()
-
-                # Discard data for a previous id. Necessary, because the StreamReset (and with that the clearing of
-                # `received`) happens only after it was attempted to send a response.
-                if len(received) > 1 and received[0]['id'] != received[-1]['id']:
-                    received = [data for data in received if data['id'] == received[-1]['id']]
-
-                if len(received) > 0:
-                    current_id = received[0]['id']
-                    text = ''.join(msg['text'] for msg in received)
-                    finished = received[-1]['status'] == 'FINISHED'
-
-                    if len(text.split()) >= 2 or finished:
-                        # Only add whole words or the end of the text.
-                        await self.generator.add_text(text)
+        try:
+            while True:
+                try:
+                    received += self._recv_client_messages()
+
+                    # Discard data for a previous id. Necessary, because the StreamReset (and with that the clearing of
+                    # `received`) happens only after it was attempted to send a response.
+                    if len(received) > 1 and received[0]['id'] != received[-1]['id']:
+                        received = [data for data in received if data['id'] == received[-1]['id']]
+
+                    if len(received) > 0:
+                        if current_id is not None and received[0]['id'] != current_id:
+                            # The client reset before any audio of the old utterance was sent, retire it.
+                            self._retire_utterance(audio_task, stream)
+                            current_id, stream, chunker, audio_task, coalescer, cacheable = (None,) * 6
+                        text = ''.join(msg['text'] for msg in received)
+                        finished = received[-1]['status'] == 'FINISHED'
+                        arrived = None  # When held back text arrived.
+                        if current_id is None:
+                            encoder = AudioEncoder(choose_encoding(received[0].get('audio_encodings')),
+                                                   self.audio_config['rate'], self.audio_config['channels'])
+                            if not finished and (not text.strip() or self.phrase_cache.may_complete(text)):
+                                # Nothing to say yet, or the text may still turn into a cached phrase. It is held
+                                # back until that is clear, but not longer than the chunker would hold it.
+                                if held is None or held[0] != received[0]['id'] or held[1] is None:
+                                    held = (received[0]['id'], time.monotonic() if text.strip() else None)
+                                remaining = None if held[1] is None else held[1] + CHUNK_DEADLINE - time.monotonic()
+                                if remaining is None or remaining > 0:
+                                    await self._wait_for_text_or_audio(None, remaining)
+                                    continue
+                            arrived = held[1] if held is not None else None
+                            held = None
+                            cacheable = ('', [])
+                            if (cached := self.phrase_cache.get_leading(text, finished)) is not None:
+                                frames, text = cached
+                                only_phrase = finished and not text.strip()
+                                self._send_cached(received[0]['id'], encoder, frames, end=only_phrase)
+                                if only_phrase:
+                                    received = []
+                                    continue
+                                cacheable = None
+                            coalescer = FrameCoalescer(self.audio_config['rate'], COALESCE_DURATION)
+                            stream = await self.generator.open_stream()
+                            chunker = TextChunker(CHUNK_MIN_WORDS, CHUNK_MAX_WORDS, CHUNK_DEADLINE)
+                            audio_task = asyncio.create_task(stream.get_audio_chunk())
+                        current_id = received[0]['id']
                         received = []
-                    if finished or text == 'Let me think about that.':
-                        # The generator seems to keep some kind of rolling window state and if we don't finish after
-                        # this, the audio will not be generated completely.
-                        await self.generator.finish()
-
-                if current_id is not None and not self.generator.audio_queue.empty():
-                    audio = await self.generator.get_audio_chunk()
-                    if audio is None:
+                        if cacheable is not None:
+                            cacheable = (cacheable[0] + text, cacheable[1])
+                            if len(cacheable[0].split()) > self.phrase_cache.max_words:
+                                cacheable = None
+                        chunks = chunker.add(text, arrived)
+                        if finished:
+                            chunks += chunker.flush()
+                        for chunk in chunks:
+                            await self.generator.add_text(stream, chunk)
                         if finished:
-                            # For 'Let me think..' `finished` will not be true.
-                            self.streams['client'].send({'audio': b'', 'status': 'FINISHED', 'id': current_id,
-                                                         'config': self.audio_config})
-                        await self.generator.restart()
-                        current_id = None
-                        finished = False  # Reset
-                    else:
-                        bytes_ = audio.cpu().numpy().tobytes()
-                        self.streams['client'].send({'audio': bytes_, 'status': 'GENERATING', 'id': current_id,
-                                                     'config': self.audio_config})
-
-                await asyncio.sleep(POLL_INTERVAL)
-            except StreamReset:
-                await self.generator.restart()
-                current_id = None
-            except ConnectionError:
-                break
+                            await self.generator.finish(stream)
+                    elif chunker is not None:
+                        # Woken up by the deadline of the chunker.
+                        for chunk in chunker.poll():
+                            await self.generator.add_text(stream, chunk)
+                    if coalescer is not None and (batch := coalescer.poll()) is not None:
+                        # The client is about to run out of audio to play.
+                        self._send_audio(current_id, encoder, batch)
+
+                    if audio_task is not None and audio_task.done():
+                        audio = audio_task.result()
+                        audio_task = None
+                        if audio is None:
+                            if finished:
+                                if (batch := coalescer.flush()) is not None:
+                                    self._send_audio(current_id, encoder, batch)
+                                self._send_audio(current_id, encoder, None)
+                                if cacheable is not None:
+                                    self.phrase_cache.put(*cacheable)
+                            cacheable = None
+                            # The generator retired the stream when its audio ended.
+                            stream = None
+                            chunker = None
+                            coalescer = None
+                            current_id = None
+                            finished = False  # Reset
+                        else:
+                            audio_task = asyncio.create_task(stream.get_audio_chunk())
+                            pcm = audio.cpu().numpy()
+                            if cacheable is not None:
+                                cacheable[1].append(pcm.tobytes())
+                            first = coalescer.start is None
+                            if (batch := coalescer.add(pcm)) is not None:
+                                self._send_audio(current_id, encoder, batch, with_config=first)
+                        continue
+
+                    # Wake up for the deadlines of the chunker and the coalescer, too.
+                    timeouts = [chunker and chunker.time_until_deadline(), coalescer and coalescer.time_until_flush()]
+                    await self._wait_for_text_or_audio(
+                        audio_task, min((timeout for timeout in timeouts if timeout is not None), default=None)
+                    )
+                except StreamReset:
+                    self._retire_utterance(audio_task, stream)
+                    current_id, stream, chunker, audio_task, coalescer, cacheable = (None,) * 6
+                    held = None
+                except ConnectionError:
+                    break
+        finally:
+            self._retire_utterance(audio_task, stream)
+
+    def _retire_utterance(self, audio_task: tp.Optional[asyncio.Task], stream: tp.Optional[TTSStream]) -> None:
+        """ Stops waiting for the audio of an utterance that is abandoned and frees its stream. The caller drops the
+        rest of the utterance's state with it. """
+        self._cancel(audio_task)
+        if stream is not None:
+            self.generator.close_stream(stream)
+
+    def _send_audio(self, id_: str, encoder: AudioEncoder, pcm: tp.Optional[np.ndarray],
+                    with_config: bool = False) -> None:
+        """ Sends float32 PCM, or the end of the utterance for `None`. The audio config is only sent with the first
+        audio and the end of an utterance. """
+        if pcm is None:
+            msg = {'audio': b'', 'status': 'FINISHED', 'id': id_}
+        else:
+            msg = {'audio': encoder.encode(pcm), 'status': 'GENERATING', 'id': id_}
+        if pcm is None or with_config:
+            msg['config'] = self.audio_config | {'format': decoded_format(encoder.encoding),
+                                                 'encoding': encoder.encoding}
+        self.streams['client'].send(msg)
+
+    def _send_cached(self, id_: str, encoder: AudioEncoder, frames: tp.List[bytes], end: bool = True) -> None:
+        """ Sends the audio of a cached phrase, with `end` also the end of the utterance. """
+        pcm = [np.frombuffer(bytes_, dtype=np.float32) for bytes_ in frames]
+        if pcm:
+            # All frames are there, the first one is sent alone only to start the playback as early as possible.
+            per_message = max(1, round(COALESCE_DURATION * self.audio_config['rate'] / len(pcm[0])))
+            self._send_audio(id_, encoder, pcm[0], with_config=True)
+            for start in range(1, len(pcm), per_message):
+                self._send_audio(id_, encoder, np.concatenate(pcm[start:start + per_message]))
+        if end:
+            self._send_audio(id_, encoder, None)
+        print(f'Phrase cache hit: {self.phrase_cache.summary()}')
+
+    async def _wait_for_text_or_audio(self, audio_task: tp.Optional[asyncio.Task],
+                                      timeout: tp.Optional[float] = None) -> None:
+        """ Sleep until the client sent something or, while an utterance is generated, the next audio chunk is ready.
+        Returns after `timeout` seconds at the latest. """
+        if audio_task is None:
+            await self.streams['client'].wait_readable(timeout)
+            return
+        readable = asyncio.create_task(self.streams['client'].wait_readable())
+        await asyncio.wait([readable, audio_task], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        self._cancel(readable)
+
+    @staticmethod
+    def _cancel(task: tp.Optional[asyncio.Task]) -> None:
+        if task is not None and not task.done():
+            task.cancel()
 
 
 async def main():
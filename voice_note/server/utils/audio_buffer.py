@@ -0,0 +1,35 @@
+import mmap
+
+CAPACITY = 2 ** 20  # Bytes
+
+
+class AudioBuffer:
+    """ Collects the audio of a recording and hands out read-only views of it, without copying.
+
+    The buffer is an anonymous memory map, its pages only take up memory once audio is written to them. So `capacity`
+    can be generous, e.g. enough for the longest expected recording, and the audio is never moved. Beyond it, a buffer
+    of twice the size is mapped and the audio copied over once; views of the old buffer stay valid (and unchanged).
+    Audio is only ever appended, so views can be passed to other threads, e.g. for transcription or saving, while more
+    audio arrives.
+    """
+
+    def __init__(self, capacity: int = CAPACITY):
+        self.data = mmap.mmap(-1, max(mmap.PAGESIZE, capacity))
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def append(self, audio_bytes: bytes) -> None:
+        end = self.size + len(audio_bytes)
+        if end > len(self.data):
+            # A map with views can not be resized, it is replaced instead.
+            data = mmap.mmap(-1, max(end, 2 * len(self.data)))
+            data[:self.size] = memoryview(self.data)[:self.size]
+            self.data = data
+        self.data[self.size:end] = audio_bytes
+        self.size = end
+
+    def view(self, start: int = 0, end: int = None) -> memoryview:
+        """ The audio from byte `start` to `end` (default: all audio so far). """
+        return memoryview(self.data)[start:self.size if end is None else end].toreadonly()
@@ -0,0 +1,129 @@
+import struct
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+try:
+    import opuslib
+except ImportError:  # Needs libopus, clients fall back to `PCM16` without it (see `preferred_encodings`).
+    opuslib = None
+
+# Encodings of the audio bytes of a message, declared as `config['encoding']`.
+FLOAT32 = 'f32'  # Raw 32-bit float PCM, what the TTS model produces.
+PCM16 = 'pcm16'  # 16-bit PCM, half the size.
+MULAW = 'mulaw'  # 8-bit mu-law companded PCM, a quarter of the size. Pure NumPy.
+OPUS = 'opus'  # Opus packets, each prefixed with its length (2 bytes, big-endian). Needs `opuslib`.
+
+# pyaudio sample formats (`pyaudio.paFloat32`, `pyaudio.paInt16`), the TTS server does not depend on pyaudio.
+PA_FLOAT32 = 1
+PA_INT16 = 8
+
+MU = 255
+OPUS_FRAME_DURATION = 0.02  # Seconds
+OPUS_BITRATE = 24_000  # Bits per second
+
+
+def available_encodings() -> List[str]:
+    """ Encodings that can be encoded and decoded here, the most compact first. """
+    return ([OPUS] if opuslib is not None else []) + [MULAW, PCM16, FLOAT32]
+
+
+def preferred_encodings(mulaw: bool = False) -> List[str]:
+    """ Encodings for a client to accept, in order of preference. Opus is compact and sounds close to the original,
+    without it `PCM16` is lossless enough. The 8-bit `MULAW` is audibly lossy and only preferred with `mulaw`, e.g. on a
+    slow network. """
+    return ([OPUS] if opuslib is not None else []) + ([MULAW] if mulaw else []) + [PCM16, FLOAT32]
+
+
+def choose_encoding(accepted: Optional[Sequence[str]]) -> str:
+    """ The first encoding of the client's `accepted` list (in order of preference) that is available here.
+
+    Clients that do not send a list get `FLOAT32`, as before encodings could be negotiated.
+    """
+    available = available_encodings()
+    for encoding in accepted or []:
+        if encoding in available:
+            return encoding
+    return FLOAT32
+
+
+def decoded_format(encoding: str) -> int:
+    """ The pyaudio sample format of the PCM that `AudioDecoder.decode` returns for `encoding`. """
+    return PA_FLOAT32 if encoding == FLOAT32 else PA_INT16
+
+
+class AudioEncoder:
+    """ Encodes the float32 PCM chunks of one utterance, in order (Opus keeps state in between). """
+
+    def __init__(self, encoding: str, rate: int, channels: int = 1):
+        self.encoding = encoding
+        self.channels = channels
+        if encoding == OPUS:
+            self.frame_size = int(rate * OPUS_FRAME_DURATION)
+            self.opus = opuslib.Encoder(rate, channels, opuslib.APPLICATION_VOIP)
+            self.opus.bitrate = OPUS_BITRATE
+
+    def encode(self, pcm: np.ndarray) -> bytes:
+        pcm = np.asarray(pcm, dtype=np.float32)
+        if self.encoding == FLOAT32:
+            return pcm.tobytes()
+        if self.encoding == PCM16:
+            return _to_int16(pcm).tobytes()
+        if self.encoding == MULAW:
+            pcm = np.clip(pcm, -1, 1)
+            companded = np.sign(pcm) * np.log1p(MU * np.abs(pcm)) / np.log1p(MU)
+            return np.round(companded * 127).astype(np.int8).tobytes()
+        if self.encoding == OPUS:
+            return self._encode_opus(pcm)
+        raise ValueError(f'Unknown audio encoding {self.encoding}.')
+
+    def _encode_opus(self, pcm: np.ndarray) -> bytes:
+        samples = self.frame_size * self.channels
+        if len(pcm) % samples:
+            pcm = np.pad(pcm, (0, samples - len(pcm) % samples))  # Opus only takes whole frames.
+        packets = []
+        for start in range(0, len(pcm), samples):
+            packet = self.opus.encode_float(pcm[start:start + samples].tobytes(), self.frame_size)
+            packets.append(struct.pack('>H', len(packet)) + packet)
+        return b''.join(packets)
+
+
+class AudioDecoder:
+    """ Decodes the audio bytes of one utterance to PCM in `decoded_format(encoding)`, in the order they were sent. """
+
+    def __init__(self, encoding: str, rate: int, channels: int = 1):
+        self.encoding = encoding
+        self.channels = channels
+        if encoding == OPUS:
+            if opuslib is None:
+                raise RuntimeError('Decoding Opus needs opuslib.')
+            self.frame_size = int(rate * OPUS_FRAME_DURATION)
+            self.opus = opuslib.Decoder(rate, channels)
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'AudioDecoder':
+        return cls(config.get('encoding', FLOAT32), config['rate'], config['channels'])
+
+    def decode(self, data: bytes) -> bytes:
+        if self.encoding in (FLOAT32, PCM16):
+            return data
+        if self.encoding == MULAW:
+            companded = np.frombuffer(data, dtype=np.int8) / 127
+            pcm = np.sign(companded) * np.expm1(np.abs(companded) * np.log1p(MU)) / MU
+            return _to_int16(pcm).tobytes()
+        if self.encoding == OPUS:
+            return self._decode_opus(data)
+        raise ValueError(f'Unknown audio encoding {self.encoding}.')
+
+    def _decode_opus(self, data: bytes) -> bytes:
+        pcm, offset = [], 0
+        while offset < len(data):
+            (length,) = struct.unpack_from('>H', data, offset)
+            offset += 2
+            pcm.append(self.opus.decode(data[offset:offset + length], self.frame_size))
+            offset += length
+        return b''.join(pcm)
+
+
+def _to_int16(pcm: np.ndarray) -> np.ndarray:
+    return (np.clip(pcm, -1, 1) * 32767).astype(np.int16)
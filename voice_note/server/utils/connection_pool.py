@@ -0,0 +1,88 @@
+import asyncio
+import random
+from typing import Dict, List, Optional, Set
+
+import websockets
+from websockets.asyncio.client import ClientConnection
+
+from server.utils.message import BINARY_SUBPROTOCOL
+from server.utils.multiplexing import MUX_SUBPROTOCOL, ChannelConnection, MultiplexedConnection
+
+INITIAL_BACKOFF = 0.05  # Seconds
+MAX_BACKOFF = 2.  # Seconds
+# Keepalive pings, so a dead downstream connection is noticed (and replaced) before the next message is lost on it.
+PING_INTERVAL = 5.  # Seconds
+PING_TIMEOUT = 5.  # Seconds
+
+
+async def connect_with_backoff(uri: str, subprotocols: List[str]) -> ClientConnection:
+    """ Connect to `uri`, retrying with jittered exponential backoff while it cannot be reached. """
+    backoff = INITIAL_BACKOFF
+    while True:
+        try:
+            return await websockets.connect(uri, subprotocols=subprotocols, ping_interval=PING_INTERVAL,
+                                            ping_timeout=PING_TIMEOUT)
+        except OSError:
+            await asyncio.sleep(random.uniform(0, backoff))
+            backoff = min(2 * backoff, MAX_BACKOFF)
+
+
+class MultiplexedConnectionPool:
+    """ Keeps one multiplexed connection per downstream URI open, for all sessions to open their channels on.
+
+    Connections are set up in the background (see `warm_up`) and replaced automatically when they are lost. Open
+    channels are then attached to the new connection, so the sessions using them keep running.
+    """
+
+    def __init__(self):
+        self.connections: Dict[str, MultiplexedConnection] = {}
+        self.connected: Dict[str, asyncio.Event] = {}
+        self.unsupported: Set[str] = set()  # URIs of servers that do not support multiplexing.
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def warm_up(self, uri: str) -> None:
+        if uri not in self.tasks:
+            self.connected[uri] = asyncio.Event()
+            self.tasks[uri] = asyncio.create_task(self._maintain_connection(uri))
+
+    async def open_channel(self, uri: str) -> Optional[ChannelConnection]:
+        """ Open a channel to `uri`, waiting for the connection if needed. `None` if `uri` does not multiplex. """
+        self.warm_up(uri)
+        while True:
+            await self.connected[uri].wait()
+            if uri in self.unsupported:
+                return None
+            mux = self.connections[uri]
+            if not mux.closed:
+                return mux.open_channel()
+            # Lost and not yet replaced.
+            self.connected[uri].clear()
+
+    async def _maintain_connection(self, uri: str) -> None:
+        detached: List[ChannelConnection] = []
+        while True:
+            connection = await connect_with_backoff(uri, [MUX_SUBPROTOCOL, BINARY_SUBPROTOCOL])
+            if connection.subprotocol != MUX_SUBPROTOCOL:
+                await connection.close()
+                self.unsupported.add(uri)
+                self.connected[uri].set()
+                return
+
+            mux = self.connections[uri] = MultiplexedConnection(connection, keep_channels=True)
+            for channel in detached:
+                mux.attach(channel)
+            self.connected[uri].set()
+
+            await mux.run()
+            self.connected[uri].clear()
+            detached = [channel for channel in mux.channels.values() if not channel.closed]
+            print(f"Lost connection to {uri}, reconnecting {len(detached)} channels.")
+
+    async def close(self) -> None:
+        for task in self.tasks.values():
+            task.cancel()
+        for mux in self.connections.values():
+            for channel in list(mux.channels.values()):
+                channel._set_closed()
+            await mux.close()
+        self.tasks = {}
@@ -1,11 +1,13 @@
+import itertools
 import json
 import wave
 from pathlib import Path
 import time
 import numpy as np
-from typing import Dict, List
+from typing import Dict, List, Optional, TextIO, Union
 
 from server.utils.audio import AudioConfig
+from server.utils.persistence import PersistenceWriter
 
 
 def _float_to_int16(audio_bytes: bytes) -> bytes:
@@ -15,22 +17,68 @@ def _float_to_int16(audio_bytes: bytes) -> bytes:
     return int16_array.tobytes()
 
 
+class StreamingWavWriter:
+    """ Writes a WAV file chunk by chunk. The header is only patched once, when the file is closed. """
+
+    def __init__(self, filepath: Path, audio_config: AudioConfig):
+        self.convert_float = audio_config.format == 1  # pyaudio.paFloat32
+        self.wf = wave.open(str(filepath), 'wb')
+        self.wf.setnchannels(audio_config.channels)
+        self.wf.setsampwidth(2 if self.convert_float else audio_config.sample_size)  # Floats are saved as int16.
+        self.wf.setframerate(audio_config.rate)
+
+    def write(self, audio_bytes: bytes) -> None:
+        self.wf.writeframesraw(_float_to_int16(audio_bytes) if self.convert_float else audio_bytes)
+
+    def close(self) -> None:
+        self.wf.close()
+
+
 class Conversation:
-    def __init__(self):
+    """ Saves the turns of a conversation as text and audio.
+
+    Assistant responses arrive in many small chunks, so they are only appended: text chunks to the `events.jsonl` log,
+    audio to a streaming WAV file. `conversation.json` is rewritten once per turn boundary. All file writes run in the
+    thread of a `PersistenceWriter`, which can be shared by several conversations. The directory is only created with
+    the first turn, so a connection that never got to say anything leaves nothing behind.
+    """
+
+    def __init__(self, writer: Optional[PersistenceWriter] = None):
         self.turns: List[Dict] = []
-        self.assistant_audio_buffer = b""
+        self.assistant_text_chunks: List[str] = []
+        self.assistant_audio_started = False
+        self.owns_writer = writer is None
+        self.writer = PersistenceWriter() if writer is None else writer
         self.save_dir = Path('outputs')
-        self.save_path = self.save_dir / time.strftime("%Y%m%d-%H%M%S")
-        self.save_path.mkdir(parents=True, exist_ok=True)
+        self.save_path: Optional[Path] = None  # Created with the first turn.
+
+        # Only accessed from the writer thread.
+        self.events_file = None
+        self.assistant_audio_writer: Optional[StreamingWavWriter] = None
+
+    def _create_save_path(self) -> Path:
+        # Several sessions can start a conversation within the same second.
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        for idx in itertools.count():
+            save_path = self.save_dir / (timestamp if idx == 0 else f"{timestamp}-{idx}")
+            try:
+                save_path.mkdir(parents=True)
+                return save_path
+            except FileExistsError:
+                continue
+
+    def add_turn(self, user_text: str, user_audio_bytes: Union[bytes, memoryview],
+                 user_audio_config: AudioConfig) -> None:
+        if self.assistant_audio_started:
+            self.finalize_assistant_response()
+        if self.save_path is None:
+            self.save_path = self._create_save_path()
+            self.writer.submit(self._open_events_file)
 
-    def add_turn(self, user_text: str, user_audio_bytes: bytes, user_audio_config: AudioConfig) -> None:
         turn_num = len(self.turns)
         user_audio_filename = f"user_audio_{turn_num}.wav"
         assistant_audio_filename = f"assistant_audio_{turn_num}.wav"
 
-        # Reset the buffer for the new turn
-        self.assistant_audio_buffer = b""
-
         self.turns.append({
             "turn": turn_num,
             "user": {
@@ -43,52 +91,90 @@ class Conversation:
             }
         })
 
-        self._save_audio(user_audio_bytes, user_audio_config, user_audio_filename)
+        self.writer.submit(self._save_audio, user_audio_bytes, user_audio_config, user_audio_filename)
+        self._log_event({"event": "turn", "turn": turn_num, "user_text": user_text})
         self._save_json()
 
-    def update_assistant_response(self, text_chunk: str, audio_chunk: bytes) -> None:
+    def update_assistant_response(self, text_chunk: str, audio_chunk: bytes,
+                                  audio_config: Optional[AudioConfig] = None) -> None:
         if not self.turns:
             return
 
         last_turn = self.turns[-1]
-        last_turn["assistant"]["text"] += text_chunk
-        self.assistant_audio_buffer += audio_chunk
-        self._save_json()
+        if text_chunk:
+            self.assistant_text_chunks.append(text_chunk)
+            self._log_event({"event": "assistant_text", "turn": last_turn["turn"], "text": text_chunk})
+
+        if audio_chunk and audio_config:
+            if not self.assistant_audio_started:
+                self.assistant_audio_started = True
+                self.writer.submit(self._open_assistant_audio, last_turn["assistant"]["audio_file"], audio_config)
+            self.writer.submit(self._write_assistant_audio, audio_chunk, droppable=True)
 
-    def finalize_assistant_audio(self, audio_config: AudioConfig) -> None:
-        if not self.turns or not audio_config:
+    def finalize_assistant_response(self) -> None:
+        if not self.turns:
             return
 
         last_turn = self.turns[-1]
-        assistant_audio_filename = last_turn["assistant"]["audio_file"]
+        last_turn["assistant"]["text"] += ''.join(self.assistant_text_chunks)
+        self.assistant_text_chunks = []
+        if self.assistant_audio_started:
+            self.assistant_audio_started = False
+            self.writer.submit(self._close_assistant_audio)
+
+        self._log_event({"event": "assistant_finished", "turn": last_turn["turn"]})
+        self._save_json()
 
-        self._save_audio(self.assistant_audio_buffer, audio_config, assistant_audio_filename)
-        # No need to modify self.turns, as the buffer is separate.
+    def close(self) -> None:
+        """ Finish the conversation. Its remaining writes are only guaranteed to be on disk once the writer is closed. """
+        if self.assistant_audio_started:
+            self.finalize_assistant_response()
+        if self.save_path is not None:
+            self.writer.submit(self._close_events_file)
+        if self.owns_writer:
+            self.writer.close()
 
-    def _save_audio(self, audio_bytes: bytes, audio_config: AudioConfig, filename: str) -> None:
+    def _log_event(self, event: Dict) -> None:
+        self.writer.submit(self._write_event, json.dumps(event) + '\n')
+
+    def _save_json(self) -> None:
+        # Serialized right away, the writer thread must not see later changes of `self.turns`.
+        self.writer.submit(self._write_json, json.dumps({"turns": self.turns}, indent=4))
+
+    # The methods below run in the writer thread.
+
+    def _open_events_file(self) -> None:
+        self.events_file = open(self.save_path / "events.jsonl", 'a')
+
+    def _write_event(self, line: str) -> TextIO:
+        self.events_file.write(line)
+        return self.events_file
+
+    def _close_events_file(self) -> None:
+        self.events_file.close()
+
+    def _open_assistant_audio(self, filename: str, audio_config: AudioConfig) -> None:
+        self.assistant_audio_writer = StreamingWavWriter(self.save_path / filename, audio_config)
+
+    def _write_assistant_audio(self, audio_chunk: bytes) -> None:
+        self.assistant_audio_writer.write(audio_chunk)
+
+    def _close_assistant_audio(self) -> None:
+        self.assistant_audio_writer.close()
+        self.assistant_audio_writer = None
+
+    def _save_audio(self, audio_bytes: Union[bytes, memoryview], audio_config: AudioConfig, filename: str) -> None:
         if not audio_bytes or not audio_config:
             return
 
-        filepath = self.save_path / filename
-        audio_to_save = audio_bytes
-        sample_width = audio_config.sample_size
-
-        if audio_config.format == 1:  # pyaudio.paFloat32
-            audio_to_save = _float_to_int16(audio_bytes)
-            sample_width = 2  # 16-bit integer
+        writer = StreamingWavWriter(self.save_path / filename, audio_config)
+        writer.write(audio_bytes)
+        writer.close()
 
-        with wave.open(str(filepath), 'wb') as wf:
-            wf.setnchannels(audio_config.channels)
-            wf.setsampwidth(sample_width)
-            wf.setframerate(audio_config.rate)
-            wf.writeframes(audio_to_save)
+    def _write_json(self, text: str) -> None:
+        with open(self.save_path / "conversation.json", 'w') as f:
+            f.write(text)
 
-    def _save_json(self) -> None:
-        filepath = self.save_path / "conversation.json"
-        with open(filepath, 'w') as f:
-            json.dump({
-                "turns": self.turns
-            }, f, indent=4)
-
-    def get_save_path(self) -> str:
-        return str(self.save_path)
+    def get_save_path(self) -> Optional[str]:
+        """ `None` before the first turn, nothing was saved yet. """
+        return None if self.save_path is None else str(self.save_path)
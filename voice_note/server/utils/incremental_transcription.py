@@ -0,0 +1,93 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+
+from server.utils.audio_buffer import AudioBuffer
+from server.utils.vad import find_pause
+
+MIN_WINDOW_SECONDS = 5.
+MAX_WINDOW_SECONDS = 25.  # Stay below Whisper's 30 s input window.
+
+
+class IncrementalTranscription:
+    """ Transcribes an utterance window by window while it is still being recorded.
+
+    Once at least `min_window` seconds of audio are pending, they are split at the quietest pause and the part before it
+    is transcribed in the background. Windows that reach `max_window` seconds are split even without a pause. When the
+    recording is finished, only the audio after the last split still has to be transcribed.
+    """
+
+    def __init__(self, id_: str, rate: int, transcribe: Callable[[memoryview], Awaitable[Optional[str]]],
+                 min_window: float = MIN_WINDOW_SECONDS, max_window: float = MAX_WINDOW_SECONDS,
+                 audio: Optional[AudioBuffer] = None):
+        """ `rate` is the sample rate of the (16 bit mono) audio, `transcribe` turns a window of it into text. The audio
+        is collected in `audio`, windows are views of it. """
+        self.id = id_
+        self.rate = rate
+        self.transcribe = transcribe
+        self.min_window = min_window
+        self.max_window = max_window
+
+        self.audio = AudioBuffer() if audio is None else audio
+        self.split = 0  # Byte offset of the last split, the audio after it is pending.
+        self.texts: List[str] = []
+        self.windows: asyncio.Queue[Optional[memoryview]] = asyncio.Queue()
+        self.n_windows = 0
+        self.n_transcribed = 0
+        self.transcribed = asyncio.Event()  # Set whenever a window was transcribed.
+        self.worker = asyncio.create_task(self._transcribe_windows())
+
+    def add_audio(self, audio_bytes: bytes) -> None:
+        if not audio_bytes:
+            return
+        self.audio.append(audio_bytes)
+
+        pending_seconds = (len(self.audio) - self.split) / (2 * self.rate)
+        if pending_seconds < self.min_window:
+            return
+        # Skip the first half of the pending audio, so windows do not get too short.
+        split = find_pause(self.audio.view(self.split), self.rate, min_seconds=pending_seconds / 2,
+                           force=pending_seconds >= self.max_window)
+        if split is not None:
+            self._add_window(self.split + split)
+
+    async def transcribe_pending(self) -> str:
+        """ Split off all pending audio as a window, e.g. at a pause, and return the text of the utterance so far once it
+        is transcribed. More audio can be added in the meantime. """
+        if len(self.audio) > self.split:
+            self._add_window(len(self.audio))
+        n_windows = self.n_windows
+        while self.n_transcribed < n_windows:
+            self.transcribed.clear()
+            await self.transcribed.wait()
+        return ' '.join(self.texts)
+
+    async def finish(self) -> str:
+        """ Transcribe the remaining audio and return the text of the whole utterance. """
+        if len(self.audio) > self.split:
+            self._add_window(len(self.audio))
+        self.windows.put_nowait(None)
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        return ' '.join(self.texts)
+
+    def cancel(self) -> None:
+        self.worker.cancel()
+
+    def get_audio_bytes(self) -> memoryview:
+        return self.audio.view()
+
+    def _add_window(self, end: int) -> None:
+        self.windows.put_nowait(self.audio.view(self.split, end))
+        self.n_windows += 1
+        self.split = end
+
+    async def _transcribe_windows(self) -> None:
+        while (window := await self.windows.get()) is not None:
+            text = await self.transcribe(window)
+            if text:
+                self.texts.append(text)
+            self.n_transcribed += 1
+            self.transcribed.set()
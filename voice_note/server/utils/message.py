@@ -1,6 +1,17 @@
 import json
 import base64
-from typing import Dict, Union
+import struct
+from typing import Dict, List, Optional, Sequence, Union
+
+# WebSocket subprotocol for the binary wire format (see `Message.encode_binary`). Connections that did not negotiate it
+# keep using JSON with base64-encoded bytes, so older clients continue to work.
+BINARY_SUBPROTOCOL = 'voicenote.binary.v1'
+_HEADER_LENGTH = struct.Struct('>I')
+
+
+def select_subprotocol(_connection, subprotocols: Sequence[str]) -> Optional[str]:
+    """ `select_subprotocol` callback for `websockets.serve`: use binary framing if offered, otherwise plain JSON. """
+    return BINARY_SUBPROTOCOL if BINARY_SUBPROTOCOL in subprotocols else None
 
 
 # TODO: should this be a class?
@@ -35,6 +46,63 @@ class Message:
                 transformed[key] = val
         return transformed
 
+    def has_bytes(self) -> bool:
+        return self._has_bytes(self.data)
+
+    @classmethod
+    def _has_bytes(cls, data: DataDict) -> bool:
+        return any(isinstance(val, bytes) or (isinstance(val, dict) and cls._has_bytes(val)) for val in data.values())
+
+    def encode_binary(self) -> bytes:
+        """ Encode as binary frame: 4 byte header length, JSON header, then the raw bytes values concatenated.
+
+        In the header, every bytes value is replaced by `<key>_binary: <length>`. Payloads follow in header order.
+        """
+        payloads = []
+        header = json.dumps(self._extract_payloads(self.data, payloads)).encode()
+        return b''.join([_HEADER_LENGTH.pack(len(header)), header, *payloads])
+
+    def _extract_payloads(self, data: DataDict, payloads: List[bytes]) -> EncodedDict:
+        transformed = {}
+        for key, val in data.items():
+            if isinstance(val, dict):
+                transformed[key] = self._extract_payloads(val, payloads)
+            elif isinstance(val, bytes):
+                transformed[key + '_binary'] = len(val)
+                payloads.append(val)
+            else:
+                transformed[key] = val
+        return transformed
+
+    @classmethod
+    def from_frame(cls, data: Union[str, bytes]) -> 'Message':
+        """ Create a message from a received WebSocket frame, which is binary for `encode_binary`, else text. """
+        if isinstance(data, bytes):
+            return cls(cls.decode_binary(data))
+        return cls.from_data_string(data)
+
+    @classmethod
+    def decode_binary(cls, data: bytes) -> DataDict:
+        view = memoryview(data)
+        (header_length,) = _HEADER_LENGTH.unpack_from(view)
+        offset = _HEADER_LENGTH.size + header_length
+        header = json.loads(bytes(view[_HEADER_LENGTH.size:offset]))
+        decoded, _ = cls._insert_payloads(header, view, offset)
+        return decoded
+
+    @classmethod
+    def _insert_payloads(cls, header: EncodedDict, view: memoryview, offset: int) -> tuple[DataDict, int]:
+        transformed = {}
+        for key, val in header.items():
+            if isinstance(val, dict):
+                transformed[key], offset = cls._insert_payloads(val, view, offset)
+            elif key.endswith('_binary'):
+                transformed[key.removesuffix('_binary')] = bytes(view[offset:offset + val])
+                offset += val
+            else:
+                transformed[key] = val
+        return transformed, offset
+
     @classmethod
     def from_data_string(cls, data: str) -> 'Message':
         return cls(cls.decode(data))
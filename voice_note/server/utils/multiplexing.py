@@ -0,0 +1,161 @@
+import asyncio
+import itertools
+import struct
+from typing import Callable, Dict, Optional, Union
+from websockets.asyncio.client import ClientConnection
+from websockets.asyncio.server import ServerConnection
+from websockets.exceptions import ConnectionClosed, ConnectionClosedOK
+
+from server.utils.message import BINARY_SUBPROTOCOL
+
+# WebSocket subprotocol for carrying many sessions (channels) over one connection between two servers.
+MUX_SUBPROTOCOL = 'voicenote.mux.v1'
+
+# Every multiplexed frame starts with its type and the id of its channel, followed by the payload.
+_FRAME_HEADER = struct.Struct('>BI')
+TEXT_FRAME, BINARY_FRAME, CLOSE_FRAME = range(3)
+
+
+class ChannelDetached(Exception):
+    """ Raised once by `ChannelConnection.recv` after the channel lost its connection. Frames that were in flight are
+    lost and the peer sees the channel as a new one after it was attached again, so it will not answer earlier messages.
+    """
+
+
+class ChannelConnection:
+    """ One channel of a `MultiplexedConnection`.
+
+    Provides the part of the websockets connection interface that `StreamingConnection` uses, so a channel can be used
+    wherever a WebSocket connection is expected. Channels always support binary messages. While the channel is detached
+    (see `MultiplexedConnection.keep_channels`), sending waits until it was attached to a new connection.
+    """
+
+    subprotocol = BINARY_SUBPROTOCOL
+
+    def __init__(self, mux: 'MultiplexedConnection', channel_id: int):
+        self.frames: asyncio.Queue[Union[str, bytes, ChannelDetached, None]] = asyncio.Queue()
+        self.attached = asyncio.Event()
+        self.closed = False
+        self._attach(mux, channel_id)
+
+    def _attach(self, mux: 'MultiplexedConnection', channel_id: int) -> None:
+        self.mux = mux
+        self.channel_id = channel_id
+        self.remote_address = (mux.connection.remote_address, channel_id)
+        self.attached.set()
+
+    async def recv(self) -> Union[str, bytes]:
+        frame = await self.frames.get()
+        if frame is None:
+            self.frames.put_nowait(None)  # Keep signalling the closed channel to later calls.
+            raise ConnectionClosedOK(None, None)
+        if isinstance(frame, ChannelDetached):
+            raise frame
+        return frame
+
+    async def send(self, frame: Union[str, bytes]) -> None:
+        frame_type, payload = (TEXT_FRAME, frame.encode()) if isinstance(frame, str) else (BINARY_FRAME, frame)
+        while True:
+            await self.attached.wait()
+            if self.closed:
+                raise ConnectionClosedOK(None, None)
+            mux = self.mux
+            try:
+                await mux.send(frame_type, self.channel_id, payload)
+                return
+            except ConnectionClosed:
+                # `MultiplexedConnection.run` will close or detach the channel, unless it already attached it to a new
+                # connection. Wait for that and try again.
+                if not self.closed and self.mux is mux:
+                    self.attached.clear()
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        self._set_closed()
+        self.mux.channels.pop(self.channel_id, None)
+        try:
+            await self.mux.send(CLOSE_FRAME, self.channel_id, b'')
+        except ConnectionClosed:
+            pass
+
+    def _detach(self) -> None:
+        self.attached.clear()
+        self.frames.put_nowait(ChannelDetached(f'Lost the connection of channel {self.channel_id}.'))
+
+    def _set_closed(self) -> None:
+        self.closed = True
+        self.frames.put_nowait(None)
+        self.attached.set()  # Wake up waiting senders, so they notice the closed channel.
+
+
+class MultiplexedConnection:
+    """ Carries many channels over a single WebSocket connection.
+
+    The side that opened the WebSocket connection opens the channels, the other side gets notified about new channels via
+    `on_channel`. Closing a channel is signalled to the peer. When the connection is closed, all channels are closed,
+    unless `keep_channels` is set: then they are only detached, so they can be attached to a new connection.
+    """
+
+    def __init__(self, connection: Union[ClientConnection, ServerConnection],
+                 on_channel: Optional[Callable[[ChannelConnection], None]] = None, keep_channels: bool = False):
+        self.connection = connection
+        self.on_channel = on_channel
+        self.keep_channels = keep_channels
+        self.channels: Dict[int, ChannelConnection] = {}
+        self.channel_ids = itertools.count()
+        self.last_channel_id = -1  # Highest channel id seen so far, frames for older, closed channels are dropped.
+        self.closed = False
+
+    def open_channel(self) -> ChannelConnection:
+        if self.closed:
+            raise ConnectionError('Multiplexed connection is closed.')
+        return self._add_channel(next(self.channel_ids))
+
+    def _add_channel(self, channel_id: int) -> ChannelConnection:
+        channel = self.channels[channel_id] = ChannelConnection(self, channel_id)
+        self.last_channel_id = max(self.last_channel_id, channel_id)
+        return channel
+
+    def attach(self, channel: ChannelConnection) -> None:
+        """ Move a channel detached from a previous connection to this one. The peer sees it as a new channel. """
+        channel_id = next(self.channel_ids)
+        self.channels[channel_id] = channel
+        channel._attach(self, channel_id)
+
+    async def send(self, frame_type: int, channel_id: int, payload: bytes) -> None:
+        await self.connection.send(_FRAME_HEADER.pack(frame_type, channel_id) + payload)
+
+    async def run(self) -> None:
+        try:
+            while True:
+                frame = await self.connection.recv()
+                frame_type, channel_id = _FRAME_HEADER.unpack_from(frame)
+                payload = frame[_FRAME_HEADER.size:]
+
+                channel = self.channels.get(channel_id)
+                if frame_type == CLOSE_FRAME:
+                    if channel is not None:
+                        del self.channels[channel_id]
+                        channel._set_closed()
+                    continue
+                if channel is None:
+                    if self.on_channel is None or channel_id <= self.last_channel_id:
+                        continue  # Channel was already closed on this side.
+                    channel = self._add_channel(channel_id)
+                    self.on_channel(channel)
+                channel.frames.put_nowait(payload.decode() if frame_type == TEXT_FRAME else payload)
+        except ConnectionClosed:
+            pass
+        finally:
+            self.closed = True
+            for channel in self.channels.values():
+                if self.keep_channels:
+                    channel._detach()
+                else:
+                    channel._set_closed()
+            if not self.keep_channels:
+                self.channels = {}
+
+    async def close(self) -> None:
+        await self.connection.close()
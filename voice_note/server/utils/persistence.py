@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import queue
+import threading
+from typing import Any, Callable
+
+logger = logging.getLogger(__name__)
+
+# Tasks that may wait for the writer thread before droppable ones are dropped.
+MAX_PENDING = 1024
+# Tasks that are run before buffered files are flushed.
+MAX_BATCH_SIZE = 64
+
+_STOP = object()
+
+
+class PersistenceWriter:
+    """ Runs disk writes in a background thread, so a slow disk does not stall the event loop.
+
+    Tasks run in the order they were submitted. Tasks that write to a buffered file return it; such files are flushed
+    once per batch of tasks instead of after every write. `close` returns only after every submitted task has run.
+
+    `submit` never blocks, it is called from the event loop. When the disk falls behind, bulk writes that are submitted
+    as droppable (e.g. audio chunks) are dropped instead of queued, so the backlog cannot grow without bounds. All other
+    tasks (opening and closing files, ...) are always queued, the files stay consistent.
+    """
+
+    def __init__(self, max_pending: int = MAX_PENDING, max_batch_size: int = MAX_BATCH_SIZE):
+        self.max_batch_size = max_batch_size
+        self.max_pending = max_pending
+        self.tasks = queue.Queue()
+        self.closed = False
+        self.dropped = 0
+        self._dropping = False  # Whether the last droppable task was dropped, to log once per overload.
+        self._dirty = {}  # Files written since the last flush, only touched by the writer thread.
+        self.thread = threading.Thread(target=self._run, name='persistence', daemon=True)
+        self.thread.start()
+
+    def submit(self, fn: Callable[..., Any], *args, droppable: bool = False) -> None:
+        """ Queue `fn(*args)` to run in the writer thread. A `droppable` task is dropped instead while `max_pending`
+        tasks are waiting. """
+        if self.closed:
+            raise RuntimeError('PersistenceWriter is closed.')
+        if droppable and self.tasks.qsize() >= self.max_pending:
+            self.dropped += 1
+            if not self._dropping:
+                logger.warning(f'The disk falls behind, dropping writes ({self.dropped} so far).')
+            self._dropping = True
+            return
+        if droppable:
+            self._dropping = False
+        self.tasks.put((fn, args))
+
+    async def flush(self) -> None:
+        """ Wait until every task submitted so far has run and its file has been flushed. """
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self.submit(self._flush_and_notify, loop, done)
+        await done
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.tasks.put(_STOP)
+        self.thread.join()
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            batch = [self.tasks.get()]
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.tasks.get_nowait())
+                except queue.Empty:
+                    break
+
+            for task in batch:
+                if task is _STOP:
+                    stopped = True
+                    continue
+                fn, args = task
+                try:
+                    result = fn(*args)
+                except Exception:
+                    logger.exception(f"Persistence task {getattr(fn, '__qualname__', fn)} failed.")
+                    continue
+                if hasattr(result, 'flush'):
+                    self._dirty[id(result)] = result
+            self._flush()
+
+    def _flush_and_notify(self, loop: asyncio.AbstractEventLoop, done: asyncio.Future) -> None:
+        self._flush()
+        loop.call_soon_threadsafe(done.set_result, None)
+
+    def _flush(self) -> None:
+        for file in self._dirty.values():
+            try:
+                if not file.closed:
+                    file.flush()
+            except Exception:
+                logger.exception('Flushing a persisted file failed.')
+        self._dirty.clear()
@@ -1,36 +1,177 @@
+import functools
+import math
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
 import torch
 from torchaudio.transforms import Resample
-from typing import List
+from typing import List, Optional, Tuple, Union
 
 from server.utils.audio import AudioConfig
+from server.utils.vad import speech_bounds, split_at_pauses
 from transformers import WhisperForConditionalGeneration, WhisperProcessor
 
+SAMPLE_RATE = 16_000  # Whisper's
+# Fragments are converted and resampled in blocks of about this many seconds, each call has some overhead.
+BLOCK_SECONDS = 1.
+# Whisper's input window, longer audio is split at pauses into several windows.
+MAX_WINDOW_SECONDS = 30.
+# Resamples the blocks of all samples in the background while they are recorded. One thread, so the blocks of a sample
+# are processed in order and its `StreamingResampler` is never used by two threads at once.
+_block_resampler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='resample')
+
+
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_freq: int, new_freq: int = SAMPLE_RATE) -> Resample:
+    """ Resamplers are shared by all samples with the same rate, building one computes its sinc kernel. They hold no
+    state, so they can also be used from several threads at once. """
+    return Resample(orig_freq, new_freq)
+
+
+def to_float(audio_bytes: bytes) -> torch.Tensor:
+    """ 16 bit PCM bytes to float samples in [-1, 1). """
+    # `np.frombuffer` reads the bytes in place, the conversion to float is the only copy.
+    data = np.frombuffer(audio_bytes, dtype=np.int16).astype(np.float32)
+    # Is also done in OpenAI's whisper implementation in whisper#load_audio and seems to make data similar to the
+    # result of that.
+    data /= 32768.
+    return torch.from_numpy(data)
+
+
+class StreamingResampler:
+    """ Resamples audio fragment by fragment, with the same result as resampling all of it at once with `Resample`.
+
+    `Resample` pads the audio with zeros and convolves it with one kernel per output phase, moving `orig` input samples
+    per step. Here every step is computed as soon as its input is complete, so only the kernel's overlap has to be kept
+    between fragments.
+    """
+
+    def __init__(self, orig_freq: int, new_freq: int = SAMPLE_RATE):
+        self.passthrough = orig_freq == new_freq
+        self.length = 0  # Input samples so far
+        self.produced = 0  # Output samples so far
+        if self.passthrough:
+            return
+        resampler = get_resampler(orig_freq, new_freq)
+        self.orig = orig_freq // resampler.gcd
+        self.new = new_freq // resampler.gcd
+        self.width = resampler.width
+        self.kernel = resampler.kernel
+        # Input that is still needed for the next steps, starting with the zero padding on the left.
+        self.pending = torch.zeros(self.width)
+
+    def process(self, data: torch.Tensor) -> torch.Tensor:
+        """ Resample the next fragment. Returns the output samples that are complete now. """
+        self.length += len(data)
+        if self.passthrough:
+            return data
+        self.pending = torch.cat([self.pending, data])
+        return self._resample()
+
+    def flush(self) -> torch.Tensor:
+        """ Returns the remaining output samples at the end of the audio. """
+        if self.passthrough:
+            return torch.zeros(0)
+        self.pending = torch.cat([self.pending, torch.zeros(self.width + self.orig)])
+        output = self._resample()
+        return output[:math.ceil(self.new * self.length / self.orig) - self.produced + len(output)]
+
+    def _resample(self) -> torch.Tensor:
+        kernel_size = self.kernel.shape[-1]
+        steps = (len(self.pending) - kernel_size) // self.orig + 1
+        if steps <= 0:
+            return torch.zeros(0)
+        output = torch.nn.functional.conv1d(
+            self.pending[None, None, :(steps - 1) * self.orig + kernel_size], self.kernel, stride=self.orig
+        )
+        self.pending = self.pending[steps * self.orig:]
+        output = output[0].T.reshape(-1)  # Interleave the phases.
+        self.produced += len(output)
+        return output
+
 
 class Sample:
 
-    def __init__(self, fragments: List[bytes], audio_config: AudioConfig):
-        self.fragments = fragments
+    def __init__(self, fragments: List[Union[bytes, memoryview]], audio_config: AudioConfig):
+        self.fragments = fragments  # Not resampled yet, they are released once they are.
+        self.n_bytes = sum(len(fragment) for fragment in fragments)
+        self.pending_bytes = self.n_bytes  # Of `fragments`
         self.audio_config = audio_config
-        self.resampler = Resample(audio_config.rate, 16_000)
+        self.resampler = StreamingResampler(audio_config.rate)
+        self.block_size = int(BLOCK_SECONDS * audio_config.rate) * 2  # Bytes
+        self.resampled: List[torch.Tensor] = []
         self.result = None
+        self.segments: List[Tuple[float, str]] = []  # Start (in seconds) and text of each transcribed window.
+        self._audio_data: Optional[torch.Tensor] = None
+        self.resampling: Optional[Future] = None  # The last block handed to `_block_resampler`
 
-    def transcribe(self, model: WhisperForConditionalGeneration, processor: WhisperProcessor, lang: str = None):
-        if len(self.fragments) == 0:
-            return
+    def add_fragment(self, audio_bytes: Union[bytes, memoryview]) -> None:
+        """ Add audio. Complete blocks are resampled right away in a background thread, e.g. while the rest of it is
+        still being recorded, so this is cheap enough to be called on the event loop. """
+        self.fragments.append(audio_bytes)
+        self.n_bytes += len(audio_bytes)
+        self.pending_bytes += len(audio_bytes)
+        if self.pending_bytes >= self.block_size:
+            block, self.fragments, self.pending_bytes = self.fragments, [], 0
+            self.resampling = _block_resampler.submit(self._resample_block, block)
 
-        input_features = processor(self.audio_data, sampling_rate=16_000, return_tensors="pt").input_features
-        pred_ids = model.generate(input_features.to(model.device, dtype=model.dtype), language=lang)
-        self.result = processor.batch_decode(pred_ids, skip_special_tokens=True)[0].strip()
+    def transcribe(self, model: WhisperForConditionalGeneration, processor: WhisperProcessor, lang: str = None,
+                   vad: bool = True):
+        self.transcribe_batch([self], model, processor, lang, vad)
+
+    @staticmethod
+    def transcribe_batch(samples: List['Sample'], model: WhisperForConditionalGeneration, processor: WhisperProcessor,
+                         lang: str = None, vad: bool = True):
+        """ Transcribe several samples with one `generate` call and store the text in their `result`.
+
+        Samples longer than Whisper's 30 s window are split at pauses, all windows (of all samples) are transcribed
+        together and the texts of a sample are joined again. With `vad`, silence before and after the speech is trimmed
+        and samples without speech get an empty result without being passed to the model (Whisper tends to hallucinate
+        text for silence).
+        """
+        samples = [sample for sample in samples if sample.n_bytes > 0]
+        windows = []  # The sample, start (in seconds) and audio of each window.
+        for sample in samples:
+            sample.segments = []
+            data = sample.audio_data.numpy()
+            bounds = speech_bounds(data, SAMPLE_RATE) if vad else (0, len(data))
+            if bounds is None:
+                continue  # No speech, the result stays empty.
+            speech = data[bounds[0]:bounds[1]]
+            for start, end in split_at_pauses(speech, SAMPLE_RATE, MAX_WINDOW_SECONDS):
+                windows.append((sample, (bounds[0] + start) / SAMPLE_RATE, speech[start:end]))
+
+        if windows:
+            input_features = processor([audio for _, _, audio in windows], sampling_rate=SAMPLE_RATE,
+                                       return_tensors="pt").input_features
+            pred_ids = model.generate(input_features.to(model.device, dtype=model.dtype), language=lang)
+            for (sample, start, _), text in zip(windows, processor.batch_decode(pred_ids, skip_special_tokens=True)):
+                if text.strip():
+                    sample.segments.append((start, text.strip()))
+        for sample in samples:
+            sample.result = ' '.join(text for _, text in sample.segments)
 
     @property
     def audio_data(self) -> torch.Tensor:
-        data = torch.asarray(self.get_audio_bytes(), dtype=torch.int16).float()
-
-        # Is also done in OpenAI's whisper implementation in whisper#load_audio and seems to make data similar to the
-        # result of that.
-        data /= 32768.
+        """ The audio as float samples at 16 kHz. Ends the sample, no more fragments can be added afterwards. """
+        if self._audio_data is None:
+            if self.resampling is not None:
+                self.resampling.result()  # Also waits for the blocks before, raises if one failed.
+            self._resample_fragments()
+            self.resampled.append(self.resampler.flush())
+            self._audio_data = torch.cat(self.resampled)
+            self.resampled = []
+        return self._audio_data
 
-        return self.resampler(data)
+    def _resample_fragments(self) -> None:
+        # Block by block, so the whole recording is never converted to float at the input rate.
+        block, block_bytes = [], 0
+        for idx, fragment in enumerate(self.fragments):
+            block.append(fragment)
+            block_bytes += len(fragment)
+            if block_bytes >= self.block_size or idx == len(self.fragments) - 1:
+                self._resample_block(block)
+                block, block_bytes = [], 0
+        self.fragments, self.pending_bytes = [], 0
 
-    def get_audio_bytes(self) -> bytes:
-        return b''.join(self.fragments)
+    def _resample_block(self, block: List[Union[bytes, memoryview]]) -> None:
+        self.resampled.append(self.resampler.process(to_float(block[0] if len(block) == 1 else b''.join(block))))
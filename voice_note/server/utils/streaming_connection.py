@@ -1,16 +1,17 @@
 import asyncio
 import logging
 import os
+from collections import deque
 from datetime import datetime
-from hashlib import md5
-from typing import List, Union
+from typing import Callable, Deque, List, Optional, Union
 from websockets.asyncio.client import ClientConnection
 from websockets.asyncio.server import ServerConnection
 from websockets.exceptions import ConnectionClosedError, ConnectionClosedOK
-from queue import SimpleQueue, Empty
 
-from server.utils.message import Message
+from server.utils.message import BINARY_SUBPROTOCOL, Message
 from server.utils.misc import BASE_DIR
+from server.utils.multiplexing import ChannelDetached
+from server.utils.tracing import TRACE_KEY, Tracer
 
 POLL_INTERVAL = 0.005  # Seconds
 LOG_DIR = BASE_DIR / 'logs'
@@ -22,29 +23,49 @@ class StreamReset(Exception):
         self.id = id_
 
 
+class StreamInterrupted(Exception):
+    """ The connection was lost and replaced while a request was in flight, its response will not arrive. """
+
+    def __init__(self, message: str, id_: str):
+        super().__init__(message)
+        self.id = id_
+
+
 class StreamingConnection:
     def __init__(self, name: str, connection: Union[ClientConnection, ServerConnection]):
         self._setup_logger(name)
+        # Only trace when debug logging is enabled, so there is no per-message cost otherwise.
+        self.tracer = Tracer(name, self.logger) if self.logger.isEnabledFor(logging.DEBUG) else None
         self.connection = connection
-        self.received_q = SimpleQueue()
-        self.ready_to_send_q = SimpleQueue()
+        # Deques are used instead of `asyncio.Queue`s, because appending to them is thread-safe and they can be cleared
+        # in place on reset (so the long-running send/recv tasks never wait on a stale queue).
+        self.received_q: Deque[Message.DataDict] = deque()
+        self.ready_to_send_q: Deque[Message.DataDict] = deque()
+        self._received_event = asyncio.Event()
+        self._ready_to_send_event = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Binary frames for messages that carry bytes, if the peer negotiated it during the handshake.
+        self.binary = connection.subprotocol == BINARY_SUBPROTOCOL
         self.closed = False
+        # Set when the connection was replaced (see `ChannelDetached`), until the stream is reset for the next request.
+        self.interrupted = False
         self.communication_id = None
 
     async def run(self) -> None:
-        while True:
-            try:
-                tasks = self._create_communication_tasks()
-                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-                for task in done:
-                    if task.exception() is not None:
-                        raise task.exception()
-            except (ConnectionClosedOK, ConnectionClosedError):
-                # TODO: Should the two be handled differently?
-                self.closed = True
-                break
-            finally:
-                self.cancel_tasks(tasks)
+        self._loop = asyncio.get_running_loop()
+        tasks = self._create_communication_tasks()
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        except (ConnectionClosedOK, ConnectionClosedError):
+            # TODO: Should the two be handled differently?
+            self.closed = True
+            # Wake up everyone waiting for messages, so they notice the closed connection.
+            self._received_event.set()
+        finally:
+            self.cancel_tasks(tasks)
 
     def _create_communication_tasks(self) -> List[asyncio.Task]:
         return [asyncio.create_task(self._recv_to_queue()), asyncio.create_task(self._send_from_queue())]
@@ -56,51 +77,99 @@ class StreamingConnection:
                 task.cancel()
 
     async def _recv_to_queue(self) -> None:
-        msg = Message.from_data_string(await self.connection.recv())
-        self.logger.debug(f"Received message {md5(msg.encode().encode()).hexdigest()} with status {msg.data.get('status')}")
-        if msg.data.get('status') == 'RESET':
-            self.reset(msg['id'], propagate=False)
-        elif self._is_valid_msg(msg.data.get('id')):
-            self.received_q.put(msg.data)
-        else:
-            print(f"Discarding msg with id {msg.data.get('id')}.")
+        while True:
+            try:
+                frame = await self.connection.recv()
+            except ChannelDetached:
+                self.interrupted = True
+                self._received_event.set()  # Wake up the workload waiting for the response.
+                continue
+            msg = Message.from_frame(frame)
+            if self.tracer is not None:
+                self.tracer.received(msg.data, len(frame))
+            else:
+                msg.data.pop(TRACE_KEY, None)  # The sender traces, even though this side does not.
+            if msg.data.get('status') == 'RESET':
+                self.reset(msg['id'], propagate=False)
+            elif self._is_valid_msg(msg.data.get('id')):
+                self.received_q.append(msg.data)
+                self._received_event.set()
+            else:
+                print(f"Discarding msg with id {msg.data.get('id')}.")
 
     async def _send_from_queue(self) -> None:
-        try:
-            msg = Message(self.ready_to_send_q.get_nowait())
-            await self.connection.send(msg.encode())
-            self.logger.debug(f"Sent message {md5(msg.encode().encode()).hexdigest()} with status {msg.data.get('status')}")
-        except Empty:
-            await asyncio.sleep(POLL_INTERVAL)
+        while True:
+            await self._wait_until(self._ready_to_send_event, lambda: bool(self.ready_to_send_q))
+            data = self.ready_to_send_q.popleft()
+            if self.tracer is not None:
+                data = self.tracer.stamp(data)
+            msg = Message(data)
+            frame = msg.encode_binary() if self.binary and msg.has_bytes() else msg.encode()
+            await self.connection.send(frame)
+            if self.tracer is not None:
+                self.tracer.sent(data, len(frame))
+
+    @staticmethod
+    async def _wait_until(event: asyncio.Event, condition: Callable[[], bool]) -> None:
+        # Events are only ever set from the event loop thread (see `send_threadsafe`), so nothing can slip in between
+        # checking the condition and clearing the event.
+        while not condition():
+            event.clear()
+            await event.wait()
 
     def send(self, data: Message.DataDict) -> None:
+        """ Queue `data` for sending. Must be called from the thread running the event loop. """
+        self._enqueue(data)
+        self._ready_to_send_event.set()
+
+    def send_threadsafe(self, data: Message.DataDict) -> None:
+        """ Same as `send`, but can be called from other threads, e.g. PyAudio callbacks. """
+        self._enqueue(data)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._ready_to_send_event.set)
+
+    def _enqueue(self, data: Message.DataDict) -> None:
         if self.closed:
             raise ConnectionError
 
         if self._is_valid_msg(data.get('id')):
-            self.ready_to_send_q.put(data)
+            self.ready_to_send_q.append(data)
         else:
             raise StreamReset("Invalid message ID", self.communication_id)
 
     def recv(self) -> List[Message.DataDict]:
+        """ The messages received so far. Raises `StreamInterrupted` once they are all consumed, if the connection was
+        replaced in the meantime. """
         if self.closed:
             raise ConnectionError
+        if self.interrupted and not self.received_q:
+            raise StreamInterrupted('Connection was replaced, the response was lost', self.communication_id)
 
         received = []
-        while True:
-            try:
-                received.append(self.received_q.get_nowait())
-            except Empty:
-                break
+        while self.received_q:
+            received.append(self.received_q.popleft())
         return received
 
+    async def wait_readable(self, timeout: Optional[float] = None) -> None:
+        """ Wait until there are messages to `recv`, the connection is closed or interrupted or `timeout` seconds
+        have passed. """
+        try:
+            await asyncio.wait_for(self._wait_until(
+                self._received_event, lambda: bool(self.received_q) or self.closed or self.interrupted
+            ), timeout)
+        except asyncio.TimeoutError:
+            pass
+
     async def close(self) -> None:
+        if self.tracer is not None and (summary := self.tracer.latency_summary()) is not None:
+            self.logger.debug(f"Closing, {summary}")
         await self.connection.close()
 
     def reset(self, id_: str, propagate: bool = True) -> None:
         self.communication_id = id_
-        self.received_q = SimpleQueue()
-        self.ready_to_send_q = SimpleQueue()
+        self.interrupted = False
+        self.received_q.clear()
+        self.ready_to_send_q.clear()
         if propagate:
             self.send({'id': id_, 'status': 'RESET'})
 
@@ -0,0 +1,121 @@
+import re
+import time
+from typing import Callable, List, Optional
+
+MIN_WORDS = 3
+MAX_WORDS = 15
+DEADLINE = 0.3  # Seconds
+STALL_DEADLINE = 1.5  # Seconds
+
+# A period after these words (compared in lower case, without the period) does not end a sentence.
+ABBREVIATIONS = frozenset({
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'vs', 'etc', 'approx', 'no', 'nr', 'fig', 'inc', 'ltd', 'co',
+    'corp', 'dept', 'est', 'min', 'max', 'jan', 'feb', 'mar', 'apr', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov',
+    'dec', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun', 'ca', 'cf', 'al',
+})
+_CLOSING = r'"\'”’)\]*_'  # Quotes, brackets and markdown emphasis that may follow punctuation.
+_SENTENCE_END = re.compile(rf'[.!?…]+[{_CLOSING}]*$')
+_CLAUSE_END = re.compile(rf'[,;:—–][{_CLOSING}]*$')
+_DOTTED_ABBREVIATION = re.compile(r'^(?:[A-Za-z]\.){2,}$')  # e.g. i.e. U.S.
+_INITIAL = re.compile(r'^[A-Z]\.$')
+_ORDINAL = re.compile(r'^\d+\.$')
+_WORD = re.compile(r'\S+')
+
+
+class TextChunker:
+    """ Splits text that streams in piece by piece into chunks for the TTS model.
+
+    Chunks end at sentence boundaries once they have `min_words` words, so the model sees whole phrases and can get the
+    prosody right. Chunks that grow to `max_words` are split at the last clause boundary (or hard at `max_words`).
+    Text that waited for `deadline` seconds before the first chunk is released anyway, which bounds the time to first
+    audio. While the model speaks the earlier chunks, later text may wait for the longer `stall_deadline`. Only complete
+    words are released before `flush`, a word is complete once whitespace follows it.
+    """
+
+    def __init__(self, min_words: int = MIN_WORDS, max_words: int = MAX_WORDS, deadline: float = DEADLINE,
+                 stall_deadline: float = STALL_DEADLINE, clock: Callable[[], float] = time.monotonic):
+        self.min_words = min_words
+        self.max_words = max_words
+        self.deadline = deadline
+        self.stall_deadline = stall_deadline
+        self.clock = clock
+        self.buffer = ''
+        self.pending_since: Optional[float] = None
+        self.released = False  # Whether a chunk was returned already.
+
+    def add(self, text: str, arrived: Optional[float] = None) -> List[str]:
+        """ Add a piece of text and return the chunks that are ready. `arrived` is when the text arrived (on `clock`),
+        if it was held back before it was added. """
+        if self.pending_since is None and text.strip():
+            self.pending_since = self.clock() if arrived is None else arrived
+        self.buffer += text
+
+        chunks = []
+        while (chunk := self._take(self._find_cut(self._complete_words()))) is not None:
+            chunks.append(chunk)
+        return chunks + self.poll()
+
+    def poll(self) -> List[str]:
+        """ Return all complete words as a chunk if they waited for the deadline. """
+        if self.pending_since is None or self.clock() < self.pending_since + self._current_deadline():
+            return []
+        chunk = self._take(len(self._complete_words()))
+        return [] if chunk is None else [chunk]
+
+    def flush(self) -> List[str]:
+        """ Return everything that is left, at the end of the text. """
+        words = _WORD.findall(self.buffer)
+        self.buffer = ''
+        self.pending_since = None
+        return [' '.join(words)] if words else []
+
+    def time_until_deadline(self) -> Optional[float]:
+        """ Seconds until `poll` releases the pending words, `None` without complete pending words. """
+        if self.pending_since is None or not self._complete_words():
+            return None
+        return max(0., self.pending_since + self._current_deadline() - self.clock())
+
+    def _current_deadline(self) -> float:
+        return self.stall_deadline if self.released else self.deadline
+
+    def _complete_words(self) -> List[re.Match]:
+        words = list(_WORD.finditer(self.buffer))
+        if words and words[-1].end() == len(self.buffer):
+            words.pop()  # More of the last word might still come.
+        return words
+
+    def _find_cut(self, words: List[re.Match]) -> Optional[int]:
+        """ Return the number of words to release, or `None` to wait for more text. """
+        for idx in range(self.min_words - 1, len(words)):
+            if self._ends_sentence(words, idx):
+                return idx + 1
+        if len(words) < self.max_words:
+            return None
+        for idx in range(self.max_words - 1, self.min_words - 2, -1):
+            if _CLAUSE_END.search(words[idx].group()):
+                return idx + 1
+        return self.max_words
+
+    def _ends_sentence(self, words: List[re.Match], idx: int) -> bool:
+        word = words[idx].group()
+        if '\n' in self.buffer[words[idx].end():words[idx + 1].start() if idx + 1 < len(words) else None]:
+            return True  # End of a paragraph or list item.
+        if not _SENTENCE_END.search(word):
+            return False
+        if not word.endswith('.'):
+            return True  # ! ? …
+        stripped = word.rstrip('.').lower()
+        if stripped in ABBREVIATIONS or _DOTTED_ABBREVIATION.match(word) or _INITIAL.match(word):
+            return False
+        if _ORDINAL.match(word) and idx == 0:
+            return False  # Numbered list item, e.g. "1. Preheat the oven."
+        return True
+
+    def _take(self, n_words: Optional[int]) -> Optional[str]:
+        if not n_words:
+            return None
+        words = list(_WORD.finditer(self.buffer))[:n_words]
+        self.buffer = self.buffer[words[-1].end():]
+        self.pending_since = self.clock() if self.buffer.strip() else None
+        self.released = True
+        return ' '.join(word.group() for word in words)
@@ -0,0 +1,55 @@
+import itertools
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Deque, Optional
+
+from server.utils.message import Message
+
+TRACE_KEY = 'trace'
+
+
+class Tracer:
+    """ Per-message tracing for a `StreamingConnection`.
+
+    Outgoing messages are stamped with a cheap ID (`<connection name>#<sequence number>`) and the wall-clock send time,
+    which the receiving connection strips again to log the hop latency. Only created when debug logging is enabled, so
+    disabled tracing costs a single `is None` check per message.
+    """
+
+    def __init__(self, name: str, logger: logging.Logger, max_latencies: int = 1000):
+        self.name = name
+        self.logger = logger
+        self.sequence = itertools.count()
+        self.hop_latencies: Deque[float] = deque(maxlen=max_latencies)  # Seconds, for received messages.
+
+    def stamp(self, data: Message.DataDict) -> Message.DataDict:
+        return data | {TRACE_KEY: {'msg_id': f"{self.name}#{next(self.sequence)}", 'sent_at': time.time()}}
+
+    def sent(self, data: Message.DataDict, size: int) -> None:
+        self.logger.debug(f"Sent {data[TRACE_KEY]['msg_id']} ({self._describe(data)}, {size} bytes)")
+
+    def received(self, data: Message.DataDict, size: int) -> Message.DataDict:
+        """ Log a received message and return it without the trace information. """
+        trace = data.pop(TRACE_KEY, None)
+        if trace is None:
+            self.logger.debug(f"Received untraced message ({self._describe(data)}, {size} bytes)")
+            return data
+
+        latency = time.time() - trace['sent_at']
+        self.hop_latencies.append(latency)
+        self.logger.debug(f"Received {trace['msg_id']} ({self._describe(data)}, {size} bytes) "
+                          f"after {latency * 1000:.2f} ms")
+        return data
+
+    def latency_summary(self) -> Optional[str]:
+        if not self.hop_latencies:
+            return None
+        latencies_ms = sorted(latency * 1000 for latency in self.hop_latencies)
+        return (f"hop latency over last {len(latencies_ms)} messages: mean {statistics.mean(latencies_ms):.2f} ms, "
+                f"median {statistics.median(latencies_ms):.2f} ms, max {latencies_ms[-1]:.2f} ms")
+
+    @staticmethod
+    def _describe(data: Message.DataDict) -> str:
+        return f"status={data.get('status')}, id={data.get('id')}"
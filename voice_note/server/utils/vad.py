@@ -0,0 +1,106 @@
+import numpy as np
+from typing import List, Optional, Tuple
+
+FRAME_SECONDS = 0.03
+SILENCE_RMS = 0.01  # Relative to full scale.
+# Less audio above `SILENCE_RMS` than this is not speech, e.g. a click or a cough.
+MIN_SPEECH_SECONDS = 0.1
+# Kept around speech when silence is trimmed, so soft word onsets and endings are not cut off.
+PADDING_SECONDS = 0.2
+
+
+def int16_to_float(audio_bytes: bytes) -> np.ndarray:
+    return np.frombuffer(audio_bytes, dtype=np.int16).astype(np.float32) / 32768.
+
+
+def frame_rms(samples: np.ndarray, rate: int, frame_seconds: float = FRAME_SECONDS) -> np.ndarray:
+    """ Root mean square of consecutive, non-overlapping frames. A trailing partial frame is ignored. """
+    frame_size = max(1, int(rate * frame_seconds))
+    n_frames = len(samples) // frame_size
+    frames = samples[:n_frames * frame_size].reshape(n_frames, frame_size)
+    return np.sqrt(np.mean(frames ** 2, axis=1))
+
+
+def find_pause(audio_bytes: bytes, rate: int, min_seconds: float = 0., force: bool = False,
+               silence_rms: float = SILENCE_RMS) -> Optional[int]:
+    """ Find a good point to split 16 bit mono audio, i.e. the middle of the quietest frame after `min_seconds`.
+
+    Returns the split point as byte offset, or `None` if there is no frame below `silence_rms` (unless `force` is set).
+    """
+    split = find_pause_in_samples(int16_to_float(audio_bytes), rate, min_seconds, force, silence_rms)
+    return None if split is None else split * 2
+
+
+def find_pause_in_samples(samples: np.ndarray, rate: int, min_seconds: float = 0., force: bool = False,
+                          silence_rms: float = SILENCE_RMS) -> Optional[int]:
+    """ Same as `find_pause` for float samples, returns the split point as sample index. """
+    frame_size = max(1, int(rate * FRAME_SECONDS))
+    rms = frame_rms(samples, rate)
+    first_frame = int(min_seconds * rate) // frame_size
+    if first_frame >= len(rms):
+        return None
+
+    quietest = first_frame + int(np.argmin(rms[first_frame:]))
+    if not force and rms[quietest] >= silence_rms:
+        return None
+    return quietest * frame_size + frame_size // 2
+
+
+def split_at_pauses(samples: np.ndarray, rate: int, max_seconds: float) -> List[Tuple[int, int]]:
+    """ Split float samples into windows of at most `max_seconds`, each ending at the quietest point of its second half.
+    Returns the start and end (sample indices) of the windows. """
+    max_size = int(max_seconds * rate)
+    windows, start = [], 0
+    while len(samples) - start > max_size:
+        split = find_pause_in_samples(samples[start:start + max_size], rate, min_seconds=max_seconds / 2, force=True)
+        windows.append((start, start + split))
+        start += split
+    return windows + [(start, len(samples))]
+
+
+def speech_bounds(samples: np.ndarray, rate: int, silence_rms: float = SILENCE_RMS,
+                  min_speech: float = MIN_SPEECH_SECONDS, padding: float = PADDING_SECONDS) -> Optional[Tuple[int, int]]:
+    """ Start and end (sample indices) of the audio from the first to the last frame above `silence_rms`, with `padding`
+    seconds of the silence around it. `None` if less than `min_speech` seconds are above `silence_rms`. """
+    frame_size = max(1, int(rate * FRAME_SECONDS))
+    voiced = np.flatnonzero(frame_rms(samples, rate) >= silence_rms)
+    if len(voiced) * frame_size < min_speech * rate:
+        return None
+    pad = int(padding * rate)
+    return max(0, voiced[0] * frame_size - pad), min(len(samples), (voiced[-1] + 1) * frame_size + pad)
+
+
+class EndOfSpeechDetector:
+    """ Notices the end of speech in a recording that arrives in fragments of 16 bit mono audio: at least `min_speech`
+    seconds above `silence_rms`, followed by `silence` seconds below it. """
+
+    def __init__(self, rate: int, silence: float, silence_rms: float = SILENCE_RMS,
+                 min_speech: float = MIN_SPEECH_SECONDS):
+        self.rate = rate
+        self.frame_size = max(1, int(rate * FRAME_SECONDS))
+        self.silence_rms = silence_rms
+        self.min_speech_frames = int(np.ceil(min_speech * rate / self.frame_size))
+        self.end_frames = int(np.ceil(silence * rate / self.frame_size))
+        self.leftover = b''  # Incomplete frame
+        self.speech_frames = 0
+        self.silent_frames = 0  # Since the last frame above `silence_rms`
+
+    def add_audio(self, audio_bytes: bytes) -> bool:
+        """ Returns whether speech has ended with `audio_bytes`. """
+        audio_bytes = self.leftover + audio_bytes
+        usable = len(audio_bytes) // (2 * self.frame_size) * 2 * self.frame_size
+        self.leftover = audio_bytes[usable:]
+        for voiced in frame_rms(int16_to_float(audio_bytes[:usable]), self.rate) >= self.silence_rms:
+            if voiced:
+                self.speech_frames += 1
+                self.silent_frames = 0
+            else:
+                self.silent_frames += 1
+        return self.speech_frames >= self.min_speech_frames and self.silent_frames >= self.end_frames
+
+    @property
+    def silence_after_speech(self) -> float:
+        """ Seconds of silence since the last frame of speech, 0 as long as there was not enough speech. """
+        if self.speech_frames < self.min_speech_frames:
+            return 0.
+        return self.silent_frames * self.frame_size / self.rate
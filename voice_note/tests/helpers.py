@@ -0,0 +1,26 @@
+""" Helpers that are shared by several test modules. """
+
+import numpy as np
+
+
+class FakeClock:
+    """ A clock for code that takes one, e.g. `time.monotonic`. The tests set `now`. """
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+RATE = 16000  # Of the test audio
+
+
+def tone(seconds: float) -> bytes:
+    """ 16 bit PCM of a sine tone, which the VAD takes for speech. """
+    t = np.arange(int(seconds * RATE)) / RATE
+    return (np.sin(2 * np.pi * 440 * t) * 10000).astype(np.int16).tobytes()
+
+
+def silence(seconds: float) -> bytes:
+    return np.zeros(int(seconds * RATE), dtype=np.int16).tobytes()
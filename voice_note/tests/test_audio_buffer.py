@@ -0,0 +1,25 @@
+import numpy as np
+
+from server.utils.audio_buffer import AudioBuffer
+
+
+def test_views_stay_valid_when_the_buffer_grows():
+    buffer = AudioBuffer(capacity=16)
+    buffer.append(b"ab")
+    first = buffer.view()
+    for _ in range(3000):
+        buffer.append(b"cd")
+
+    assert bytes(first) == b"ab"
+    assert len(buffer) == 6002
+    assert bytes(buffer.view(2, 6)) == b"cdcd"
+    assert bytes(buffer.view()) == b"ab" + b"cd" * 3000
+
+
+def test_views_are_read_only_and_need_no_copies():
+    buffer = AudioBuffer()
+    buffer.append(np.arange(4, dtype=np.int16).tobytes())
+    view = buffer.view()
+
+    assert view.readonly
+    assert np.frombuffer(view, dtype=np.int16).tolist() == [0, 1, 2, 3]
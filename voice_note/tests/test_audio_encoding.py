@@ -0,0 +1,40 @@
+import numpy as np
+
+from server.utils.audio_encoding import (
+    FLOAT32, MULAW, OPUS, PA_FLOAT32, PA_INT16, PCM16, AudioDecoder, AudioEncoder, choose_encoding, decoded_format,
+    preferred_encodings
+)
+
+RATE = 24_000
+
+
+def speech_like(n_samples):
+    t = np.arange(n_samples) / RATE
+    return (0.3 * np.sin(2 * np.pi * 220 * t) * np.sin(2 * np.pi * 3 * t)).astype(np.float32)
+
+
+def test_choose_encoding_prefers_the_client_order_and_falls_back_to_float32():
+    assert choose_encoding([MULAW, PCM16]) == MULAW
+    assert choose_encoding(["unknown codec", PCM16]) == PCM16
+    assert choose_encoding(None) == FLOAT32
+    assert decoded_format(FLOAT32) == PA_FLOAT32
+    assert decoded_format(MULAW) == PA_INT16
+
+
+def test_clients_prefer_lossless_pcm16_over_mulaw_unless_asked():
+    lossless = [encoding for encoding in preferred_encodings() if encoding != OPUS]
+    assert lossless == [PCM16, FLOAT32]
+    assert [encoding for encoding in preferred_encodings(mulaw=True) if encoding != OPUS] == [MULAW, PCM16, FLOAT32]
+    assert preferred_encodings()[0] in (OPUS, PCM16)
+
+
+def test_encodings_round_trip_within_their_precision():
+    pcm = speech_like(1920)
+    for encoding, bytes_per_sample, tolerance in [(FLOAT32, 4, 0.), (PCM16, 2, 1e-4), (MULAW, 1, 0.02)]:
+        encoded = AudioEncoder(encoding, RATE).encode(pcm)
+        decoded = AudioDecoder.from_config({"encoding": encoding, "rate": RATE, "channels": 1}).decode(encoded)
+
+        assert len(encoded) == len(pcm) * bytes_per_sample
+        dtype = np.float32 if encoding == FLOAT32 else np.int16
+        scale = 1 if encoding == FLOAT32 else 32767
+        assert np.abs(np.frombuffer(decoded, dtype=dtype) / scale - pcm).max() <= tolerance
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+
+import pytest
+
+from server.base_server import BatchingThreadExecutor
+
+
+class RecordingExecutor(BatchingThreadExecutor):
+    def __init__(self, max_batch_size: int, max_wait: float, release: threading.Event = None):
+        super().__init__(max_batch_size, max_wait)
+        self.batches = []
+        self.release = release
+
+    def blocking_fn(self, items):
+        if self.release is not None:
+            self.release.wait()
+        self.batches.append(list(items))
+        return [item.upper() for item in items]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_a_batch_and_get_their_own_results():
+    executor = RecordingExecutor(max_batch_size=8, max_wait=0.05)
+
+    results = await asyncio.gather(*(executor.run(f"session-{idx}") for idx in range(3)))
+
+    assert results == ["SESSION-0", "SESSION-1", "SESSION-2"]
+    assert executor.batches == [["session-0", "session-1", "session-2"]]
+
+
+@pytest.mark.asyncio
+async def test_batches_are_limited_to_max_batch_size():
+    executor = RecordingExecutor(max_batch_size=2, max_wait=0.05)
+
+    results = await asyncio.gather(*(executor.run(f"s{idx}") for idx in range(5)))
+
+    assert results == ["S0", "S1", "S2", "S3", "S4"]
+    assert [len(batch) for batch in executor.batches] == [2, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_request_is_dropped_from_pending_batch():
+    release = threading.Event()
+    executor = RecordingExecutor(max_batch_size=1, max_wait=0., release=release)
+
+    running = asyncio.create_task(executor.run("running"))
+    await asyncio.sleep(0.01)
+    cancelled = asyncio.create_task(executor.run("cancelled"))
+    kept = asyncio.create_task(executor.run("kept"))
+    await asyncio.sleep(0.01)
+    cancelled.cancel()
+    release.set()
+
+    assert await running == "RUNNING"
+    assert await kept == "KEPT"
+    with pytest.raises(asyncio.CancelledError):
+        await cancelled
+    assert executor.batches == [["running"], ["kept"]]
+
+
+@pytest.mark.asyncio
+async def test_errors_are_raised_for_every_request_in_the_batch():
+    class FailingExecutor(BatchingThreadExecutor):
+        def blocking_fn(self, items):
+            raise RuntimeError("model failed")
+
+    executor = FailingExecutor(max_batch_size=4, max_wait=0.01)
+    results = await asyncio.gather(executor.run("a"), executor.run("b"), return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in results)
@@ -0,0 +1,242 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from server.base_server import _current_session
+from server.chat.chat import ChatServer, ChatSession, PiProcessPool, PiRpcClient
+from server.utils.streaming_connection import StreamReset
+
+FAKE_PI = [
+    sys.executable, str(Path(__file__).parents[1] / "benchmarks" / "fake_pi.py"), "--startup", "0", "--reset", "0"
+]
+
+
+class FakePi:
+    """ Answers every prompt with three text deltas. """
+
+    def __init__(self):
+        self.prompts = []
+        self.aborts = 0
+        self.release = asyncio.Event()  # Holds back the end of the response until it is set.
+        self.release.set()
+
+    async def new_session(self):
+        pass
+
+    async def abort(self):
+        self.aborts += 1
+
+    async def prompt(self, message):
+        self.prompts.append(message)
+        for word in ["Sure", ", ", "done."]:
+            await asyncio.sleep(0)
+            yield {"type": "message_update", "assistantMessageEvent": {"type": "text_delta", "delta": word}}
+        await self.release.wait()
+        yield {"type": "agent_end"}
+
+
+class FakeStream:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+
+class FakeTTSStream(FakeStream):
+    """ Ends every utterance as soon as the chat server finishes it. """
+
+    closed = False
+    received_q = []
+
+    def __init__(self):
+        super().__init__()
+        self.answered = 0
+
+    def recv(self):
+        finished = [msg for msg in self.sent if msg["status"] == "FINISHED"]
+        replies = [{"status": "FINISHED", "audio": b"", "id": msg["id"]} for msg in finished[self.answered:]]
+        self.answered = len(finished)
+        return replies
+
+    async def wait_readable(self):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def chat():
+    server = object.__new__(ChatServer)  # Without writing Pi's configuration.
+    session = ChatSession(None, FakePi())
+    session.streams["client"] = FakeStream()
+    _current_session.set(session)
+    return server, session
+
+
+@pytest.mark.asyncio
+async def test_confirmed_speculative_response_is_streamed_without_a_new_prompt(chat):
+    server, session = chat
+
+    await server._run_workload([{"status": "SPECULATIVE", "text": "Hello there", "id": "spec-1"}])
+    await asyncio.sleep(0.01)
+    assert session.streams["client"].sent == []  # Held back until it is confirmed.
+
+    await server._run_workload([{"status": "CONFIRMED", "id": "spec-1"}])
+
+    assert session.pi.prompts == ["Hello there"]
+    assert "".join(msg["text"] for msg in session.streams["client"].sent) == "Sure, done."
+    assert session.streams["client"].sent[-1]["status"] == "FINISHED"
+    assert all(msg["id"] == "spec-1" for msg in session.streams["client"].sent)
+
+
+@pytest.mark.asyncio
+async def test_discarded_speculative_prompt_is_aborted_and_only_the_rest_is_sent(chat):
+    server, session = chat
+    session.pi.release.clear()
+
+    await server._run_workload([{"status": "SPECULATIVE", "text": "What is the weather", "id": "spec-1"}])
+    await asyncio.sleep(0.01)
+    final = asyncio.create_task(server._run_workload([{"text": "What is the weather in Paris?", "id": "req-1"}]))
+    await asyncio.sleep(0.01)
+    session.pi.release.set()
+    await final
+
+    assert session.pi.aborts == 1
+    assert session.pi.prompts == ["What is the weather", "in Paris?"]
+    assert {msg["id"] for msg in session.streams["client"].sent} == {"req-1"}
+
+    await server._run_workload([{"text": "Thanks", "id": "req-2"}])
+    assert session.pi.prompts[-1] == "Thanks"
+
+
+@pytest.mark.asyncio
+async def test_audio_encodings_are_sent_to_tts_once_per_request_also_with_error_replies(chat):
+    server, session = chat
+    session.streams["tts"] = FakeTTSStream()
+
+    await server._run_workload([{"text": "Hello there", "id": "req-1", "audio_encodings": ["pcm16"]}])
+    await server._run_workload([{"status": "CONFIRMED", "id": "unknown"}])  # Answered with an error reply.
+
+    sent = session.streams["tts"].sent
+    assert [msg["id"] for msg in sent if "audio_encodings" in msg] == ["req-1", "unknown"]
+    assert all(msg["audio_encodings"] == ["pcm16"] for msg in sent if "audio_encodings" in msg)
+    assert sent[0]["text"] == "Sure" and sent[-2]["text"] == "Sorry, I ran into an error."
+
+
+@pytest.mark.asyncio
+async def test_pool_hands_out_started_processes_and_recycles_them():
+    pool = PiProcessPool(FAKE_PI, ".", size=1)
+    pool.warm_up()
+    while not pool.ready:
+        await asyncio.sleep(0.01)
+
+    pi = pool.take()
+    assert pi.process is not None and pi.process.returncode is None  # Started before it was needed.
+    assert pool.starting == 1  # Its replacement.
+    while pool.starting:
+        await asyncio.sleep(0.01)
+
+    pool.recycle(pi)  # The pool is full with the replacement, so it is closed instead.
+    while pool.tasks:
+        await asyncio.sleep(0.01)
+    assert len(pool.ready) == 1 and pool.ready[0] is not pi and pi.process is None
+
+    ready = pool.ready[0]
+    await pool.close()
+    assert ready.process is None and not pool.ready
+
+
+class TimedStream:
+    """ A client stream that notes when text arrives and, like after a reset, rejects messages with a stale id. """
+
+    def __init__(self, communication_id):
+        self.communication_id = communication_id
+        self.texts = []
+
+    def send(self, data):
+        if data["id"] != self.communication_id:
+            raise StreamReset("Invalid message ID", self.communication_id)
+        if data.get("text"):
+            self.texts.append((time.perf_counter(), data["id"], data["text"]))
+
+
+async def first_text(stream, request_id):
+    while not any(id_ == request_id for _, id_, _ in stream.texts):
+        await asyncio.sleep(0.001)
+    return next(sent for sent, id_, _ in stream.texts if id_ == request_id)
+
+
+@pytest.mark.asyncio
+async def test_reset_to_next_first_token_does_not_wait_for_the_interrupted_response():
+    # A long response: 200 tokens take 4 s.
+    pi = PiRpcClient(FAKE_PI + ["--first-token", "0.05", "--token-interval", "0.02", "--tokens", "200"], ".")
+    server = object.__new__(ChatServer)
+    session = ChatSession(None, pi)
+    stream = session.streams["client"] = TimedStream("req-1")
+    _current_session.set(session)
+    try:
+        interrupted = asyncio.create_task(server._run_workload([{"text": "one", "id": "req-1"}]))
+        await first_text(stream, "req-1")
+
+        reset = time.perf_counter()
+        stream.communication_id = "req-2"  # The next message for "req-1" raises `StreamReset`.
+        with pytest.raises(StreamReset):
+            await interrupted
+        next_response = asyncio.create_task(server._run_workload([{"text": "two", "id": "req-2"}]))
+        latency = await first_text(stream, "req-2") - reset
+
+        assert latency < 0.5  # The first token itself takes 0.05 s.
+        assert all(text.startswith("two:") for _, id_, text in stream.texts if id_ == "req-2")
+        next_response.cancel()
+        await asyncio.gather(next_response, return_exceptions=True)
+    finally:
+        await pi.close()
+
+
+@pytest.mark.asyncio
+async def test_abort_does_not_wait_for_the_running_prompt():
+    pi = PiRpcClient(FAKE_PI + ["--first-token", "0.05", "--token-interval", "0.02", "--tokens", "200"], ".")
+    try:
+        interrupted = pi.prompt("one")  # Kept, like an `async for` loop that is stuck elsewhere.
+        while not ChatServer._extract_text_delta(await interrupted.__anext__()):
+            pass
+
+        reset = time.perf_counter()
+        await asyncio.wait_for(pi.abort(), 1.)
+        async for event in pi.prompt("two"):
+            if text := ChatServer._extract_text_delta(event):
+                break
+        latency = time.perf_counter() - reset
+
+        assert text.startswith("two:")
+        assert latency < 0.5  # The first token itself takes 0.05 s.
+        await pi.abort()
+    finally:
+        await pi.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("command", ["prompt", "new_session"])
+async def test_pi_that_does_not_stop_after_an_abort_is_restarted(monkeypatch, command):
+    monkeypatch.setattr("server.chat.chat.ABORT_TIMEOUT", 0.2)
+    hanging_pi = FAKE_PI + ["--ignore-abort", "--first-token", "0", "--token-interval", "0.01", "--tokens", "50"]
+    pi = PiRpcClient(hanging_pi, ".")
+    try:
+        interrupted = pi.prompt("one")
+        while not ChatServer._extract_text_delta(await interrupted.__anext__()):
+            pass
+        hung = pi.process
+        await pi.abort()
+
+        if command == "new_session":
+            await pi.new_session()  # Not while the aborted response is still running.
+            assert pi.process is not hung
+        texts = [ChatServer._extract_text_delta(event) async for event in pi.prompt("two")]
+
+        assert pi.process is not hung and hung.returncode is not None
+        assert len([text for text in texts if text]) == 50
+        assert all(text.startswith("two:") for text in texts if text)
+    finally:
+        await pi.close()
@@ -0,0 +1,44 @@
+import numpy as np
+
+from server.tts.coalescing import FrameCoalescer
+from tests.helpers import FakeClock
+
+
+def frame(size=10):
+    return np.ones(size, dtype=np.float32)
+
+
+def test_frames_are_sent_right_away_while_the_client_has_little_audio():
+    clock = FakeClock()
+    coalescer = FrameCoalescer(rate=100, target=0.3, clock=clock)  # 10 samples are 0.1 s.
+
+    assert len(coalescer.add(frame())) == 10  # The first frame.
+    clock.now = 0.01
+    assert len(coalescer.add(frame())) == 10  # The client has only 0.09 s left to play.
+
+
+def test_frames_are_held_back_while_the_client_has_enough_audio():
+    clock = FakeClock()
+    coalescer = FrameCoalescer(rate=100, target=0.3, clock=clock)
+
+    coalescer.add(frame(50))  # 0.5 s buffered.
+    assert coalescer.add(frame()) is None
+    assert coalescer.add(frame()) is None
+    assert coalescer.time_until_flush() == 0.2
+    clock.now = 0.15
+    assert coalescer.poll() is None
+    assert len(coalescer.add(frame())) == 30  # The target is reached.
+    assert coalescer.time_until_flush() is None
+
+
+def test_pending_audio_is_released_when_the_client_runs_low():
+    clock = FakeClock()
+    coalescer = FrameCoalescer(rate=100, target=0.3, clock=clock)
+
+    coalescer.add(frame(50))
+    coalescer.add(frame())
+    clock.now = 0.2
+    assert len(coalescer.poll()) == 10
+    coalescer.add(frame())
+    assert len(coalescer.flush()) == 10  # At the end of the utterance.
+    assert coalescer.flush() is None
@@ -0,0 +1,25 @@
+import pytest
+
+pytest.importorskip("pyaudio")
+
+from server.utils.audio import AudioConfig  # noqa: E402
+from server.utils.conversation import Conversation  # noqa: E402
+from server.utils.persistence import PersistenceWriter  # noqa: E402
+
+
+async def test_conversation_directory_is_created_with_the_first_turn(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    writer = PersistenceWriter()
+    unused = Conversation(writer)
+    unused.close()
+    await writer.flush()
+    assert not (tmp_path / "outputs").exists()
+    assert unused.get_save_path() is None
+
+    conversation = Conversation(writer)
+    conversation.add_turn("Hello", b"\x00\x00", AudioConfig(format=8, channels=1, rate=16000))
+    conversation.close()
+    writer.close()
+    assert sorted(path.name for path in (tmp_path / conversation.get_save_path()).iterdir()) == [
+        "conversation.json", "events.jsonl", "user_audio_0.wav"
+    ]
@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+from server.utils.incremental_transcription import IncrementalTranscription
+from server.utils.vad import find_pause
+from tests.helpers import RATE, silence, tone
+
+
+def test_find_pause_splits_inside_silence():
+    audio = tone(1.) + silence(.5) + tone(1.)
+
+    split = find_pause(audio, RATE)
+
+    assert 2 * RATE <= split <= 2 * int(1.5 * RATE)
+    assert find_pause(tone(2.), RATE) is None
+    assert find_pause(tone(2.), RATE, force=True) is not None
+
+
+@pytest.mark.asyncio
+async def test_incremental_transcription_transcribes_windows_before_finish():
+    windows = []
+
+    async def transcribe(audio_bytes):
+        windows.append(audio_bytes)
+        return f"window-{len(windows)}"
+
+    incremental = IncrementalTranscription("req-1", RATE, transcribe, min_window=2., max_window=4.)
+    chunks = [tone(1.5), silence(.5), tone(1.5), silence(.5), tone(1.)]
+    for chunk in chunks:
+        incremental.add_audio(chunk)
+    await asyncio.sleep(0)
+
+    assert len(windows) >= 1  # Transcribed while recording.
+    assert await incremental.finish() == " ".join(f"window-{idx + 1}" for idx in range(len(windows)))
+    assert b"".join(windows) == b"".join(chunks) == incremental.get_audio_bytes()
+    assert all(len(window) <= 4 * 2 * RATE for window in windows)
+
+
+@pytest.mark.asyncio
+async def test_incremental_transcription_forces_split_at_max_window():
+    windows = []
+
+    async def transcribe(audio_bytes):
+        windows.append(audio_bytes)
+        return "text"
+
+    incremental = IncrementalTranscription("req-1", RATE, transcribe, min_window=1., max_window=2.)
+    for _ in range(5):
+        incremental.add_audio(tone(1.))
+    await incremental.finish()
+
+    assert len(windows) >= 3
+    assert all(len(window) <= 2 * 2 * RATE for window in windows)
+
+
+@pytest.mark.asyncio
+async def test_transcribe_pending_splits_at_the_current_end():
+    windows = []
+
+    async def transcribe(audio_bytes):
+        windows.append(bytes(audio_bytes))
+        return f"window-{len(windows)}"
+
+    incremental = IncrementalTranscription("req-1", RATE, transcribe, min_window=5., max_window=10.)
+    incremental.add_audio(tone(1.) + silence(.5))
+
+    assert await incremental.transcribe_pending() == "window-1"
+    assert windows == [tone(1.) + silence(.5)]
+
+    incremental.add_audio(tone(1.))
+    assert await incremental.finish() == "window-1 window-2"
+    assert windows[1] == tone(1.)
@@ -0,0 +1,31 @@
+from server.utils.message import Message
+
+
+PAYLOAD = {
+    "id": "req-1",
+    "status": "GENERATING",
+    "audio": b"\x00\x01" * 100,
+    "config": {"format": 8, "channels": 1, "rate": 16000},
+    "nested": {"empty": b"", "bytes": b"abc"},
+}
+
+
+def test_binary_encoding_roundtrips_nested_bytes():
+    encoded = Message(PAYLOAD).encode_binary()
+
+    assert isinstance(encoded, bytes)
+    assert Message.from_frame(encoded).data == PAYLOAD
+
+
+def test_binary_encoding_carries_raw_payload_without_base64_overhead():
+    binary = Message(PAYLOAD).encode_binary()
+    text = Message(PAYLOAD).encode()
+
+    assert PAYLOAD["audio"] in binary
+    assert len(binary) < len(text.encode())
+
+
+def test_text_frames_still_decode_as_json():
+    assert Message.from_frame(Message(PAYLOAD).encode()).data == PAYLOAD
+    assert not Message({"id": "req-1", "text": "hi"}).has_bytes()
+    assert Message(PAYLOAD).has_bytes()
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+
+from server.utils.persistence import PersistenceWriter
+
+
+def test_writer_runs_tasks_in_order_and_flushes_on_close(tmp_path):
+    writer = PersistenceWriter()
+    log_file = open(tmp_path / "log.txt", "w")
+
+    def write(line):
+        log_file.write(line)
+        return log_file
+
+    for idx in range(1000):
+        writer.submit(write, f"{idx}\n")
+    writer.close()
+
+    assert (tmp_path / "log.txt").read_text() == "".join(f"{idx}\n" for idx in range(1000))
+    assert not writer.thread.is_alive()
+    log_file.close()
+
+
+async def test_writer_survives_failing_tasks(tmp_path):
+    writer = PersistenceWriter()
+    results = []
+
+    def fail():
+        raise OSError("disk full")
+
+    writer.submit(fail)
+    writer.submit(results.append, "after failure")
+    await writer.flush()
+    assert results == ["after failure"]
+    writer.close()
+
+
+async def test_submit_does_not_block_and_drops_bulk_writes_while_the_disk_falls_behind():
+    writer = PersistenceWriter(max_pending=2)
+    release = threading.Event()
+    results = []
+
+    writer.submit(release.wait)
+    await asyncio.sleep(0.05)  # The writer thread is stuck in `release.wait` now.
+    for idx in range(5):
+        writer.submit(results.append, idx, droppable=True)
+    writer.submit(results.append, "not droppable")  # E.g. closing a file, is queued although the queue is full.
+    release.set()
+    await writer.flush()
+    writer.submit(results.append, 5, droppable=True)  # The writer caught up.
+    await writer.flush()
+
+    assert results == [0, 1, "not droppable", 5]
+    assert writer.dropped == 3
+    writer.close()
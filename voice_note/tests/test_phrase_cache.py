@@ -0,0 +1,66 @@
+from server.tts.phrase_cache import PhraseCache
+
+
+def test_lookup_is_normalized_and_counts_hits():
+    cache = PhraseCache("voice", ["Sorry, I ran into an error."])
+    cache.put("Sorry, I ran into an error.", [b"ab", b"cd"])
+
+    assert cache.may_complete("sorry, I  ran")
+    assert not cache.may_complete("Sorry, I ran out")
+    assert not cache.may_complete("")
+    assert cache.get_leading("  SORRY, I ran into an error.\n", complete=True) == ([b"ab", b"cd"], "\n")
+    assert cache.get_leading("Sorry, I ran into an error", complete=True) is None  # Punctuation changes the prosody.
+    assert cache.hits == 1 and cache.misses == 1 and cache.hit_rate == 0.5
+
+
+def test_only_the_given_phrases_are_cached():
+    cache = PhraseCache("voice", ["One moment, please."])
+    cache.put("Paris is the capital of France.", [b"ef"])
+    cache.put("One moment, please.", [b"gh"])
+
+    assert list(cache.entries) == ["one moment, please."]
+    assert cache.max_words == 3
+
+
+def test_phrase_is_found_at_the_start_of_a_longer_utterance():
+    cache = PhraseCache("voice", ["Let me think.", "Let me think about that."])
+    cache.put("Let me think.", [b"short"])
+    cache.put("Let me think about that.", [b"long"])
+
+    assert cache.get_leading("Let me think about that. The answer is") == ([b"long"], " The answer is")
+    assert cache.get_leading("Let me think. Hm") == ([b"short"], " Hm")
+    # The last word may still grow into another one.
+    assert cache.get_leading("Let me think.") is None
+    assert cache.get_leading("Let me think.", complete=True) == ([b"short"], "")
+    assert cache.get_leading("Paris is the capital.", complete=True) is None
+
+
+def test_least_recently_used_phrases_are_evicted():
+    cache = PhraseCache("voice", ["one", "two", "three", "too big"], max_bytes=8)
+    cache.put("one", [b"1111"])
+    cache.put("two", [b"2222"])
+    cache.get_leading("one", complete=True)
+    cache.put("three", [b"3333"])
+
+    assert list(cache.entries) == ["one", "three"]
+    assert cache.nbytes == 8
+    cache.put("too big", [b"123456789"])
+    assert "too big" not in cache.entries
+
+
+def test_phrases_are_persisted_per_voice(tmp_path):
+    cache = PhraseCache("voice", ["one", "two", "three"], max_bytes=8, directory=tmp_path)
+    cache.put("one", [b"11", b"11"])
+    cache.put("two", [b"2222"])
+    cache.put("three", [b"3333"])  # Evicts "one", also on disk.
+    cache.close()
+
+    reloaded = PhraseCache("voice", ["one", "two", "three"], directory=tmp_path)
+    assert reloaded.entries == {"two": [b"2222"], "three": [b"3333"]}
+    reloaded.close()
+    not_a_phrase_anymore = PhraseCache("voice", ["three"], directory=tmp_path)
+    assert not_a_phrase_anymore.entries == {"three": [b"3333"]}
+    not_a_phrase_anymore.close()
+    other_voice = PhraseCache("other voice", ["one", "two", "three"], directory=tmp_path)
+    assert other_voice.entries == {}
+    other_voice.close()
@@ -0,0 +1,104 @@
+import threading
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torchaudio")
+pytest.importorskip("transformers")
+
+import torch  # noqa: E402
+from torchaudio.transforms import Resample  # noqa: E402
+
+from server.utils.audio import AudioConfig  # noqa: E402
+from server.utils.sample import Sample, StreamingResampler, get_resampler, to_float  # noqa: E402
+
+
+@pytest.mark.parametrize("rate", [48_000, 44_100, 16_000])
+def test_streaming_resampler_matches_resampling_at_once(rate):
+    audio = torch.from_numpy(np.random.default_rng(0).uniform(-1, 1, rate * 2 + 123).astype(np.float32))
+    resampler = StreamingResampler(rate)
+    # Fragments of different sizes, also shorter than the kernel.
+    bounds = [0, 1, 50, 4_000, 4_100, 30_000, len(audio)]
+    output = [resampler.process(audio[start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+    output = torch.cat(output + [resampler.flush()])
+
+    expected = Resample(rate, 16_000)(audio)
+    assert output.shape == expected.shape
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_resamplers_are_shared_and_bytes_are_converted_in_place():
+    assert get_resampler(48_000) is get_resampler(48_000)
+
+    pcm = np.array([0, 16_384, -32_768], dtype=np.int16)
+    assert to_float(pcm.tobytes()).tolist() == [0., 0.5, -1.]
+
+
+def test_fragments_are_resampled_off_the_calling_thread():
+    rate = 48_000
+    audio = np.random.default_rng(0).integers(-32_768, 32_768, rate * 3 + 480, dtype=np.int16)
+    sample = Sample(fragments=[], audio_config=AudioConfig(format=8, channels=1, rate=rate))
+    process, threads = sample.resampler.process, set()
+
+    def recording_process(data):
+        threads.add(threading.current_thread())
+        return process(data)
+
+    sample.resampler.process = recording_process
+    for start in range(0, len(audio), 4_800):
+        sample.add_fragment(audio[start:start + 4_800].tobytes())
+    assert threading.current_thread() not in threads  # Only complete blocks so far.
+
+    expected = Resample(rate, 16_000)(to_float(audio.tobytes()))
+    assert torch.allclose(sample.audio_data, expected, atol=1e-5)
+
+
+def test_samples_without_speech_are_not_transcribed():
+    silent = Sample(fragments=[bytes(2 * 48_000)], audio_config=AudioConfig(format=8, channels=1, rate=48_000))
+
+    Sample.transcribe_batch([silent], model=None, processor=None)  # Fails if the model is called.
+
+    assert silent.result == ""
+
+
+class FakeProcessor:
+    """ Passes the window lengths through the "model" and decodes them as text. """
+
+    def __call__(self, audio, sampling_rate, return_tensors):
+        assert sampling_rate == 16_000
+        return types.SimpleNamespace(input_features=torch.tensor([[len(window)] for window in audio]))
+
+    def batch_decode(self, pred_ids, skip_special_tokens):
+        return [f"{int(ids[0]) / 16_000:.1f}s" for ids in pred_ids]
+
+
+class FakeModel:
+    device, dtype = "cpu", torch.float32
+
+    def __init__(self):
+        self.calls = 0
+
+    def generate(self, input_features, language):
+        self.calls += 1
+        return input_features
+
+
+def test_long_samples_are_split_into_windows_and_transcribed_together():
+    rate = 16_000
+    config = AudioConfig(format=8, channels=1, rate=rate)
+    t = np.arange(rate * 20) / rate
+    speech = (np.sin(2 * np.pi * 300 * t) * 8000).astype(np.int16).tobytes()
+    pause = bytes(2 * rate)
+    long_sample = Sample(fragments=[pause, speech, pause, speech, pause, speech], audio_config=config)  # 63 s
+    short_sample = Sample(fragments=[speech[:2 * rate * 5]], audio_config=config)
+    model = FakeModel()
+
+    Sample.transcribe_batch([long_sample, short_sample], model, FakeProcessor())
+
+    assert model.calls == 1
+    assert len(long_sample.segments) == 3
+    assert all(float(text[:-1]) <= 30. for _, text in long_sample.segments)
+    assert [round(start) for start, _ in long_sample.segments] == [1, 21, 42]  # Starts in the recording.
+    assert long_sample.result == " ".join(text for _, text in long_sample.segments)
+    assert short_sample.result == "5.0s"
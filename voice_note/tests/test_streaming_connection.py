@@ -6,7 +6,10 @@ import pytest
 import websockets
 
 from server.base_server import BaseServer
-from server.utils.message import Message
+from server.utils import connection_pool
+from server.utils.connection_pool import connect_with_backoff
+from server.utils.message import BINARY_SUBPROTOCOL, Message
+from server.utils.multiplexing import MUX_SUBPROTOCOL, MultiplexedConnection
 from server.utils.streaming_connection import POLL_INTERVAL, StreamReset, StreamingConnection
 
 
@@ -205,6 +208,21 @@ class ClosingResponderServer(BaseServer):
         await self.streams["client"].close()
 
 
+class StalledServer(BaseServer):
+    """ Takes requests, but never answers them. """
+
+    def __init__(self, host: str, port: int):
+        super().__init__("stalled", host, port)
+        self.requests = []
+
+    def _get_cutoff_idx(self, received):
+        return int(bool(received))
+
+    async def _run_workload(self, received):
+        self.requests.append(received[0]["id"])
+        await asyncio.Future()
+
+
 class ForwardingServer(BaseServer):
     def __init__(self, host: str, port: int, downstream_uri: str):
         super().__init__("forwarding", host, port)
@@ -495,3 +513,294 @@ async def test_client_disconnect_or_closed_stream_ends_session_cleanly():
             await close_stream(client_connection, client_task)
         await stop_task(main_task)
         await stop_task(leaf_task)
+
+
+@pytest.mark.asyncio
+async def test_send_threadsafe_and_wait_readable_deliver_without_polling():
+    port = get_free_port()
+    server_ready = asyncio.Event()
+    server_connections = []
+
+    async def server_handler(websocket):
+        connection = StreamingConnection("server_threadsafe", websocket)
+        run_task = asyncio.create_task(connection.run())
+        server_connections.append(connection)
+        server_ready.set()
+        with contextlib.suppress(asyncio.CancelledError):
+            await run_task
+
+    server = await websockets.serve(server_handler, HOST, port)
+    client_connection = None
+    client_task = None
+    try:
+        client_connection, client_task = await open_stream(f"ws://{HOST}:{port}", "client_threadsafe")
+        await server_ready.wait()
+        server_connection = server_connections[0]
+
+        # Nothing was sent yet, so waiting has to run into the timeout.
+        await server_connection.wait_readable(timeout=POLL_INTERVAL)
+        assert server_connection.recv() == []
+
+        client_connection.reset("req-1")
+        await asyncio.to_thread(
+            client_connection.send_threadsafe, {"id": "req-1", "audio": b"\x01\x02", "status": "RECORDING"}
+        )
+        await asyncio.wait_for(server_connection.wait_readable(), timeout=TIMEOUT)
+        assert server_connection.recv() == [{"id": "req-1", "audio": b"\x01\x02", "status": "RECORDING"}]
+
+        with pytest.raises(StreamReset):
+            await asyncio.to_thread(client_connection.send_threadsafe, {"id": "stale", "status": "RECORDING"})
+
+        # Closing the connection wakes up waiting readers.
+        waiter = asyncio.create_task(client_connection.wait_readable())
+        await server_connection.close()
+        await asyncio.wait_for(waiter, timeout=TIMEOUT)
+        assert client_connection.closed
+    finally:
+        if client_connection is not None and client_task is not None:
+            await close_stream(client_connection, client_task)
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_binary_framing_is_negotiated_per_connection():
+    port = get_free_port()
+    server = LatestWinsServer(HOST, port)
+    server_task = await start_server(server)
+
+    binary_connection = json_connection = None
+    binary_task = json_task = None
+    try:
+        websocket = await websockets.connect(f"ws://{HOST}:{port}", subprotocols=[BINARY_SUBPROTOCOL])
+        binary_connection = StreamingConnection("binary_client", websocket)
+        binary_task = asyncio.create_task(binary_connection.run())
+        assert binary_connection.binary
+
+        binary_connection.send({"id": "req-1", "audio": b"\x00\x01", "text": "binary", "status": "FINISHED"})
+        messages = await collect_messages(binary_connection, lambda msgs: len(msgs) == 1)
+        assert server.completed_requests == [("req-1", "binary")]
+        assert messages == [{"id": "req-1", "text": "binary", "status": "FINISHED"}]
+        await close_stream(binary_connection, binary_task)
+        binary_connection = None
+
+        # Clients that do not offer the subprotocol keep using JSON.
+        json_connection, json_task = await open_stream(f"ws://{HOST}:{port}", "json_client")
+        assert not json_connection.binary
+        json_connection.send({"id": "req-2", "audio": b"\x02", "text": "json", "status": "FINISHED"})
+        messages = await collect_messages(json_connection, lambda msgs: len(msgs) == 1)
+        assert server.completed_requests[-1] == ("req-2", "json")
+    finally:
+        if binary_connection is not None and binary_task is not None:
+            await close_stream(binary_connection, binary_task)
+        if json_connection is not None and json_task is not None:
+            await close_stream(json_connection, json_task)
+        await stop_task(server_task)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_clients_get_isolated_sessions_through_fake_pipeline():
+    n_clients = 10
+    tts_port = get_free_port()
+    chat_port = get_free_port()
+    ingress_port = get_free_port()
+    tts_server = TTSLikeServer(HOST, tts_port)
+    chat_server = ChatLikeServer(HOST, chat_port, f"ws://{HOST}:{tts_port}")
+    ingress_server = CollectingIngressServer(HOST, ingress_port, f"ws://{HOST}:{chat_port}")
+
+    tts_task = await start_server(tts_server)
+    chat_task = await start_server(chat_server)
+    ingress_task = await start_server(ingress_server)
+
+    clients = []
+    try:
+        for idx in range(n_clients):
+            clients.append(await open_stream(f"ws://{HOST}:{ingress_port}", f"load_client_{idx}"))
+        await wait_for(lambda: len(ingress_server.sessions) == n_clients)
+
+        for idx, (connection, _) in enumerate(clients):
+            connection.send({"id": f"req-{idx}", "text": f"client {idx} ", "status": "GENERATING"})
+            connection.send({"id": f"req-{idx}", "text": "says hello", "status": "FINISHED"})
+
+        all_messages = await asyncio.gather(*(
+            collect_messages(connection, lambda msgs: any(msg["status"] == "FINISHED" for msg in msgs), timeout=8.0)
+            for connection, _ in clients
+        ))
+
+        for idx, messages in enumerate(all_messages):
+            assert {msg["id"] for msg in messages} == {f"req-{idx}"}
+            assert b"".join(msg["audio"] for msg in messages) == f"CLIENT {idx} SAYS HELLO".encode()
+        assert sorted(ingress_server.completed_requests) == sorted(
+            (f"req-{idx}", f"client {idx} says hello") for idx in range(n_clients)
+        )
+        # Every client connection got its own downstream session, all carried over one connection per server pair.
+        assert len(chat_server.sessions) == n_clients
+        assert len(tts_server.sessions) == n_clients
+        assert list(ingress_server.pool.connections) == [f"ws://{HOST}:{chat_port}"]
+        assert list(chat_server.pool.connections) == [f"ws://{HOST}:{tts_port}"]
+    finally:
+        for connection, run_task in clients:
+            await close_stream(connection, run_task)
+        await stop_task(ingress_task)
+        await stop_task(chat_task)
+        await stop_task(tts_task)
+
+
+@pytest.mark.asyncio
+async def test_multiplexed_channels_reset_and_close_independently():
+    port = get_free_port()
+    server_channels = []
+
+    async def server_handler(websocket):
+        def on_channel(channel):
+            connection = StreamingConnection(f"server_channel_{channel.channel_id}", channel)
+            server_channels.append((connection, asyncio.create_task(connection.run())))
+
+        await MultiplexedConnection(websocket, on_channel).run()
+
+    server = await websockets.serve(server_handler, HOST, port, select_subprotocol=BaseServer._select_subprotocol)
+    mux_task = None
+    try:
+        websocket = await websockets.connect(f"ws://{HOST}:{port}", subprotocols=[MUX_SUBPROTOCOL])
+        assert websocket.subprotocol == MUX_SUBPROTOCOL
+        mux = MultiplexedConnection(websocket)
+        mux_task = asyncio.create_task(mux.run())
+        first = StreamingConnection("channel_first", mux.open_channel())
+        second = StreamingConnection("channel_second", mux.open_channel())
+        first_task = asyncio.create_task(first.run())
+        second_task = asyncio.create_task(second.run())
+
+        first.send({"id": "a-1", "audio": b"\x01", "status": "RECORDING"})
+        second.send({"id": "b-1", "text": "hello", "status": "RECORDING"})
+        await wait_for(lambda: len(server_channels) == 2)
+        (server_first, _), (server_second, _) = server_channels
+        assert await collect_messages(server_first, lambda msgs: len(msgs) == 1) == [
+            {"id": "a-1", "audio": b"\x01", "status": "RECORDING"}
+        ]
+
+        # A reset only affects its own channel.
+        first.reset("a-2")
+        await wait_for(lambda: server_first.communication_id == "a-2")
+        assert server_second.communication_id is None
+        assert await collect_messages(server_second, lambda msgs: len(msgs) == 1) == [
+            {"id": "b-1", "text": "hello", "status": "RECORDING"}
+        ]
+
+        await first.close()
+        await wait_for(lambda: server_first.closed)
+        assert not server_second.closed
+        second.send({"id": "b-1", "text": "still open", "status": "FINISHED"})
+        assert (await collect_messages(server_second, lambda msgs: len(msgs) == 1))[0]["text"] == "still open"
+
+        await mux.close()
+        await wait_for(lambda: second.closed and server_second.closed)
+        await asyncio.gather(first_task, second_task)
+    finally:
+        if mux_task is not None:
+            await stop_task(mux_task)
+        for _, task in server_channels:
+            await stop_task(task)
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_session_survives_downstream_restart():
+    tts_port = get_free_port()
+    chat_port = get_free_port()
+    ingress_port = get_free_port()
+    tts_task = await start_server(TTSLikeServer(HOST, tts_port))
+    chat_task = await start_server(ChatLikeServer(HOST, chat_port, f"ws://{HOST}:{tts_port}"))
+    ingress_server = CollectingIngressServer(HOST, ingress_port, f"ws://{HOST}:{chat_port}")
+    ingress_task = await start_server(ingress_server)
+
+    client_connection = None
+    client_task = None
+    try:
+        client_connection, client_task = await open_stream(f"ws://{HOST}:{ingress_port}", "restart_client")
+        client_connection.reset("req-1")
+        client_connection.send({"id": "req-1", "text": "before", "status": "FINISHED"})
+        messages = await collect_messages(client_connection, lambda msgs: any(m["status"] == "FINISHED" for m in msgs))
+        assert b"".join(msg["audio"] for msg in messages) == b"BEFORE"
+
+        await stop_task(chat_task)
+        chat_task = await start_server(ChatLikeServer(HOST, chat_port, f"ws://{HOST}:{tts_port}"))
+
+        client_connection.reset("req-2")
+        client_connection.send({"id": "req-2", "text": "after", "status": "FINISHED"})
+        messages = await collect_messages(
+            client_connection, lambda msgs: any(m["status"] == "FINISHED" for m in msgs), timeout=4.0
+        )
+        assert b"".join(msg["audio"] for msg in messages) == b"AFTER"
+        assert not client_connection.closed
+    finally:
+        if client_connection is not None and client_task is not None:
+            await close_stream(client_connection, client_task)
+        await stop_task(ingress_task)
+        await stop_task(chat_task)
+        await stop_task(tts_task)
+
+
+@pytest.mark.asyncio
+async def test_request_in_flight_during_downstream_restart_ends_and_session_goes_on():
+    tts_port = get_free_port()
+    chat_port = get_free_port()
+    ingress_port = get_free_port()
+    tts_task = await start_server(TTSLikeServer(HOST, tts_port))
+    stalled_server = StalledServer(HOST, chat_port)
+    chat_task = await start_server(stalled_server)
+    ingress_task = await start_server(CollectingIngressServer(HOST, ingress_port, f"ws://{HOST}:{chat_port}"))
+
+    client_connection = None
+    client_task = None
+    try:
+        client_connection, client_task = await open_stream(f"ws://{HOST}:{ingress_port}", "mid_request_client")
+        client_connection.reset("req-1")
+        client_connection.send({"id": "req-1", "text": "lost", "status": "FINISHED"})
+        await wait_for(lambda: stalled_server.requests == ["req-1"])
+
+        await stop_task(chat_task)
+        chat_task = await start_server(ChatLikeServer(HOST, chat_port, f"ws://{HOST}:{tts_port}"))
+        messages = await collect_messages(client_connection, lambda msgs: any(m["status"] == "FINISHED" for m in msgs))
+        assert messages == [{"id": "req-1", "text": "", "status": "FINISHED"}]
+
+        client_connection.reset("req-2")
+        client_connection.send({"id": "req-2", "text": "after", "status": "FINISHED"})
+        messages = await collect_messages(
+            client_connection, lambda msgs: any(m["status"] == "FINISHED" for m in msgs), timeout=4.0
+        )
+        assert b"".join(msg["audio"] for msg in messages) == b"AFTER"
+        assert not client_connection.closed
+    finally:
+        if client_connection is not None and client_task is not None:
+            await close_stream(client_connection, client_task)
+        await stop_task(ingress_task)
+        await stop_task(chat_task)
+        await stop_task(tts_task)
+
+
+@pytest.mark.asyncio
+async def test_connect_with_backoff_waits_for_server_without_spinning(monkeypatch):
+    port = get_free_port()
+    attempts = 0
+    original_connect = websockets.connect
+
+    def counting_connect(*args, **kwargs):
+        nonlocal attempts
+        attempts += 1
+        return original_connect(*args, **kwargs)
+
+    monkeypatch.setattr(connection_pool.websockets, "connect", counting_connect)
+    connect_task = asyncio.create_task(connect_with_backoff(f"ws://{HOST}:{port}", [BINARY_SUBPROTOCOL]))
+    await asyncio.sleep(0.5)
+    assert not connect_task.done()
+    # Polling every 5 ms would have taken about 100 attempts.
+    assert attempts < 15
+
+    server = await websockets.serve(lambda websocket: websocket.wait_closed(), HOST, port)
+    try:
+        connection = await asyncio.wait_for(connect_task, timeout=4.0)
+        await connection.close()
+    finally:
+        server.close()
+        await server.wait_closed()
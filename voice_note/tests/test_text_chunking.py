@@ -0,0 +1,70 @@
+from server.utils.text_chunking import TextChunker
+from tests.helpers import FakeClock
+
+
+def chunk_stream(chunker, pieces):
+    chunks = []
+    for piece in pieces:
+        chunks += chunker.add(piece)
+    return chunks + chunker.flush()
+
+
+def test_chunks_end_at_sentence_boundaries():
+    chunker = TextChunker(min_words=3, max_words=15, deadline=10.)
+    text = "Hello there! How are you doing today? Fine. I hope you are well."
+    pieces = [text[idx:idx + 4] for idx in range(0, len(text), 4)]  # Splits inside words.
+
+    assert chunk_stream(chunker, pieces) == [
+        "Hello there! How are you doing today?",  # "Hello there!" is shorter than `min_words`.
+        "Fine. I hope you are well.",
+    ]
+
+
+def test_abbreviations_numbers_and_list_items_do_not_end_sentences():
+    chunker = TextChunker(min_words=2, max_words=30, deadline=10.)
+    text = "Dr. Smith said the U.S. economy grew 3.5 percent, e.g. in 2024. J. Doe agreed.\n1. First item\n2. Second"
+
+    assert chunk_stream(chunker, [text]) == [
+        "Dr. Smith said the U.S. economy grew 3.5 percent, e.g. in 2024.",
+        "J. Doe agreed.",
+        "1. First item",
+        "2. Second",
+    ]
+
+
+def test_long_sentences_are_split_at_clause_boundaries():
+    chunker = TextChunker(min_words=3, max_words=8, deadline=10.)
+    chunks = chunker.add("one two three four, five six seven eight nine ten eleven twelve thirteen ")
+
+    assert chunks == ["one two three four,", "five six seven eight nine ten eleven twelve"]
+    assert chunker.flush() == ["thirteen"]
+
+
+def test_deadline_releases_complete_words_only():
+    clock = FakeClock()
+    chunker = TextChunker(min_words=3, max_words=15, deadline=0.3, stall_deadline=1., clock=clock)
+
+    assert chunker.time_until_deadline() is None
+    assert chunker.add("Well, I thi") == []
+    assert chunker.time_until_deadline() == 0.3
+    clock.now = 0.2
+    assert chunker.poll() == []
+    assert chunker.time_until_deadline() is not None and abs(chunker.time_until_deadline() - 0.1) < 1e-9
+    clock.now = 0.3
+    assert chunker.poll() == ["Well, I"]
+    assert chunker.time_until_deadline() is None  # "thi" is not complete yet.
+    assert chunker.add("nk so, ") == []
+    assert chunker.time_until_deadline() == 1.  # The first chunk was released, the model is speaking.
+    clock.now = 1.3
+    assert chunker.poll() == ["think so,"]
+    assert chunker.add("yes.") == []
+    assert chunker.flush() == ["yes."]
+    assert chunker.flush() == []
+
+
+def test_deadline_counts_from_when_held_back_text_arrived():
+    clock = FakeClock()
+    chunker = TextChunker(min_words=3, max_words=15, deadline=0.3, clock=clock)
+
+    clock.now = 0.3
+    assert chunker.add("Let me think ", arrived=0.) == ["Let me think"]
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+
+import pytest
+
+from server.utils.message import Message
+from server.utils.streaming_connection import StreamingConnection
+from server.utils.tracing import TRACE_KEY, Tracer
+
+
+class FrameConnection:
+    """ Hands out the given frames to `recv`. """
+
+    subprotocol = None
+
+    def __init__(self, frames):
+        self.frames = asyncio.Queue()
+        for frame in frames:
+            self.frames.put_nowait(frame)
+
+    async def recv(self):
+        return await self.frames.get()
+
+
+def test_tracer_stamps_and_strips_trace_information():
+    sender = Tracer("sender", logging.getLogger("test_tracing_sender"))
+    receiver = Tracer("receiver", logging.getLogger("test_tracing_receiver"))
+    data = {"id": "req-1", "status": "GENERATING", "audio": b"\x00"}
+
+    stamped = sender.stamp(data)
+    assert TRACE_KEY not in data
+    assert stamped[TRACE_KEY]["msg_id"] == "sender#0"
+    assert sender.stamp(data)[TRACE_KEY]["msg_id"] == "sender#1"
+
+    assert receiver.received(stamped, size=10) == data
+    assert len(receiver.hop_latencies) == 1
+    assert receiver.latency_summary().startswith("hop latency over last 1 messages")
+
+
+def test_tracer_accepts_untraced_messages():
+    tracer = Tracer("receiver", logging.getLogger("test_tracing_untraced"))
+    data = {"id": "req-1", "status": "FINISHED"}
+
+    assert tracer.received(dict(data), size=10) == data
+    assert tracer.latency_summary() is None
+
+
+@pytest.mark.asyncio
+async def test_trace_is_stripped_even_if_the_receiver_does_not_trace():
+    data = {"id": "req-1", "status": "GENERATING", "text": "Hi"}
+    stamped = Tracer("sender", logging.getLogger("test_tracing_sender")).stamp(data)
+    receiver = StreamingConnection("test_tracing_untraced_receiver", FrameConnection([Message(stamped).encode()]))
+    receiver.tracer = None  # Like without debug logging.
+
+    recv_task = asyncio.create_task(receiver._recv_to_queue())
+    await asyncio.wait_for(receiver.wait_readable(), 1.)
+    recv_task.cancel()
+
+    assert receiver.recv() == [data]
@@ -0,0 +1,118 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip("moshi")
+
+import torch  # noqa: E402
+
+from server.base_server import BaseServer, Session, _current_session  # noqa: E402
+from server.tts import tts  # noqa: E402
+from server.tts.phrase_cache import PhraseCache  # noqa: E402
+
+FRAME = np.zeros(1920, dtype=np.float32)
+
+
+class FakeStream:
+    def __init__(self):
+        self.audio = asyncio.Queue()
+        self.text = []
+
+    async def get_audio_chunk(self):
+        return await self.audio.get()
+
+
+class FakeGenerator:
+    """ Generates one frame per utterance once it is finished, but nothing before. """
+
+    def __init__(self):
+        self.streams = []
+        self.closed = []
+
+    async def start(self):
+        pass
+
+    async def open_stream(self):
+        self.streams.append(FakeStream())
+        return self.streams[-1]
+
+    async def add_text(self, stream, text):
+        assert text is not None
+        stream.text.append(text)
+
+    async def finish(self, stream):
+        stream.audio.put_nowait(torch.from_numpy(FRAME))
+        stream.audio.put_nowait(None)
+
+    def close_stream(self, stream):
+        self.closed.append(stream)
+
+
+class FakeClientStream:
+    def __init__(self):
+        self.received = []
+        self.sent = []
+        self.readable = asyncio.Event()
+        self.closed = False
+
+    def send(self, msg):
+        self.sent.append(msg)
+
+    def put(self, msg):
+        self.received.append(msg)
+        self.readable.set()
+
+    def recv(self):
+        if self.closed:
+            raise ConnectionError
+        received, self.received = self.received, []
+        self.readable.clear()
+        return received
+
+    async def wait_readable(self, timeout=None):
+        try:
+            await asyncio.wait_for(self.readable.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def close(self):
+        self.closed = True
+        self.readable.set()
+
+
+async def wait_for_end(client, id_):
+    for _ in range(100):
+        if any(msg["id"] == id_ and msg["status"] == "FINISHED" for msg in client.sent):
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"{id_} did not end")
+
+
+async def test_cached_phrase_with_a_new_id_retires_the_utterance_that_is_still_generating(monkeypatch):
+    monkeypatch.setattr(tts, "CHUNK_DEADLINE", 0.1)
+    server = tts.TTSServer.__new__(tts.TTSServer)
+    BaseServer.__init__(server, "tts", "127.0.0.1", 0)
+    server.generator = FakeGenerator()
+    server.phrase_cache = PhraseCache("voice", ["Sorry, I ran into an error."])
+    server.phrase_cache.put("Sorry, I ran into an error.", [FRAME.tobytes()])
+    server.audio_config = {"format": 1, "channels": 1, "rate": 24_000}
+    client = FakeClientStream()
+    session = Session(None)
+    session.streams["client"] = client
+    _current_session.set(session)
+    workload = asyncio.create_task(server._handle_workload())
+
+    client.put({"id": "a", "text": "Paris is the capital of France. It is", "status": "GENERATING"})
+    await asyncio.sleep(0.05)
+    client.put({"id": "b", "text": "Sorry, I ran into an error.", "status": "FINISHED"})
+    await wait_for_end(client, "b")
+    await asyncio.sleep(tts.CHUNK_DEADLINE + 0.1)  # Past the deadlines of the old utterance.
+    client.put({"id": "c", "text": "Hello.", "status": "FINISHED"})
+    await wait_for_end(client, "c")
+    client.close()
+    await workload
+
+    assert server.generator.closed == [server.generator.streams[0]]
+    assert "".join(server.generator.streams[1].text) == "Hello."
+    assert {msg["id"] for msg in client.sent} == {"b", "c"}
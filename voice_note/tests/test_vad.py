@@ -0,0 +1,51 @@
+import numpy as np
+
+from server.utils.vad import EndOfSpeechDetector, int16_to_float, speech_bounds, split_at_pauses
+from tests.helpers import RATE, silence, tone
+
+
+def test_speech_bounds_trim_silence_but_keep_padding():
+    samples = int16_to_float(silence(2.) + tone(1.) + silence(.5) + tone(.5) + silence(3.))
+
+    start, end = speech_bounds(samples, RATE, padding=.2)
+
+    assert abs(start / RATE - 1.8) < .05
+    assert abs(end / RATE - 4.2) < .05
+
+
+def test_speech_bounds_ignore_silence_and_clicks():
+    assert speech_bounds(int16_to_float(silence(3.)), RATE) is None
+    assert speech_bounds(int16_to_float(silence(1.) + tone(.03) + silence(1.)), RATE) is None
+
+
+def test_end_of_speech_needs_speech_followed_by_silence():
+    detector = EndOfSpeechDetector(RATE, silence=1.)
+    audio = silence(2.) + tone(1.) + silence(.5) + tone(.5) + silence(1.5)
+    chunk = 1601  # Not a multiple of the frame size.
+    ended = [detector.add_audio(audio[idx:idx + chunk]) for idx in range(0, len(audio), chunk)]
+
+    first_end = ended.index(True) * chunk / 2 / RATE
+    assert 4.9 < first_end < 5.1  # 1 s after the end of the second tone.
+
+
+def test_silence_after_speech_restarts_with_speech():
+    detector = EndOfSpeechDetector(RATE, silence=1.)
+
+    detector.add_audio(silence(1.))
+    assert detector.silence_after_speech == 0.
+    detector.add_audio(tone(1.) + silence(.5))
+    assert abs(detector.silence_after_speech - .5) < .05
+    detector.add_audio(tone(.5) + silence(.2))
+    assert abs(detector.silence_after_speech - .2) < .05
+
+
+def test_split_at_pauses_keeps_windows_below_the_maximum():
+    samples = int16_to_float((tone(4.) + silence(.5)) * 5)  # 22.5 s
+
+    windows = split_at_pauses(samples, RATE, max_seconds=10.)
+
+    assert windows[0][0] == 0 and windows[-1][1] == len(samples)
+    assert all(end == next_start for (_, end), (next_start, _) in zip(windows, windows[1:]))
+    assert all(end - start <= 10 * RATE for start, end in windows)
+    # Splits inside the pauses.
+    assert all(np.all(samples[end - 100:end + 100] == 0) for _, end in windows[:-1])